@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+"""
+Stand-in for /bin/ip, /sbin/sysctl and /bin/kill used by benchmarks.
+
+Simulates namespaces, links, addresses, routes and sysctls in a JSON state file
+so nscommander can be run without root. The program to emulate is chosen by the
+name it is called with, so benchmarks link it as ip, sysctl and kill.
+
+Environment:
+    NSC_FAKE_STATE    state file
+    NSC_FAKE_LOG      every invocation is appended to this file
+    NSC_FAKE_LATENCY  seconds to sleep on every invocation
+"""
+
+import fcntl
+import ipaddress
+import json
+import os
+import sys
+import time
+
+
+class FakeError(Exception):
+    pass
+
+
+def namespace_state(state, name):
+    if name not in state['netns']:
+        raise FakeError('Cannot open network namespace "%s": No such file or directory' % name)
+    return state['netns'][name]
+
+
+def new_namespace():
+    return {'links': {'lo': {'up': False}}, 'addresses': {}, 'routes': {'4': {}, '6': {}}, 'sysctl': {}}
+
+
+def family_of(destination, options):
+    if '-6' in options:
+        return '6'
+    if '-4' in options:
+        return '4'
+    if destination in ['default', 'all']:
+        return '4'
+    return str(ipaddress.ip_network(destination, strict=False).version)
+
+
+def normalize(destination, family):
+    if destination == 'default':
+        destination = '0.0.0.0/0' if family == '4' else '::/0'
+    return str(ipaddress.ip_network(destination, strict=False))
+
+
+def connected(ns, family):
+    routes = {}
+    for link, addresses in ns['addresses'].items():
+        for address in addresses:
+            network = ipaddress.ip_interface(address).network
+            if str(network.version) == family and network.prefixlen != network.max_prefixlen:
+                routes[str(network)] = link
+    return routes
+
+
+def ip_netns(state, args, out):
+    command = args[0] if args else 'list'
+    if command in ['list', 'show']:
+        for name in sorted(state['netns'].keys()):
+            if name:
+                out.append(name)
+    elif command == 'add':
+        if args[1] in state['netns']:
+            raise FakeError('Cannot create namespace file "/run/netns/%s": File exists' % args[1])
+        state['netns'][args[1]] = new_namespace()
+    elif command in ['delete', 'del']:
+        namespace_state(state, args[1])
+        del state['netns'][args[1]]
+    elif command == 'pids':
+        namespace_state(state, args[1])
+    else:
+        raise FakeError('Unknown netns command "%s"' % command)
+
+
+def ip_link(state, ns, args, options, out):
+    command = args[0] if args else 'show'
+    if command == 'add':
+        (name, peer) = (args[1], args[args.index('peer') + 2])
+        for x in [name, peer]:
+            if x in ns['links']:
+                raise FakeError("RTNETLINK answers: File exists")
+        ns['links'][name] = {'up': False, 'peer': peer}
+        ns['links'][peer] = {'up': False, 'peer': name}
+    elif command == 'set':
+        name = args[1]
+        if name not in ns['links']:
+            raise FakeError('Cannot find device "%s"' % name)
+        if 'netns' in args:
+            target = args[args.index('netns') + 1]
+            target = '' if target == '1' else target
+            other = namespace_state(state, target)
+            other['links'][name] = ns['links'].pop(name)
+            other['addresses'][name] = ns['addresses'].pop(name, [])
+        if 'up' in args:
+            ns['links'][name]['up'] = True
+        if 'down' in args:
+            ns['links'][name]['up'] = False
+    elif command in ['delete', 'del']:
+        name = args[1]
+        if name not in ns['links']:
+            raise FakeError('Cannot find device "%s"' % name)
+        ns['links'].pop(name)
+        ns['addresses'].pop(name, None)
+        # Peer of veth disappears too, wherever it is
+        for other in state['netns'].values():
+            for (link, info) in list(other['links'].items()):
+                if info.get('peer') == name:
+                    other['links'].pop(link)
+                    other['addresses'].pop(link, None)
+    elif command in ['show', 'list']:
+        for (index, (name, info)) in enumerate(sorted(ns['links'].items())):
+            out.append("%d: %s: <%s> mtu 1500" % (index + 1, name, 'UP' if info['up'] else ''))
+    else:
+        raise FakeError('Unknown link command "%s"' % command)
+
+
+def ip_address(ns, args, options, out):
+    command = args[0] if args else 'show'
+    if command in ['add', 'delete', 'del']:
+        (address, name) = (args[1], args[args.index('dev') + 1])
+        if name not in ns['links']:
+            raise FakeError('Cannot find device "%s"' % name)
+        addresses = ns['addresses'].setdefault(name, [])
+        if command == 'add':
+            if address in addresses:
+                raise FakeError("Error: ipv4: Address already assigned.")
+            addresses.append(address)
+        else:
+            if address not in addresses:
+                raise FakeError("Error: ipv4: Address not found.")
+            addresses.remove(address)
+    elif command in ['show', 'list']:
+        names = sorted(ns['links'].keys())
+        if 'dev' in args:
+            names = [args[args.index('dev') + 1]]
+        if '-json' in options or '-j' in options:
+            out.append(json.dumps([{'ifname': name, 'ifindex': i + 1,
+                                    'flags': ['UP'] if ns['links'][name]['up'] else [],
+                                    'addr_info': [{'family': 'inet' if ':' not in x else 'inet6',
+                                                   'local': x.split('/')[0], 'prefixlen': int(x.split('/')[1])}
+                                                  for x in ns['addresses'].get(name, [])]}
+                                   for (i, name) in enumerate(names)]))
+            return
+        for name in names:
+            out.append("1: %s: <>" % name)
+            for address in ns['addresses'].get(name, []):
+                family = 'inet6' if ':' in address else 'inet'
+                if ('-6' in options and family == 'inet') or ('-4' in options and family == 'inet6'):
+                    continue
+                out.append("    %s %s scope global %s" % (family, address, name))
+    else:
+        raise FakeError('Unknown address command "%s"' % command)
+
+
+def ip_route(ns, args, options, out):
+    command = args[0] if args else 'show'
+    if command in ['add', 'delete', 'del', 'replace']:
+        family = family_of(args[1], options)
+        destination = normalize(args[1], family)
+        routes = ns['routes'][family]
+        vias = [args[i + 1] for (i, x) in enumerate(args) if x == 'via']
+        if command == 'add' and (destination in routes or destination in connected(ns, family)):
+            raise FakeError("RTNETLINK answers: File exists")
+        if command in ['delete', 'del']:
+            if destination not in routes:
+                raise FakeError("RTNETLINK answers: No such process")
+            del routes[destination]
+            return
+        routes[destination] = vias
+    elif command in ['show', 'list']:
+        family = '6' if '-6' in options else '4'
+        if 'root' in args:
+            family = family_of(args[args.index('root') + 1], options)
+        routes = [(x, None, 'kernel') for x in connected(ns, family).keys()]
+        routes += [(x, vias, 'boot') for (x, vias) in ns['routes'][family].items()]
+        if '-json' in options or '-j' in options:
+            result = []
+            for (destination, vias, protocol) in routes:
+                route = {'dst': destination, 'flags': []}
+                if protocol == 'kernel':
+                    route['protocol'] = 'kernel'
+                if vias and len(vias) == 1:
+                    route['gateway'] = vias[0]
+                elif vias:
+                    route['nexthops'] = [{'gateway': x} for x in vias]
+                result.append(route)
+            out.append(json.dumps(result))
+            return
+        for (destination, vias, protocol) in routes:
+            out.append("%s %s" % (destination, ' '.join(["via %s" % x for x in vias or []])))
+    else:
+        raise FakeError('Unknown route command "%s"' % command)
+
+
+def ip_command(state, args, namespace, options, out):
+    if not args:
+        raise FakeError("Usage: ip OBJECT COMMAND")
+    obj = args[0]
+    if obj == 'netns':
+        if len(args) > 2 and args[1] == 'exec':
+            return execute(state, os.path.basename(args[3]), args[4:], args[2], out)
+        return ip_netns(state, args[1:], out)
+    ns = namespace_state(state, namespace)
+    if 'link'.startswith(obj):
+        ip_link(state, ns, args[1:], options, out)
+    elif 'address'.startswith(obj):
+        ip_address(ns, args[1:], options, out)
+    elif 'route'.startswith(obj):
+        ip_route(ns, args[1:], options, out)
+    else:
+        raise FakeError('Object "%s" is unknown, try "ip help".' % obj)
+
+
+def ip_main(state, args, namespace, out):
+    options = []
+    batch = None
+    while args and args[0].startswith('-'):
+        option = args.pop(0)
+        if option in ['-n', '-netns']:
+            namespace = args.pop(0)
+        elif option == '-batch':
+            batch = args.pop(0)
+        else:
+            options.append(option)
+    if batch is None:
+        return ip_command(state, args, namespace, options, out)
+    lines = (sys.stdin if batch == '-' else open(batch)).read().splitlines()
+    failed = False
+    for (number, line) in enumerate(lines):
+        if not line.strip():
+            continue
+        try:
+            ip_command(state, line.split(), namespace, options, out)
+        except FakeError as e:
+            sys.stderr.write("%s\nCommand failed %s:%d\n" % (e, batch, number + 1))
+            failed = True
+            if '-force' not in options:
+                break
+    if failed:
+        raise FakeError(None)
+
+
+def sysctl_main(state, args, namespace, out):
+    ns = namespace_state(state, namespace)
+    if args and args[0] == '-w':
+        for pair in args[1:]:
+            (key, value) = pair.split('=', 1)
+            ns['sysctl'][key] = value
+    elif args and args[0] == '-n':
+        for key in args[1:]:
+            out.append(ns['sysctl'].get(key, '0'))
+    elif args and args[0] == '-e':
+        # Keys never written are taken as missing, -e leaves them out
+        for key in args[1:]:
+            if key in ns['sysctl']:
+                out.append("%s = %s" % (key, ns['sysctl'][key]))
+    else:
+        raise FakeError("sysctl: unsupported arguments %s" % ' '.join(args))
+
+
+def execute(state, program, args, namespace, out):
+    if program == 'ip':
+        ip_main(state, list(args), namespace, out)
+    elif program == 'sysctl':
+        sysctl_main(state, list(args), namespace, out)
+    # Everything else, such as kill and commands of run entries, just succeeds
+
+
+def main():
+    program = os.path.basename(sys.argv[0])
+    if os.environ.get('NSC_FAKE_LOG'):
+        with open(os.environ['NSC_FAKE_LOG'], 'a') as log:
+            log.write("%s\n" % ' '.join([program] + sys.argv[1:]))
+    time.sleep(float(os.environ.get('NSC_FAKE_LATENCY', '0')))
+    path = os.environ['NSC_FAKE_STATE']
+    with open(path, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        data = f.read()
+        state = json.loads(data) if data else {'netns': {'': new_namespace()}}
+        out = []
+        try:
+            execute(state, program, sys.argv[1:], '', out)
+            status = 0
+        except FakeError as e:
+            if e.args[0]:
+                sys.stderr.write("%s\n" % e)
+            status = 1
+        f.seek(0)
+        f.truncate()
+        f.write(json.dumps(state))
+    if out:
+        sys.stdout.write('\n'.join(out) + '\n')
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Benchmark nscommander phases on synthetic topologies without root.
+
+/bin/ip, /sbin/sysctl and /bin/kill are replaced with fakeip.py, which
+simulates kernel state and optional latency and logs every invocation.
+Wall time and number of started subprocesses are recorded for
+normalize_config, parse_templates, create_from_config, destroy_from_config,
+compile_config and replay_plan.
+
+    benchmarks/run.py --topology chain --sizes 10 50 --output results.json
+    benchmarks/run.py --topology chain --sizes 10 50 --compare results.json
+"""
+
+import copy
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ip
+import nscommander
+import supervisor
+from topology import TOPOLOGIES
+
+TEMPLATE = """router id {{ namespace.interfaces[0].address.split('/')[0] }};
+{% for route in namespace.routes %}
+route {{ route.destination }} via {{ route.nexthop[0].via }};
+{% endfor %}
+"""
+
+
+class FakeEnvironment(object):
+    """
+    Temporary directory with fake ip, sysctl and kill commands installed to ip module
+    """
+    def __init__(self, latency=0.0):
+        self.directory = tempfile.mkdtemp(prefix="nscommander-bench-")
+        self.log = os.path.join(self.directory, 'commands.log')
+        self.saved = (ip.IPCOMMAND, ip.SYSCTLCOMMAND, ip.KILLCOMMAND, supervisor.PID_DIR)
+        fake = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fakeip.py')
+        for name in ['ip', 'sysctl', 'kill']:
+            os.symlink(fake, os.path.join(self.directory, name))
+        os.environ['NSC_FAKE_STATE'] = os.path.join(self.directory, 'state.json')
+        os.environ['NSC_FAKE_LOG'] = self.log
+        os.environ['NSC_FAKE_LATENCY'] = str(latency)
+        ip.IPCOMMAND = os.path.join(self.directory, 'ip')
+        ip.SYSCTLCOMMAND = os.path.join(self.directory, 'sysctl')
+        ip.KILLCOMMAND = os.path.join(self.directory, 'kill')
+        supervisor.PID_DIR = os.path.join(self.directory, 'pids')
+        self.template = {'source': os.path.join(self.directory, 'template.conf'),
+                         'destination': os.path.join(self.directory, 'out', '{{ namespace.name }}.conf')}
+        os.mkdir(os.path.join(self.directory, 'out'))
+        with open(self.template['source'], 'w') as f:
+            f.write(TEMPLATE)
+
+    def commands(self):
+        if not os.path.exists(self.log):
+            return 0
+        with open(self.log) as f:
+            return sum([1 for _ in f])
+
+    def close(self):
+        (ip.IPCOMMAND, ip.SYSCTLCOMMAND, ip.KILLCOMMAND, supervisor.PID_DIR) = self.saved
+        shutil.rmtree(self.directory)
+
+
+def measure(environment, func):
+    commands = environment.commands()
+    start = time.perf_counter()
+    func()
+    return {'seconds': time.perf_counter() - start, 'subprocesses': environment.commands() - commands}
+
+
+def run_benchmark(topology, size, jobs=1, latency=0.0, templates=True):
+    environment = FakeEnvironment(latency=latency)
+    try:
+        raw = TOPOLOGIES[topology](size, template=environment.template if templates else None)
+        config = copy.deepcopy(raw)
+        phases = {}
+        phases['normalize_config'] = measure(environment, lambda: nscommander.normalize_config(config))
+        phases['parse_templates'] = measure(environment, lambda: nscommander.render_templates(
+            list(config['namespaces'].values()), jobs=jobs))
+        phases['create_from_config'] = measure(environment, lambda: nscommander.create_from_config(config, jobs=jobs))
+        phases['destroy_from_config'] = measure(environment, lambda: nscommander.destroy_from_config(
+            config, jobs=jobs, grace=0))
+        compiled = {}
+        phases['compile_config'] = measure(environment, lambda: compiled.update(nscommander.compile_config(config)))
+        phases['replay_plan'] = measure(environment, lambda: nscommander.replay_plan(compiled, jobs=jobs))
+        nscommander.destroy_from_config(config, jobs=jobs, grace=0)
+    finally:
+        environment.close()
+    interfaces = sum([len(x['interfaces']) for x in raw['namespaces'].values()])
+    routes = sum([len(x.get('routes', [])) + len(x.get('routes6', [])) for x in raw['namespaces'].values()])
+    return {'topology': topology, 'size': size, 'jobs': jobs, 'latency': latency,
+            'namespaces': len(raw['namespaces']), 'interfaces': interfaces, 'routes': routes,
+            'phases': phases}
+
+
+def version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous):
+    """
+    Print phase timings next to timings of previous results of the same benchmark
+    """
+    def key(result):
+        return (result['topology'], result['size'], result['jobs'], result['latency'])
+    old = dict([(key(x), x) for x in previous['results']])
+    print("%-12s %6s %-20s %10s %10s %7s %8s %8s" % ('topology', 'size', 'phase', 'old s', 'new s', 'ratio',
+                                                     'old proc', 'new proc'))
+    for result in results['results']:
+        before = old.get(key(result))
+        for phase, values in result['phases'].items():
+            if before is None or phase not in before['phases']:
+                continue
+            was = before['phases'][phase]
+            print("%-12s %6d %-20s %10.3f %10.3f %7.2f %8d %8d" % (
+                result['topology'], result['size'], phase, was['seconds'], values['seconds'],
+                values['seconds'] / was['seconds'] if was['seconds'] else 0.0,
+                was['subprocesses'], values['subprocesses']))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-t", "--topology", choices=sorted(TOPOLOGIES.keys()), default="chain")
+    parser.add_argument("-s", "--sizes", type=int, nargs='+', default=[10, 50])
+    parser.add_argument("-j", "--jobs", type=int, default=1)
+    parser.add_argument("-l", "--latency", type=float, default=0.0, help="Simulated latency of every command")
+    parser.add_argument("--no-templates", default=False, action="store_true")
+    parser.add_argument("-o", "--output", help="Save results as JSON")
+    parser.add_argument("-c", "--compare", help="Compare to results saved earlier")
+    args = parser.parse_args()
+
+    ip.set_backend('ip')
+    ip.set_exec_mode('exec')
+    results = {'version': version(), 'python': platform.python_version(), 'time': time.time(), 'results': []}
+    for size in args.sizes:
+        result = run_benchmark(args.topology, size, jobs=args.jobs, latency=args.latency,
+                               templates=not args.no_templates)
+        results['results'].append(result)
+        for phase, values in result['phases'].items():
+            print("%s %d %s: %.3fs, %d subprocesses" % (args.topology, size, phase, values['seconds'],
+                                                        values['subprocesses']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
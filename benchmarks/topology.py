@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Generator of synthetic topologies for benchmarks.
+
+Every generator returns configuration in the same format nscommander reads
+from yaml. Running this file writes a generated topology as yaml.
+"""
+
+import ipaddress
+import sys
+
+import yaml
+
+
+class Addresses(object):
+    """
+    Allocates point-to-point and loopback addresses
+    """
+    def __init__(self):
+        self.links = ipaddress.ip_network('10.0.0.0/9').subnets(new_prefix=30)
+        # Wide enough for every IPv4 link, so IPv4 addresses run out first
+        self.links6 = ipaddress.ip_network('fd00::/32').subnets(new_prefix=64)
+        self.loopbacks = ipaddress.ip_network('10.200.0.0/16').hosts()
+
+    @staticmethod
+    def _next(addresses, kind):
+        try:
+            return next(addresses)
+        except StopIteration:
+            raise ValueError("Topology too large, %s addresses ran out" % kind)
+
+    def link(self):
+        hosts = list(self._next(self.links, 'link').hosts())
+        hosts6 = self._next(self.links6, 'IPv6 link')
+        return ("%s/30" % hosts[0], "%s/30" % hosts[1],
+                "%s/64" % (hosts6.network_address + 1), "%s/64" % (hosts6.network_address + 2))
+
+    def loopback(self):
+        return "%s/32" % self._next(self.loopbacks, 'loopback')
+
+
+def _namespace(loopback, template=None):
+    namespace = {'interfaces': [{'name': 'lo', 'address': loopback}], 'routes': [], 'routes6': [],
+                 'sysctl': {'net.ipv4.icmp_ratelimit': 0}}
+    if template:
+        namespace['templates'] = [{'source': template['source'],
+                                   'destination': template['destination']}]
+    return namespace
+
+
+def _veth(namespaces, addresses, name, peer, prefix):
+    (my, other, my6, other6) = addresses.link()
+    namespaces[name]['interfaces'].append({'type': 'veth', 'peer': peer, 'name_prefix': prefix,
+                                           'my_address': my, 'peer_address': other,
+                                           'my_address6': my6, 'peer_address6': other6})
+    return (my.split('/')[0], other.split('/')[0], my6.split('/')[0], other6.split('/')[0])
+
+
+def chain(size, max_routes=50, template=None):
+    """
+    Namespaces connected one after another, each has routes to loopbacks of
+    up to max_routes nearest namespaces.
+    """
+    addresses = Addresses()
+    names = ["c%d" % i for i in range(size)]
+    loopbacks = {}
+    namespaces = {}
+    for name in names:
+        loopbacks[name] = addresses.loopback()
+        namespaces[name] = _namespace(loopbacks[name], template)
+    gateways = {}
+    for (i, name) in enumerate(names[:-1]):
+        (my, other, _, _) = _veth(namespaces, addresses, name, names[i + 1], "c%d" % i)
+        # Next hop towards right is the address of the right end and vice versa
+        gateways[(name, 'right')] = other
+        gateways[(names[i + 1], 'left')] = my
+    for (i, name) in enumerate(names):
+        others = sorted([j for j in range(size) if j != i], key=lambda j: abs(i - j))[:max_routes]
+        for j in others:
+            direction = 'right' if j > i else 'left'
+            namespaces[name]['routes'].append({'destination': loopbacks[names[j]],
+                                               'nexthop': gateways[(name, direction)]})
+    return {'namespaces': namespaces}
+
+
+def mesh(size, template=None):
+    """
+    Every namespace connected to every other namespace
+    """
+    addresses = Addresses()
+    names = ["m%d" % i for i in range(size)]
+    loopbacks = {}
+    namespaces = {}
+    for name in names:
+        loopbacks[name] = addresses.loopback()
+        namespaces[name] = _namespace(loopbacks[name], template)
+    for (i, name) in enumerate(names):
+        for (j, peer) in enumerate(names[i + 1:], i + 1):
+            (my, other, _, _) = _veth(namespaces, addresses, name, peer, "m%dx%d" % (i, j))
+            namespaces[name]['routes'].append({'destination': loopbacks[peer], 'nexthop': other})
+            namespaces[peer]['routes'].append({'destination': loopbacks[name], 'nexthop': my})
+    return {'namespaces': namespaces}
+
+
+def leaf_spine(leaves, spines, ecmp=2, template=None):
+    """
+    Every leaf connected to every spine, leaves reach each other
+    with ecmp way IPv4 and IPv6 ECMP routes over spines.
+    """
+    addresses = Addresses()
+    leaf_names = ["l%d" % i for i in range(leaves)]
+    spine_names = ["s%d" % i for i in range(spines)]
+    loopbacks = {}
+    namespaces = {}
+    for name in leaf_names + spine_names:
+        loopbacks[name] = addresses.loopback()
+        namespaces[name] = _namespace(loopbacks[name], template)
+    uplinks = {}
+    for (i, leaf) in enumerate(leaf_names):
+        for (j, spine) in enumerate(spine_names):
+            (my, other, my6, other6) = _veth(namespaces, addresses, leaf, spine, "l%ds%d" % (i, j))
+            uplinks.setdefault(leaf, []).append((other, other6))
+            namespaces[spine]['routes'].append({'destination': loopbacks[leaf], 'nexthop': my})
+    for (i, leaf) in enumerate(leaf_names):
+        vias = uplinks[leaf][:ecmp]
+        for (j, other) in enumerate(leaf_names):
+            if other == leaf:
+                continue
+            if len(vias) > 1:
+                nexthop = [{'via': x[0]} for x in vias]
+                nexthop6 = [{'via': x[1]} for x in vias]
+            else:
+                nexthop = vias[0][0]
+                nexthop6 = vias[0][1]
+            namespaces[leaf]['routes'].append({'destination': loopbacks[other], 'nexthop': nexthop})
+            namespaces[leaf]['routes6'].append({'destination': "fd00:%x::/64" % (j + 1), 'nexthop': nexthop6})
+    return {'namespaces': namespaces}
+
+
+TOPOLOGIES = {
+    'chain': lambda size, template=None: chain(size, template=template),
+    'mesh': lambda size, template=None: mesh(size, template=template),
+    'leaf-spine': lambda size, template=None: leaf_spine(size, max(2, size // 8), template=template),
+}
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('topology', choices=sorted(TOPOLOGIES.keys()))
+    parser.add_argument('size', type=int, help="Number of namespaces, leaves in leaf-spine")
+    args = parser.parse_args()
+    yaml.dump(TOPOLOGIES[args.topology](args.size), sys.stdout, default_flow_style=False)
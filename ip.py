@@ -1,11 +1,18 @@
 
 import subprocess
+import contextlib
+import ctypes
+import ipaddress
+import json
 import string
 import random
 import sys
 import os
-import yaml
 import logging
+import threading
+import time
+
+from profiling import profiler
 
 
 logger = logging.getLogger("ipns")
@@ -13,6 +20,24 @@ logger = logging.getLogger("ipns")
 IPCOMMAND = '/bin/ip'
 KILLCOMMAND = '/bin/kill'
 SYSCTLCOMMAND = '/sbin/sysctl'
+NETNS_RUN_DIR = '/run/netns'
+
+# Backend used to talk to the kernel, 'ip' or 'netlink'
+BACKEND = 'ip'
+
+# How commands are run inside namespaces, 'exec' uses `ip netns exec`
+# and 'worker' sends them to a helper process living in the namespace
+EXEC_MODE = 'exec'
+
+CLONE_NEWNET = 0x40000000
+
+# Order of link counters returned by link_stats of backends
+LINK_STATS = ['rx_bytes', 'rx_packets', 'rx_errors', 'rx_dropped', 'tx_bytes', 'tx_packets', 'tx_errors', 'tx_dropped']
+
+# Pool of idle namespaces used to create and delete namespaces, see pool module
+POOL = None
+
+_libc = None
 
 
 class IPException(Exception):
@@ -23,31 +48,555 @@ def random_string(prefix="", length=16):
     return prefix + ''.join([random.choice(string.ascii_lowercase + string.digits) for x in range(length)])
 
 
-class IPContext(object):
+def set_backend(name):
+    global BACKEND
+    if name not in ['ip', 'netlink']:
+        raise IPException("Unknown backend '%s'" % name)
+    BACKEND = name
+
+
+def set_exec_mode(mode):
+    global EXEC_MODE
+    if mode not in ['exec', 'worker']:
+        raise IPException("Unknown execution mode '%s'" % mode)
+    EXEC_MODE = mode
+
+
+def set_pool(pool):
+    """
+    Take namespaces from pool on create and recycle them to it on delete, None disables pool
+    """
+    global POOL
+    POOL = pool
+
+
+def netns_path(name):
+    return os.path.join(NETNS_RUN_DIR, name)
+
+
+def setns(fd, nstype=CLONE_NEWNET):
+    """
+    Move calling thread to namespace referred by file descriptor fd
+    """
+    global _libc
+    if hasattr(os, 'setns'):
+        os.setns(fd, nstype)
+        return
+    if _libc is None:
+        _libc = ctypes.CDLL(None, use_errno=True)
+    if _libc.setns(fd, nstype) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+
+@contextlib.contextmanager
+def netns_entered(name):
+    """
+    Run the calling thread inside network namespace name for duration of with block
+    """
+    if not name:
+        yield
+        return
+    own = os.open('/proc/thread-self/ns/net', os.O_RDONLY)
+    try:
+        target = os.open(netns_path(name), os.O_RDONLY)
+        try:
+            setns(target)
+        finally:
+            os.close(target)
+        try:
+            yield
+        finally:
+            setns(own)
+    finally:
+        os.close(own)
+
+
+class IPBatch(object):
+    """
+    Queue of ip commands executed with one `ip -batch` pipe per namespace.
+
+    Commands are tagged with description of the config item they were
+    queued for, so failures reported by ip can be mapped back to config.
+    """
+    def __init__(self, force=True):
+        self.force = force
+        self.tag = None
+        self.queues = {}
+
+    def __len__(self):
+        return sum([len(x) for x in self.queues.values()])
+
+    @contextlib.contextmanager
+    def describe(self, tag):
+        old_tag = self.tag
+        self.tag = tag
+        try:
+            yield self
+        finally:
+            self.tag = old_tag
+
+    def add(self, namespace, args):
+        # Global options such as -6 are not accepted inside batch file,
+        # commands with different options are sent through separate pipes
+        args = list(args)
+        options = []
+        while args and args[0].startswith('-'):
+            options.append(args.pop(0))
+        self.queues.setdefault((namespace, tuple(options)), []).append((args, self.tag))
+
+    def _execute_namespace(self, namespace, options, commands):
+        command = [IPCOMMAND]
+        if namespace:
+            command += ['-n', namespace]
+        command += list(options)
+        if self.force:
+            command.append('-force')
+        command += ['-batch', '-']
+        script = ''.join(["%s\n" % ' '.join(args) for (args, _) in commands])
+        logger.debug("Executing batch of %d commands: %s" % (len(commands), ' '.join(command)))
+        start = time.monotonic()
+        p = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (stdout, stderr) = p.communicate(script.encode("utf-8"))
+        profiler.record('batch', "%s (%d commands)" % (' '.join(command), len(commands)), namespace, start,
+                        p.returncode, len(stdout))
+        if p.returncode == 0:
+            return []
+        failures = []
+        messages = []
+        for line in stderr.decode("utf-8", "replace").splitlines():
+            if line.startswith('Command failed -:'):
+                index = int(line.split(':')[-1]) - 1
+                if 0 <= index < len(commands):
+                    (args, tag) = commands[index]
+                    failures.append((namespace, tag, args, ' '.join(messages)))
+                messages = []
+            elif line.strip():
+                messages.append(line.strip())
+        if not failures:
+            failures.append((namespace, None, command, stderr.decode("utf-8", "replace").strip()))
+        return failures
+
+    def execute(self):
+        """
+        Execute all queued commands and clear the queue.
+        :raises IPException: listing every failed command and its config item
+        """
+        queues = self.queues
+        self.queues = {}
+        failures = []
+        for (namespace, options), commands in queues.items():
+            failures += self._execute_namespace(namespace, options, commands)
+        for namespace in set([x[0] for x in failures]):
+            # State was updated when commands were queued
+            invalidate_state(namespace)
+        if failures:
+            lines = []
+            for (namespace, tag, args, message) in failures:
+                lines.append("%s%s (namespace %s): %s" % ("%s: " % tag if tag else "", ' '.join(args),
+                                                         namespace or 'global', message))
+            raise IPException("%d batched command(s) failed:\n%s" % (len(failures), '\n'.join(lines)))
+
+
+TABLE_NAMES = {253: 'default', 254: 'main', 255: 'local'}
+
+
+def route_key(destination, ipversion='4', table='main'):
+    """
+    Index key of route, destination is normalized so that e.g. fc00::0/64 and fc00::/64 match
+    """
+    if destination == 'default':
+        destination = '0.0.0.0/0' if str(ipversion) == '4' else '::/0'
+    return (str(TABLE_NAMES.get(table, table)), str(ipaddress.ip_network(destination, strict=False)))
+
+
+def address_key(address):
+    return str(ipaddress.ip_interface(address))
+
+
+class NamespaceState(object):
+    """
+    Links, addresses and routes of one namespace.
+
+    Loaded with one structured dump and updated in place after every change done
+    through IP and Interface, so existence checks do not need to query the kernel.
+    Changes done outside nscommander require explicit invalidate().
+    """
     def __init__(self, namespace=None):
         self.namespace = namespace
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.links = {}
+        self.addresses = {}
+        self.routes = {}
+
+    def load(self, backend):
+        with self.lock:
+            if self.loaded:
+                return
+            dump = backend.dump()
+            self.links = dict([(x['name'], x) for x in dump['links']])
+            self.addresses = {}
+            for (name, address) in dump['addresses']:
+                self.addresses.setdefault(name, set()).add(address_key(address))
+            self.routes = {}
+            for route in dump['routes']:
+                self.routes[route_key(route['destination'], route['family'], route['table'])] = route
+            self.loaded = True
+
+    def invalidate(self):
+        with self.lock:
+            self.loaded = False
+            self.links = {}
+            self.addresses = {}
+            self.routes = {}
+
+    def has_link(self, name):
+        return name in self.links
+
+    def add_link(self, name, **info):
+        info['name'] = name
+        self.links[name] = info
+
+    def remove_link(self, name):
+        self.links.pop(name, None)
+        self.addresses.pop(name, None)
+
+    def get_addresses(self, name, ipversion=None):
+        return [x for x in sorted(self.addresses.get(name, []))
+                if ipversion is None or str(ipaddress.ip_interface(x).version) == str(ipversion)]
+
+    def has_address(self, name, address):
+        return address_key(address) in self.addresses.get(name, ())
+
+    def add_address(self, name, address):
+        self.addresses.setdefault(name, set()).add(address_key(address))
+        # Kernel adds route to the connected prefix
+        network = ipaddress.ip_interface(address).network
+        if network.prefixlen != network.max_prefixlen:
+            key = route_key(str(network), network.version)
+            if key not in self.routes:
+                self.routes[key] = {'destination': str(network), 'family': str(network.version),
+                                    'table': 'main', 'protocol': 'kernel', 'nexthops': []}
+
+    def remove_address(self, name, address):
+        self.addresses.get(name, set()).discard(address_key(address))
+        network = ipaddress.ip_interface(address).network
+        for addresses in self.addresses.values():
+            for other in addresses:
+                if ipaddress.ip_interface(other).network == network:
+                    return
+        self.routes.pop(route_key(str(network), network.version), None)
+
+    def has_route(self, destination, ipversion='4', table='main'):
+        return route_key(destination, ipversion, table) in self.routes
+
+    def add_route(self, destination, nexthops, ipversion='4', table='main'):
+        self.routes[route_key(destination, ipversion, table)] = {
+            'destination': destination, 'family': str(ipversion), 'table': table, 'protocol': 'boot',
+            'nexthops': [{'via': x['via']} for x in nexthops]}
+
+    def remove_route(self, destination, ipversion='4', table='main'):
+        self.routes.pop(route_key(destination, ipversion, table), None)
+
+
+_states = {}
+_states_lock = threading.Lock()
+
+
+def get_state(namespace):
+    with _states_lock:
+        if namespace not in _states:
+            _states[namespace] = NamespaceState(namespace)
+        return _states[namespace]
+
+
+def invalidate_state(namespace):
+    with _states_lock:
+        state = _states.pop(namespace, None)
+    if state is not None:
+        state.invalidate()
+
+
+def invalidate_states():
+    for namespace in list(_states.keys()):
+        invalidate_state(namespace)
+
+
+class IPContext(object):
+    def __init__(self, namespace=None, batch=None):
+        self.namespace = namespace
+        self.batch = batch
+        self._backend = None
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            if BACKEND == 'netlink':
+                from netlink import NetlinkBackend
+                self._backend = NetlinkBackend(self)
+            else:
+                self._backend = CommandBackend(self)
+        return self._backend
 
     def _ns_prefix(self):
         if not self.namespace:
             return []
         return [IPCOMMAND, 'netns', 'exec', self.namespace]
 
+    @property
+    def state(self):
+        """
+        Snapshot of links, addresses and routes in this namespace, loaded on first use
+        """
+        state = get_state(self.namespace)
+        state.load(self.backend)
+        return state
+
     def run(self, *args, background=False, output_file=None):
-        command = self._ns_prefix() + list(args)
+        if EXEC_MODE == 'worker' and self.namespace:
+            from nsworker import get_worker
+            return get_worker(self.namespace).run(args, background=background, output_file=output_file)
+        return self._execute(self._ns_prefix() + list(args), background=background, output_file=output_file)
+
+    def sysctl(self, values):
+        """
+        Set sysctl keys of dict values in this namespace.
+
+        Values are written by the namespace helper in worker mode, directly to /proc/sys
+        from a thread entered to the namespace with netlink backend and otherwise with
+        one sysctl command.
+        """
+        if not values:
+            return
+        if EXEC_MODE == 'worker' and self.namespace:
+            from nsworker import get_worker
+            get_worker(self.namespace).sysctl(values)
+        elif EXEC_MODE == 'worker' or BACKEND == 'netlink':
+            from nsworker import write_sysctl
+            start = time.monotonic()
+            with netns_entered(self.namespace):
+                write_sysctl(values)
+            profiler.record('sysctl', "write %s" % ' '.join(values.keys()), self.namespace, start)
+        else:
+            self.run(SYSCTLCOMMAND, '-w', *["%s=%s" % (key, str(value)) for (key, value) in values.items()])
+
+    def read_sysctl(self, keys):
+        """
+        Return dict of current values of sysctl keys in this namespace, keys which do not exist are left out
+        """
+        keys = list(keys)
+        if not keys:
+            return {}
+        if EXEC_MODE == 'worker' and self.namespace:
+            from nsworker import get_worker
+            return get_worker(self.namespace).read_sysctl(keys)
+        elif EXEC_MODE == 'worker' or BACKEND == 'netlink':
+            from nsworker import read_sysctl
+            start = time.monotonic()
+            with netns_entered(self.namespace):
+                values = read_sysctl(keys)
+            profiler.record('sysctl', "read %s" % ' '.join(keys), self.namespace, start)
+            return values
+        # -e skips unknown keys, so lines are matched to keys by the name printed with them
+        output = self.run(SYSCTLCOMMAND, '-e', *keys)
+        values = {}
+        for line in output.splitlines():
+            (key, separator, value) = line.partition('=')
+            if separator:
+                values[key.strip()] = ' '.join(value.split())
+        return values
+
+    def ip_json(self, *commands):
+        """
+        Run read only ip commands with one `ip -json -batch` and return list of decoded outputs
+        """
+        command = [IPCOMMAND]
+        if self.namespace:
+            command += ['-n', self.namespace]
+        command += ['-json', '-batch', '-']
+        output = self._execute(command, input=''.join(["%s\n" % x for x in commands]))
+        decoder = json.JSONDecoder()
+        results = []
+        offset = 0
+        while True:
+            while offset < len(output) and output[offset].isspace():
+                offset += 1
+            if offset >= len(output):
+                return results
+            (value, offset) = decoder.raw_decode(output, offset)
+            results.append(value)
+
+    def _execute(self, command, input=None, background=False, output_file=None):
+        """
+        Run command and return its output.
+
+        Output of commands with output_file is streamed to the file instead. Background
+        commands are started in a new session with output appended to output_file or
+        discarded, and their PID is returned.
+        """
         logger.debug("Executing command: %s" % ' '.join(command))
-        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        start = time.monotonic()
         if background:
-            return
-        (stdout, stderr) = p.communicate()
+            with open(output_file or os.devnull, 'ab') as o:
+                p = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=o, stderr=subprocess.STDOUT,
+                                     start_new_session=True)
+            profiler.record('spawn', ' '.join(command), self.namespace, start)
+            return p.pid
+        if output_file:
+            with open(output_file, 'wb') as o:
+                p = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=o, stderr=subprocess.PIPE)
+                (stdout, stderr) = p.communicate()
+            stdout = b''
+        else:
+            p = subprocess.Popen(command, stdin=subprocess.PIPE if input is not None else None,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            (stdout, stderr) = p.communicate(input.encode("utf-8") if input is not None else None)
         return_code = p.wait()
+        profiler.record('exec', ' '.join(command), self.namespace, start, return_code, len(stdout))
 
         if return_code != 0:
             raise IPException("%s command failed:\n%s\n%s" % (' '.join(command), stdout, stderr))
-        if output_file:
-            with open(output_file, 'wb') as o:
-                o.write(stdout)
         return stdout.decode("utf-8")
 
+    def ip(self, *args):
+        """
+        Run state changing ip command, or queue it if batching is enabled
+        """
+        if self.batch is not None:
+            self.batch.add(self.namespace, args)
+            return
+        self.run(IPCOMMAND, *args)
+
+
+class CommandBackend(object):
+    """
+    Backend doing every operation by running /bin/ip
+    """
+    def __init__(self, context):
+        self.context = context
+
+    def link_add_veth(self, name, peer):
+        self.context.ip('link', 'add', name, 'type', 'veth', 'peer', 'name', peer)
+
+    def link_set_netns(self, name, netns):
+        """
+        Move link to namespace netns, None is the global namespace
+        """
+        self.context.ip('link', 'set', name, 'netns', netns or '1')
+
+    def link_set(self, name, up=True):
+        self.context.ip('link', 'set', name, 'up' if up else 'down')
+
+    def link_del(self, name):
+        self.context.ip('link', 'delete', name)
+
+    def dump(self):
+        """
+        Return links, addresses and routes of namespace with one ip command
+        """
+        (addresses, routes4, routes6) = self.context.ip_json('address show',
+                                                             'route show table all root 0.0.0.0/0',
+                                                             'route show table all root ::/0')
+        dump = {'links': [], 'addresses': [], 'routes': []}
+        for link in addresses:
+            dump['links'].append({'name': link['ifname'], 'index': link['ifindex'],
+                                  'up': 'UP' in link.get('flags', [])})
+            for address in link.get('addr_info', []):
+                dump['addresses'].append((link['ifname'], "%s/%s" % (address['local'], address['prefixlen'])))
+        for (ipversion, routes) in [('4', routes4), ('6', routes6)]:
+            for route in routes:
+                nexthops = route.get('nexthops', [route])
+                dump['routes'].append({'destination': route['dst'], 'family': ipversion,
+                                       'table': route.get('table', 'main'),
+                                       'protocol': route.get('protocol', 'boot'),
+                                       'nexthops': [{'via': x['gateway']} for x in nexthops if 'gateway' in x]})
+        return dump
+
+    def link_stats(self):
+        """
+        Return {link name: tuple of counters in LINK_STATS order} of every link, read from
+        /proc/net/dev of this thread entered to the namespace without starting a process
+        """
+        with netns_entered(self.context.namespace):
+            with open('/proc/thread-self/net/dev', 'r') as f:
+                lines = f.readlines()[2:]
+        stats = {}
+        for line in lines:
+            (name, values) = line.split(':', 1)
+            # Receive bytes, packets, errs, drop, fifo, frame, compressed, multicast, then transmit the same
+            values = [int(x) for x in values.split()]
+            stats[name.strip()] = tuple(values[0:4] + values[8:12])
+        return stats
+
+    def link_list(self):
+        links = []
+        for line in self.context.run(IPCOMMAND, '-o', 'link', 'show').splitlines():
+            links.append(line.split(':')[1].strip().split('@')[0])
+        return links
+
+    def addr_list(self, name, ipversion='4'):
+        addresses = []
+        prefix = 'inet ' if ipversion == '4' else 'inet6 '
+        for line in self.context.run(IPCOMMAND, '-%s' % ipversion, 'addr', 'show', 'dev', name).splitlines():
+            line = line.strip()
+            if line.startswith(prefix):
+                addresses.append(line.split()[1].strip())
+        return addresses
+
+    def addr_add(self, name, address, ipversion='4'):
+        if ipversion == '4':
+            self.context.ip('address', 'add', address, 'dev', name)
+        else:
+            self.context.ip('-6', 'address', 'add', address, 'dev', name)
+
+    def addr_del(self, name, address, ipversion='4'):
+        if ipversion == '4':
+            self.context.ip('address', 'delete', address, 'dev', name)
+        else:
+            self.context.ip('-6', 'address', 'delete', address, 'dev', name)
+
+    def route_list(self, ipversion='4'):
+        return [x.split()[0] for x in self.context.run(IPCOMMAND, '-%s' % ipversion, 'route', 'list').splitlines()]
+
+    def route_add(self, destination, nexthops, ipversion='4'):
+        """
+        Add route to destination via list of nexthops, more than one nexthop creates ECMP route
+        """
+        if len(nexthops) == 1 and list(nexthops[0].keys()) == ['via']:
+            self.context.ip('route', 'add', destination, 'via', nexthops[0]['via'])
+            return
+        cmd = []
+        for nexthop in nexthops:
+            cmd += ['nexthop', 'via', nexthop['via']]
+            if 'weight' in nexthop:
+                cmd += ['weight', str(nexthop['weight'])]
+            if 'interface' in nexthop:
+                cmd += ['interface', str(nexthop['interface'])]
+        self.context.ip('-%s' % ipversion, 'route', 'add', destination, *cmd)
+
+    def route_del(self, destination, nexthop=None, ipversion='4'):
+        if nexthop:
+            self.context.ip('route', 'delete', destination, 'via', nexthop)
+        else:
+            self.context.ip('route', 'delete', destination)
+
+    def netns_list(self):
+        return [x.split()[0] for x in self.context.run(IPCOMMAND, 'netns', 'list').splitlines() if x.strip()]
+
+    def netns_add(self, name):
+        if POOL is not None and POOL.acquire(name):
+            return
+        self.context.ip('netns', 'add', name)
+
+    def netns_del(self, name):
+        if 'nsworker' in sys.modules:
+            # Worker would keep the namespace alive
+            sys.modules['nsworker'].stop_worker(name)
+        if POOL is None or not POOL.release(name):
+            self.context.ip('netns', 'delete', name)
+        invalidate_state(name)
+
 
 class Interface(object):
     def __init__(self, context, name):
@@ -57,63 +606,75 @@ class Interface(object):
         self.addresses6 = []
 
     def up(self):
-        self.context.run(IPCOMMAND, 'link', 'set', self.name, 'up')
+        self.context.backend.link_set(self.name, up=True)
 
     def down(self):
-        self.context.run(IPCOMMAND, 'link', 'set', self.name, 'down')
+        self.context.backend.link_set(self.name, up=False)
+
+    def delete(self):
+        """
+        Delete interface, deleting one end of veth deletes also the other end
+        """
+        self.context.backend.link_del(self.name)
+        get_state(self.context.namespace).remove_link(self.name)
+
+    def stats(self):
+        """
+        Return dict of counters in LINK_STATS, None if interface does not exist
+        """
+        counters = self.context.backend.link_stats().get(self.name)
+        return dict(zip(LINK_STATS, counters)) if counters is not None else None
 
     def _get_addresses(self):
-        self.addresses = []
-        for line in self.context.run(IPCOMMAND, '-4', 'addr', 'show', 'dev', self.name).splitlines():
-            line = line.strip()
-            if line.startswith('inet '):
-                self.addresses.append(line.split()[1].strip())
+        self.addresses = self.context.state.get_addresses(self.name, ipversion='4')
 
     def _get_addresses6(self):
-        self.addresses6 = []
-        for line in self.context.run(IPCOMMAND, '-6', 'addr', 'show', 'dev', self.name).splitlines():
-            line = line.strip()
-            if line.startswith('inet6 '):
-                self.addresses6.append(line.split()[1].strip())
+        self.addresses6 = self.context.state.get_addresses(self.name, ipversion='6')
+
+    def _add_address(self, address, ipversion):
+        state = self.context.state
+        if not state.has_address(self.name, address):
+            self.context.backend.addr_add(self.name, address, ipversion=ipversion)
+            state.add_address(self.name, address)
+
+    def _delete_address(self, address, ipversion):
+        state = self.context.state
+        if state.has_address(self.name, address):
+            self.context.backend.addr_del(self.name, address, ipversion=ipversion)
+            state.remove_address(self.name, address)
 
     def add_address(self, address):
+        self._add_address(address, '4')
         self._get_addresses()
-        if address not in self.addresses:
-            self.context.run(IPCOMMAND, 'address', 'add', address, 'dev', self.name)
-            self.addresses.append(address)
 
     def delete_address(self, address):
+        self._delete_address(address, '4')
         self._get_addresses()
-        if address in self.addresses:
-            self.context.run(IPCOMMAND, 'address', 'delete', address, 'dev', self.name)
-            self.addresses.pop(self.addresses.index(address))
 
     def add_address6(self, address):
+        self._add_address(address, '6')
         self._get_addresses6()
-        if address not in self.addresses6:
-            self.context.run(IPCOMMAND, '-6', 'address', 'add', address, 'dev', self.name)
-            self.addresses6.append(address)
 
     def delete_address6(self, address):
+        self._delete_address(address, '6')
         self._get_addresses6()
-        if address in self.addresses6:
-            self.context.run(IPCOMMAND, '-6', 'address', 'delete', address, 'dev', self.name)
-            self.addresses6.pop(self.addresses6.index(address))
 
 
 class IP(object):
-    def __init__(self, namespace=None):
+    def __init__(self, namespace=None, batch=None):
         self.namespace = namespace
-        self.context = IPContext(namespace=self.namespace)
+        self.context = IPContext(namespace=self.namespace, batch=batch)
 
     def _route(self, destination, nexthop, state="exists", ipversion='4'):
-        routes = [x.split()[0] for x in self.context.run(IPCOMMAND, '-%s' % ipversion, 'route', 'list').splitlines()]
+        routes = self.context.state
         if state == "exists":
-            if destination not in routes:
-                self.context.run(IPCOMMAND, 'route', 'add', destination, 'via', nexthop)
+            if not routes.has_route(destination, ipversion):
+                self.context.backend.route_add(destination, [{'via': nexthop}], ipversion=ipversion)
+                routes.add_route(destination, [{'via': nexthop}], ipversion)
         elif state == "absent":
-            if destination in routes:
-                self.context.run(IPCOMMAND, 'route', 'delete', destination, 'via', nexthop)
+            if routes.has_route(destination, ipversion):
+                self.context.backend.route_del(destination, nexthop, ipversion=ipversion)
+                routes.remove_route(destination, ipversion)
 
     def route(self, destination, nexthop, state="exists"):
         return self._route(destination, nexthop, state, ipversion='4')
@@ -122,20 +683,15 @@ class IP(object):
         return self._route(destination, nexthop, state, ipversion='6')
 
     def _ecmp_route(self, destination, nexthops, state="exists", ipversion='4'):
-        routes = [x.split()[0] for x in self.context.run(IPCOMMAND, '-%s' % ipversion, 'route', 'list').splitlines()]
+        routes = self.context.state
         if state == "exists":
-            if destination not in routes:
-                cmd = []
-                for nexthop in nexthops:
-                    cmd += ['nexthop', 'via', nexthop['via']]
-                    if 'weight' in nexthop:
-                        cmd += ['weight', str(nexthop['weight'])]
-                    if 'interface' in nexthop:
-                        cmd += ['interface', str(nexthop['interface'])]
-                self.context.run(IPCOMMAND, '-%s' % ipversion, 'route', 'add', destination, *cmd)
+            if not routes.has_route(destination, ipversion):
+                self.context.backend.route_add(destination, nexthops, ipversion=ipversion)
+                routes.add_route(destination, nexthops, ipversion)
         elif state == "absent":
-            if destination in routes:
-                self.context.run(IPCOMMAND, 'route', 'delete', destination)
+            if routes.has_route(destination, ipversion):
+                self.context.backend.route_del(destination, ipversion=ipversion)
+                routes.remove_route(destination, ipversion)
 
     def ecmp_route(self, destination, nexthops, state="exists"):
         return self._ecmp_route(destination, nexthops, state=state, ipversion='4')
@@ -144,23 +700,19 @@ class IP(object):
         return self._ecmp_route(destination, nexthops, state=state, ipversion='6')
 
     def netns_list(self):
-        return [x.strip() for x in self.context.run(IPCOMMAND, 'netns', 'list').splitlines()]
+        return self.context.backend.netns_list()
 
     def netns_add(self, name):
         if not name:
             raise IPException("Invalid empty namespace name")
         if name not in self.netns_list():
-            self.context.run(IPCOMMAND, 'netns', 'add', name)
-            self.context.run(SYSCTLCOMMAND, '-w', 'net.ipv4.ip_forward=1')
-            self.context.run(SYSCTLCOMMAND, '-w', 'net.ipv4.conf.all.forwarding=1')
-            self.context.run(SYSCTLCOMMAND, '-w', 'net.ipv6.conf.all.forwarding=1')
-
+            self.context.backend.netns_add(name)
 
     def netns_del(self, name):
         if not name:
             raise IPException("Invalid empty namespace name")
         if name in self.netns_list():
-            self.context.run(IPCOMMAND, 'netns', 'delete', name)
+            self.context.backend.netns_del(name)
 
     def netns(self, name=None):
         if self.namespace:
@@ -169,7 +721,7 @@ class IP(object):
             name = random_string(prefix="ns_", length=13)
         if name != 'global':
             self.netns_add(name)
-        return NetNS(name)
+        return NetNS(name, batch=self.context.batch)
 
     def interface(self, name):
         return Interface(self.context, name)
@@ -180,20 +732,26 @@ class IP(object):
         :param other: Another namespace where other end of veth is located
         :return: Tuple containing two interfaces
         """
-        other_name = other.name
-        if other_name == "global":
-            other_name = "1"
-        self.context.run(IPCOMMAND, 'link', 'add', my_interface, 'type', 'veth', 'peer', 'name', peer_interface)
-        self.context.run(IPCOMMAND  , 'link', 'set', peer_interface, 'netns', other_name)
+        self.context.backend.link_add_veth(my_interface, peer_interface)
+        self.context.backend.link_set_netns(peer_interface, other.ip.namespace)
+        get_state(self.namespace).add_link(my_interface)
+        get_state(other.ip.namespace).add_link(peer_interface)
         return self.interface(my_interface), other.ip.interface(peer_interface)
 
 ip = IP()
 
 class NetNS(object):
-    def __init__(self, name):
+    def __init__(self, name, batch=None):
         self.name = name
         if name == "global":
             nsname = None
         else:
             nsname = name
-        self.ip = IP(namespace=nsname)
+        self.ip = IP(namespace=nsname, batch=batch)
+
+    def stats(self):
+        """
+        Return {interface: dict of counters in LINK_STATS} of every interface in namespace
+        """
+        return dict([(name, dict(zip(LINK_STATS, counters)))
+                     for (name, counters) in self.ip.context.backend.link_stats().items()])
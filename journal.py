@@ -0,0 +1,183 @@
+"""
+Append-only journal of resources created from a config.
+
+Every namespace, veth pair, global namespace route and address, started
+process and rendered file is appended to the journal as one JSON line as soon
+as it exists, together with names of completed create steps. An interrupted
+create resumes from the steps not yet completed, and destroy removes exactly
+the journaled resources.
+
+Journal of a config is kept in /run/nscommander/<sha256 of config file>/journal,
+journal of an instance of it in /run/nscommander/<sha256 of config file>-<instance>/journal.
+Path of the config file is kept next to the journal, so a journal written for
+earlier content of the same file is moved over when the file has been edited.
+
+A finished create is journaled too. Steps completed before it are not skipped
+by the next create, and destroy trusts the journal alone only after it.
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+from ip import logger
+
+JOURNAL_DIR = '/run/nscommander'
+
+# File next to journal naming config file and instance journal was written for
+SOURCE_FILE = 'source'
+
+
+def config_key(path, instance=None):
+    with open(path, 'rb') as f:
+        key = hashlib.sha256(f.read()).hexdigest()
+    return key if instance is None else "%s-%s" % (key, instance)
+
+
+class Journal(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.path = None
+        self.source = None
+        self.fd = None
+        self.entries = []
+
+    @property
+    def enabled(self):
+        return self.fd is not None
+
+    def open(self, key, source=None):
+        """
+        Open journal of config key, reading entries journaled earlier
+        :param source: (config file path, instance), journals of earlier content of it are moved to key
+        """
+        self.close()
+        self.source = source
+        directory = os.path.join(JOURNAL_DIR, key)
+        if source is not None:
+            source = json.dumps([os.path.abspath(source[0]), source[1]])
+            for earlier in self._journals_of(source):
+                if earlier != directory:
+                    logger.debug("Moving journal %s of earlier config to %s" % (earlier, directory))
+                    _move(earlier, directory)
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        if source is not None:
+            with open(os.path.join(directory, SOURCE_FILE), 'w') as f:
+                f.write(source)
+        self.path = os.path.join(directory, 'journal')
+        self.entries = []
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    try:
+                        self.entries.append(json.loads(line.decode("utf-8")))
+                    except ValueError:
+                        # Last line is partial if we crashed while writing it
+                        logger.debug("Ignoring broken journal line %r" % line)
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+
+    @staticmethod
+    def _journals_of(source):
+        try:
+            names = os.listdir(JOURNAL_DIR)
+        except FileNotFoundError:
+            return []
+        journals = []
+        for name in names:
+            try:
+                with open(os.path.join(JOURNAL_DIR, name, SOURCE_FILE), 'r') as f:
+                    if f.read() == source:
+                        journals.append(os.path.join(JOURNAL_DIR, name))
+            except OSError:
+                continue
+        return journals
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def rename(self, key):
+        """
+        Move journal to new config key, done when config file changes while journal is open
+        """
+        directory = os.path.join(JOURNAL_DIR, key)
+        if self.path is None or os.path.dirname(self.path) == directory:
+            return
+        with self.lock:
+            self.close()
+            _move(os.path.dirname(self.path), directory)
+        self.open(key, self.source)
+
+    def record(self, kind, **values):
+        """
+        Append entry to journal, does nothing unless journal is open
+        """
+        if self.fd is None:
+            return
+        values['kind'] = kind
+        line = (json.dumps(values, sort_keys=True) + '\n').encode("utf-8")
+        with self.lock:
+            os.write(self.fd, line)
+            os.fsync(self.fd)
+            self.entries.append(values)
+
+    def of(self, kind):
+        return [x for x in self.entries if x['kind'] == kind]
+
+    def created(self):
+        """
+        Return True if a create finished since journal was started
+        """
+        return bool(self.of('created'))
+
+    def completed_steps(self):
+        """
+        Return steps completed by an unfinished create, those of finished creates are done again
+        """
+        steps = set()
+        for entry in self.entries:
+            if entry['kind'] == 'created':
+                steps = set()
+            elif entry['kind'] == 'step':
+                steps.add(entry['name'])
+        return steps
+
+    def remove(self):
+        """
+        Close and delete journal, done after every journaled resource is removed
+        """
+        if self.path is None:
+            return
+        self.close()
+        _remove_directory(os.path.dirname(self.path))
+        self.entries = []
+
+
+def _remove_directory(directory):
+    try:
+        for name in os.listdir(directory):
+            os.unlink(os.path.join(directory, name))
+        os.rmdir(directory)
+    except OSError:
+        pass
+
+
+def _move(old_directory, directory):
+    """
+    Append entries of journal in old directory to journal in directory and remove old directory
+    """
+    old = os.path.join(old_directory, 'journal')
+    if os.path.exists(old):
+        with open(old, 'rb') as f:
+            data = f.read()
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        with open(os.path.join(directory, 'journal'), 'ab') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+    _remove_directory(old_directory)
+
+
+journal = Journal()
@@ -0,0 +1,425 @@
+"""
+Native rtnetlink backend.
+
+Talks to the kernel over AF_NETLINK sockets opened inside each namespace
+instead of running /bin/ip for every operation.
+"""
+
+import errno
+import ipaddress
+import os
+import socket
+import struct
+import threading
+import time
+
+from ip import CommandBackend, IPException, NETNS_RUN_DIR, TABLE_NAMES, netns_entered, netns_path
+from profiling import profiler
+
+
+NETLINK_ROUTE = 0
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_GETLINK = 18
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RTM_GETROUTE = 26
+
+NLM_F_REQUEST = 0x1
+NLM_F_MULTI = 0x2
+NLM_F_ACK = 0x4
+NLM_F_DUMP = 0x300
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+
+IFLA_ADDRESS = 1
+IFLA_IFNAME = 3
+IFLA_MTU = 4
+IFLA_LINK = 5
+IFLA_STATS64 = 23
+IFLA_LINKINFO = 18
+IFLA_NET_NS_PID = 19
+IFLA_NET_NS_FD = 28
+IFLA_INFO_KIND = 1
+IFLA_INFO_DATA = 2
+VETH_INFO_PEER = 1
+
+IFF_UP = 0x1
+
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+
+RTA_DST = 1
+RTA_OIF = 4
+RTA_GATEWAY = 5
+RTA_PRIORITY = 6
+RTA_MULTIPATH = 9
+RTA_TABLE = 15
+
+RT_TABLE_MAIN = 254
+RTPROT_KERNEL = 2
+RTPROT_BOOT = 3
+RT_SCOPE_UNIVERSE = 0
+RT_SCOPE_NOWHERE = 255
+RTN_UNICAST = 1
+
+NLA_F_NESTED = 0x8000
+NLA_TYPE_MASK = 0x3fff
+
+FAMILIES = {'4': socket.AF_INET, '6': socket.AF_INET6}
+
+NLMSGHDR = struct.Struct("=IHHII")
+IFINFOMSG = struct.Struct("=BxHiII")
+IFADDRMSG = struct.Struct("=BBBBI")
+RTMSG = struct.Struct("=BBBBBBBBI")
+RTATTR = struct.Struct("=HH")
+RTNEXTHOP = struct.Struct("=HBBi")
+
+
+def _align(length):
+    return (length + 3) & ~3
+
+
+def attr(attr_type, data):
+    if isinstance(data, str):
+        data = data.encode("utf-8") + b'\0'
+    length = RTATTR.size + len(data)
+    return RTATTR.pack(length, attr_type) + data + b'\0' * (_align(length) - length)
+
+
+def parse_attrs(data, offset=0):
+    attrs = {}
+    while offset + RTATTR.size <= len(data):
+        (length, attr_type) = RTATTR.unpack_from(data, offset)
+        if length < RTATTR.size:
+            break
+        attrs[attr_type & NLA_TYPE_MASK] = data[offset + RTATTR.size:offset + length]
+        offset += _align(length)
+    return attrs
+
+
+def _string(data):
+    return data.split(b'\0', 1)[0].decode("utf-8")
+
+
+def _address(family, data):
+    return str(ipaddress.ip_address(data)) if family in FAMILIES.values() else data.hex()
+
+
+class NetlinkSocket(object):
+    """
+    rtnetlink socket bound to one network namespace
+    """
+    def __init__(self, namespace=None, groups=0):
+        self.namespace = namespace
+        with netns_entered(namespace):
+            self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW | socket.SOCK_CLOEXEC, NETLINK_ROUTE)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        self.sock.bind((0, groups))
+        self.seq = 0
+        self.lock = threading.Lock()
+
+    def close(self):
+        self.sock.close()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def receive(self):
+        """
+        Read one datagram and return list of (type, flags, seq, payload)
+        """
+        data = self.sock.recv(1 << 18)
+        messages = []
+        offset = 0
+        while offset + NLMSGHDR.size <= len(data):
+            (length, msg_type, flags, seq, _) = NLMSGHDR.unpack_from(data, offset)
+            if length < NLMSGHDR.size:
+                break
+            messages.append((msg_type, flags, seq, data[offset + NLMSGHDR.size:offset + length]))
+            offset += _align(length)
+        return messages
+
+    def request(self, msg_type, flags, payload, description=None):
+        """
+        Send request and return payloads of all replies.
+        :raises IPException: if kernel returns an error
+        """
+        start = time.monotonic()
+        status = 0
+        try:
+            return self._request(msg_type, flags, payload, description)
+        except IPException:
+            status = 1
+            raise
+        finally:
+            profiler.record('netlink', description or "netlink request %d" % msg_type, self.namespace, start,
+                            status)
+
+    def _request(self, msg_type, flags, payload, description):
+        with self.lock:
+            self.seq += 1
+            seq = self.seq
+            flags |= NLM_F_REQUEST
+            if not flags & NLM_F_DUMP == NLM_F_DUMP:
+                flags |= NLM_F_ACK
+            self.sock.send(NLMSGHDR.pack(NLMSGHDR.size + len(payload), msg_type, flags, seq, 0) + payload)
+            replies = []
+            while True:
+                for (reply_type, reply_flags, reply_seq, data) in self.receive():
+                    if reply_seq != seq:
+                        continue
+                    if reply_type == NLMSG_DONE:
+                        return replies
+                    if reply_type == NLMSG_ERROR:
+                        error = -struct.unpack_from("=i", data)[0]
+                        if error:
+                            raise IPException("%s failed in namespace %s: %s" % (
+                                description or "netlink request %d" % msg_type,
+                                self.namespace or 'global', os.strerror(error)))
+                        return replies
+                    replies.append((reply_type, data))
+
+
+_sockets = {}
+_sockets_lock = threading.Lock()
+
+
+def get_socket(namespace):
+    """
+    Return cached socket for namespace, namespaces recreated with the same name get a new socket
+    """
+    key = namespace
+    inode = os.stat(netns_path(namespace)).st_ino if namespace else None
+    with _sockets_lock:
+        if key in _sockets and _sockets[key][0] == inode:
+            return _sockets[key][1]
+        if key in _sockets:
+            _sockets[key][1].close()
+        sock = NetlinkSocket(namespace)
+        _sockets[key] = (inode, sock)
+        return sock
+
+
+def drop_socket(namespace):
+    with _sockets_lock:
+        if namespace in _sockets:
+            _sockets.pop(namespace)[1].close()
+
+
+def _parse_link(data):
+    (_, _, index, flags, _) = IFINFOMSG.unpack_from(data)
+    attrs = parse_attrs(data, IFINFOMSG.size)
+    link = {'index': index, 'flags': flags, 'up': bool(flags & IFF_UP),
+            'name': _string(attrs.get(IFLA_IFNAME, b''))}
+    if IFLA_MTU in attrs:
+        link['mtu'] = struct.unpack("=I", attrs[IFLA_MTU])[0]
+    if IFLA_ADDRESS in attrs:
+        link['address'] = ':'.join(["%02x" % x for x in attrs[IFLA_ADDRESS]])
+    if IFLA_STATS64 in attrs:
+        link['stats64'] = struct.unpack_from("=8Q", attrs[IFLA_STATS64])
+    return link
+
+
+def _parse_addr(data):
+    (family, prefixlen, _, scope, index) = IFADDRMSG.unpack_from(data)
+    attrs = parse_attrs(data, IFADDRMSG.size)
+    raw = attrs.get(IFA_LOCAL, attrs.get(IFA_ADDRESS))
+    return {'family': family, 'index': index, 'scope': scope,
+            'address': "%s/%d" % (_address(family, raw), prefixlen)}
+
+
+def _parse_route(data):
+    (family, dst_len, _, _, table, protocol, scope, route_type, _) = RTMSG.unpack_from(data)
+    attrs = parse_attrs(data, RTMSG.size)
+    if RTA_TABLE in attrs:
+        table = struct.unpack("=I", attrs[RTA_TABLE])[0]
+    if RTA_DST in attrs:
+        destination = _address(family, attrs[RTA_DST])
+        if dst_len != len(attrs[RTA_DST]) * 8:
+            destination = "%s/%d" % (destination, dst_len)
+    else:
+        destination = "default"
+    route = {'family': family, 'destination': destination, 'table': table, 'protocol': protocol,
+             'scope': scope, 'type': route_type, 'nexthops': []}
+    if RTA_GATEWAY in attrs or RTA_OIF in attrs:
+        nexthop = {}
+        if RTA_GATEWAY in attrs:
+            nexthop['via'] = _address(family, attrs[RTA_GATEWAY])
+        if RTA_OIF in attrs:
+            nexthop['oif'] = struct.unpack("=i", attrs[RTA_OIF])[0]
+        route['nexthops'].append(nexthop)
+    if RTA_MULTIPATH in attrs:
+        multipath = attrs[RTA_MULTIPATH]
+        offset = 0
+        while offset + RTNEXTHOP.size <= len(multipath):
+            (length, _, hops, ifindex) = RTNEXTHOP.unpack_from(multipath, offset)
+            if length < RTNEXTHOP.size:
+                break
+            nexthop_attrs = parse_attrs(multipath[offset:offset + length], RTNEXTHOP.size)
+            nexthop = {'weight': hops + 1, 'oif': ifindex}
+            if RTA_GATEWAY in nexthop_attrs:
+                nexthop['via'] = _address(family, nexthop_attrs[RTA_GATEWAY])
+            route['nexthops'].append(nexthop)
+            offset += _align(length)
+    return route
+
+
+class NetlinkBackend(CommandBackend):
+    """
+    Backend speaking rtnetlink directly, namespace management falls back to /bin/ip
+    """
+    @property
+    def socket(self):
+        return get_socket(self.context.namespace)
+
+    def _describe(self, description):
+        if self.context.batch is not None and self.context.batch.tag:
+            return "%s: %s" % (self.context.batch.tag, description)
+        return description
+
+    def link_index(self, name):
+        payload = IFINFOMSG.pack(0, 0, 0, 0, 0) + attr(IFLA_IFNAME, name)
+        replies = self.socket.request(RTM_GETLINK, 0, payload, self._describe("get link %s" % name))
+        return _parse_link(replies[0][1])['index']
+
+    def link_add_veth(self, name, peer):
+        peer_info = IFINFOMSG.pack(0, 0, 0, 0, 0) + attr(IFLA_IFNAME, peer)
+        linkinfo = attr(IFLA_INFO_KIND, b'veth') + attr(IFLA_INFO_DATA | NLA_F_NESTED, attr(VETH_INFO_PEER, peer_info))
+        payload = IFINFOMSG.pack(0, 0, 0, 0, 0) + attr(IFLA_IFNAME, name) + attr(IFLA_LINKINFO | NLA_F_NESTED, linkinfo)
+        self.socket.request(RTM_NEWLINK, NLM_F_CREATE | NLM_F_EXCL, payload,
+                            self._describe("add veth %s peer %s" % (name, peer)))
+
+    def link_set_netns(self, name, netns):
+        if netns:
+            fd = os.open(netns_path(netns), os.O_RDONLY)
+            try:
+                payload = IFINFOMSG.pack(0, 0, 0, 0, 0) + attr(IFLA_IFNAME, name) + \
+                    attr(IFLA_NET_NS_FD, struct.pack("=I", fd))
+                self.socket.request(RTM_NEWLINK, 0, payload, self._describe("move %s to %s" % (name, netns)))
+            finally:
+                os.close(fd)
+        else:
+            payload = IFINFOMSG.pack(0, 0, 0, 0, 0) + attr(IFLA_IFNAME, name) + \
+                attr(IFLA_NET_NS_PID, struct.pack("=I", 1))
+            self.socket.request(RTM_NEWLINK, 0, payload, self._describe("move %s to global" % name))
+
+    def link_set(self, name, up=True):
+        payload = IFINFOMSG.pack(0, 0, 0, IFF_UP if up else 0, IFF_UP) + attr(IFLA_IFNAME, name)
+        self.socket.request(RTM_NEWLINK, 0, payload,
+                            self._describe("set %s %s" % (name, 'up' if up else 'down')))
+
+    def link_del(self, name):
+        payload = IFINFOMSG.pack(0, 0, 0, 0, 0) + attr(IFLA_IFNAME, name)
+        self.socket.request(RTM_DELLINK, 0, payload, self._describe("delete link %s" % name))
+
+    def link_dump(self):
+        replies = self.socket.request(RTM_GETLINK, NLM_F_DUMP, IFINFOMSG.pack(0, 0, 0, 0, 0))
+        return [_parse_link(data) for (msg_type, data) in replies if msg_type == RTM_NEWLINK]
+
+    def link_list(self):
+        return [link['name'] for link in self.link_dump()]
+
+    def dump(self):
+        links = self.link_dump()
+        names = dict([(x['index'], x['name']) for x in links])
+        versions = dict([(v, k) for (k, v) in FAMILIES.items()])
+        routes = []
+        for route in self.route_dump():
+            if route['family'] not in versions:
+                continue
+            route['family'] = versions[route['family']]
+            route['table'] = TABLE_NAMES.get(route['table'], route['table'])
+            route['protocol'] = {RTPROT_KERNEL: 'kernel', RTPROT_BOOT: 'boot'}.get(route['protocol'],
+                                                                                   str(route['protocol']))
+            route['nexthops'] = [{'via': x['via']} for x in route['nexthops'] if 'via' in x]
+            routes.append(route)
+        return {'links': links,
+                'addresses': [(names.get(x['index']), x['address']) for x in self.addr_dump()],
+                'routes': routes}
+
+    def addr_dump(self, ipversion=None):
+        family = FAMILIES[ipversion] if ipversion else socket.AF_UNSPEC
+        replies = self.socket.request(RTM_GETADDR, NLM_F_DUMP, IFADDRMSG.pack(family, 0, 0, 0, 0))
+        return [_parse_addr(data) for (msg_type, data) in replies if msg_type == RTM_NEWADDR]
+
+    def addr_list(self, name, ipversion='4'):
+        index = self.link_index(name)
+        return [x['address'] for x in self.addr_dump(ipversion) if x['index'] == index]
+
+    def _addr(self, msg_type, flags, name, address, ipversion, description):
+        interface = ipaddress.ip_interface(address)
+        family = FAMILIES[str(interface.version)]
+        payload = IFADDRMSG.pack(family, interface.network.prefixlen, 0, RT_SCOPE_UNIVERSE, self.link_index(name))
+        payload += attr(IFA_ADDRESS, interface.ip.packed)
+        if family == socket.AF_INET:
+            payload += attr(IFA_LOCAL, interface.ip.packed)
+        self.socket.request(msg_type, flags, payload, self._describe(description))
+
+    def addr_add(self, name, address, ipversion='4'):
+        self._addr(RTM_NEWADDR, NLM_F_CREATE | NLM_F_EXCL, name, address, ipversion,
+                   "add address %s to %s" % (address, name))
+
+    def addr_del(self, name, address, ipversion='4'):
+        self._addr(RTM_DELADDR, 0, name, address, ipversion, "delete address %s from %s" % (address, name))
+
+    def route_dump(self, ipversion=None):
+        family = FAMILIES[ipversion] if ipversion else socket.AF_UNSPEC
+        replies = self.socket.request(RTM_GETROUTE, NLM_F_DUMP, RTMSG.pack(family, 0, 0, 0, 0, 0, 0, 0, 0))
+        return [_parse_route(data) for (msg_type, data) in replies if msg_type == RTM_NEWROUTE]
+
+    def route_list(self, ipversion='4'):
+        return [x['destination'] for x in self.route_dump(ipversion) if x['table'] == RT_TABLE_MAIN]
+
+    def _route_message(self, destination, ipversion, scope, route_type):
+        family = FAMILIES[ipversion]
+        if destination == 'default':
+            network = ipaddress.ip_network('0.0.0.0/0' if ipversion == '4' else '::/0')
+        else:
+            network = ipaddress.ip_network(destination, strict=False)
+        payload = RTMSG.pack(family, network.prefixlen, 0, 0, RT_TABLE_MAIN, RTPROT_BOOT, scope, route_type, 0)
+        if network.prefixlen:
+            payload += attr(RTA_DST, network.network_address.packed)
+        return payload
+
+    def route_add(self, destination, nexthops, ipversion='4'):
+        payload = self._route_message(destination, ipversion, RT_SCOPE_UNIVERSE, RTN_UNICAST)
+        if len(nexthops) == 1 and 'weight' not in nexthops[0]:
+            payload += attr(RTA_GATEWAY, ipaddress.ip_address(nexthops[0]['via']).packed)
+            if 'interface' in nexthops[0]:
+                payload += attr(RTA_OIF, struct.pack("=i", self.link_index(nexthops[0]['interface'])))
+        else:
+            multipath = b''
+            for nexthop in nexthops:
+                gateway = attr(RTA_GATEWAY, ipaddress.ip_address(nexthop['via']).packed)
+                ifindex = self.link_index(nexthop['interface']) if 'interface' in nexthop else 0
+                multipath += RTNEXTHOP.pack(RTNEXTHOP.size + len(gateway), 0,
+                                            int(nexthop.get('weight', 1)) - 1, ifindex) + gateway
+            payload += attr(RTA_MULTIPATH, multipath)
+        self.socket.request(RTM_NEWROUTE, NLM_F_CREATE | NLM_F_EXCL, payload,
+                            self._describe("add route %s" % destination))
+
+    def route_del(self, destination, nexthop=None, ipversion='4'):
+        payload = self._route_message(destination, ipversion, RT_SCOPE_NOWHERE, 0)
+        if nexthop:
+            payload += attr(RTA_GATEWAY, ipaddress.ip_address(nexthop).packed)
+        self.socket.request(RTM_DELROUTE, 0, payload, self._describe("delete route %s" % destination))
+
+    def netns_list(self):
+        try:
+            return sorted(os.listdir(NETNS_RUN_DIR))
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return []
+            raise
+
+    def netns_del(self, name):
+        drop_socket(name)
+        super(NetlinkBackend, self).netns_del(name)
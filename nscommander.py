@@ -9,18 +9,56 @@ Generates namespaces defined in configuration file.
 """
 
 
-import subprocess
-import string
-import random
 import sys
 import os
-import yaml
+import json
 import logging
 import time
+import functools
+import hashlib
+import re
+import ipaddress
+import tempfile
+import contextlib
+import signal
+import concurrent.futures
 
-from ip import random_string, ip, IPCOMMAND, KILLCOMMAND, SYSCTLCOMMAND, logger
+from ip import ip, IP, IPBatch, NetNS, set_backend, set_exec_mode, set_pool, invalidate_state, invalidate_states, IPException, NETNS_RUN_DIR, logger
 
-from templating import expand_string
+from templating import expand_string, cache_info
+from scheduler import Scheduler
+from processes import netns_pids, start_time, terminate
+from journal import config_key, journal
+import supervisor
+import sysctl
+from sysctl import forwarding_defaults
+from nsworker import stop_workers
+from reconcile import plan_config, apply_changes, peer_namespaces
+from profiling import profiler
+import plan
+import stats
+from pool import Pool
+
+
+UMASK = os.umask(0o022)
+os.umask(UMASK)
+
+
+# Bumped whenever normalize_config output changes, invalidates cached configs
+CONFIG_CACHE_VERSION = 6
+
+# Number of normalized configs kept in cache, least recently used are removed
+CONFIG_CACHE_ENTRIES = 64
+
+# Instance ids become part of namespace and file names, without - so that
+# instance and namespace name can not together collide with another instance
+INSTANCE_PATTERN = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_.]*$')
+
+# Longer veth name prefixes are shortened, prefix and -a or -b fit in 15 characters
+MAX_NAME_PREFIX = 13
+
+# Jinja expressions using names unique to an instance
+INSTANCE_EXPRESSION = re.compile(r'{{[^}]*\bnamespace\s*(\.\s*|\[\s*[\'"])(name|instance)\b')
 
 
 class ConfigException(Exception):
@@ -29,13 +67,56 @@ class ConfigException(Exception):
 
 def check_directory_for(f):
     destination_folder = os.path.dirname(f)
-        if not os.path.isdir(destination_folder):
-            raise ConfigException("Directory for file %s does not exist" % f)
+    if not os.path.isdir(destination_folder):
+        raise ConfigException("Directory for file %s does not exist" % f)
+
+
+def instance_name(name, instance):
+    """
+    Return actual name of namespace or file in instance, name itself without instance.
+    Global namespace of an instance is a namespace of its own.
+    """
+    if instance is None:
+        return name
+    return "%s-%s" % (instance, name)
+
 
+def instance_path(path, template, instance):
+    """
+    Return path of file in instance, instance is prefixed to file name
+    unless template of path already uses namespace.instance or the actual namespace.name
+    """
+    if instance is None or INSTANCE_EXPRESSION.search(template):
+        return path
+    (directory, name) = os.path.split(path)
+    return os.path.join(directory, instance_name(name, instance))
 
-def normalize_config(config):
+
+def short_name_prefix(prefix, instance=None):
+    """
+    Return name prefix short enough for interface names. Long prefixes are truncated, in an
+    instance they are shortened to their start and a hash of the whole prefix so they stay unique.
+    Without instance names stay those of earlier versions, so existing veths are still found.
+    """
+    if len(prefix) <= MAX_NAME_PREFIX:
+        return prefix
+    if instance is None:
+        return prefix[:MAX_NAME_PREFIX]
+    return "%s%s" % (prefix[:MAX_NAME_PREFIX - 8], hashlib.sha256(prefix.encode("utf-8")).hexdigest()[:8])
+
+
+def normalize_config(config, instance=None):
     if 'namespaces' not in config:
-        config['namespaces'] = []
+        config['namespaces'] = {}
+    if instance is not None and not INSTANCE_PATTERN.match(instance):
+        raise ConfigException("Invalid instance '%s', use letters, digits, _ and ." % instance)
+    namespaces = {}
+    for logical_name, namespace in config['namespaces'].items():
+        # Templates see both the name in config and the actual namespace name
+        namespace['logical_name'] = logical_name
+        namespace['instance'] = instance
+        namespaces[instance_name(logical_name, instance)] = namespace
+    config['namespaces'] = namespaces
     for name, namespace in config['namespaces'].items():
         for n in ['routes', 'routes6', 'interfaces', 'templates', 'run']:
             if n not in namespace:
@@ -89,54 +170,71 @@ def normalize_config(config):
                                                           namespace, this=route)
 
         # Handle interfaces
-        interfaces = []
-        for interface in namespace['interfaces']:
+        for index, interface in enumerate(namespace['interfaces']):
             if 'type' not in interface:
                 interface['type'] = "normal"
             if interface['type'] == 'veth':
+                if 'peer' in interface:
+                    interface['peer'] = instance_name(interface['peer'], instance)
                 if 'name_prefix' not in interface:
-                    interface['name_prefix'] = random_string("veth-", length=8)
+                    # Same name on every run, so interfaces of interrupted runs are found again
+                    interface['name_prefix'] = "veth-%s" % hashlib.sha256(("%s/%s/%d" % (
+                        name, interface.get('peer'), index)).encode("utf-8")).hexdigest()[:8]
                 else:
                     interface['name_prefix'] = expand_string(interface['name_prefix'],
                                                              namespace, this=interface)
-                # Truncate interface name, maximum interface name length is 16
-                interface['name_prefix'] = interface['name_prefix'][:13]
+                # Maximum interface name length is 15
+                interface['name_prefix'] = short_name_prefix(interface['name_prefix'], instance)
                 if 'my_interface' not in interface:
                     interface['my_interface'] = "%s-a" % interface['name_prefix']
                 else:
                     interface['my_interface'] = expand_string(interface['my_interface'],
                                                               namespace, this=interface)
                 if len(interface['my_interface']) >= 16:
-                    raise ConfigException("My interface name '%s' name too long in namespace '%s'" % (interface['my_interface']), name)
+                    raise ConfigException("My interface name '%s' name too long in namespace '%s'" % (interface['my_interface'], name))
                 if 'peer_interface' not in interface:
                     interface['peer_interface'] = "%s-b" % interface['name_prefix']
                 else:
                     interface['peer_interface'] = expand_string(interface['peer_interface'],
                                                                  namespace, this=interface)
                 if len(interface['peer_interface']) >= 16:
-                    raise ConfigException("Peer interface name '%s' name too long in namespace '%s'" % (interface['peer_interface']), name)
-                for interface_name in [interface['my_interface'], interface['peer_interface']]:
-                    if interface_name in interfaces:
-                        raise ConfigException("interface '%s' already defined in namespace '%s'" % (
-                                              interface_name, name,))
-                    interfaces.append(interface_name)
+                    raise ConfigException("Peer interface name '%s' name too long in namespace '%s'" % (interface['peer_interface'], name))
             elif interface['type'] == "normal":
                 if 'name' not in interface:
                     raise ConfigException("Name missing from inteface in namespace '%s'" % (name,))
-                interfaces.append(interface['name'])
             else:
                 raise ConfigException("Unknown interface type '%s'" % interface['type'])
 
         # Handle sysctl
         if type(namespace['sysctl']) != dict:
             raise ConfigException("Sysctl should be dict in namespace '%s'" % (name,))
+        if 'forwarding' not in namespace:
+            namespace['forwarding'] = True
+        namespace['forwarding'] = bool(namespace['forwarding'])
+        for key, value in forwarding_defaults(namespace['forwarding']).items():
+            if key not in namespace['sysctl']:
+                namespace['sysctl'][key] = value
+
+        # Handle templates, before run so run can refer to actual destinations
+        for template in namespace['templates']:
+            if 'source' not in template:
+                raise ConfigException("source missing from tempate in namespace '%s'" % (name,))
+            template['source'] = expand_string(template['source'], namespace,
+                                               this=template)
+            if 'destination' not in template:
+                raise ConfigException("destination missing from tempate in namespace '%s'" % (name,))
+            template['destination'] = instance_path(expand_string(template['destination'], namespace,
+                                                                  this=template),
+                                                    template['destination'], instance)
 
         # Handle run
-        for run in namespace['run']:
+        for index, run in enumerate(namespace['run']):
             if 'command' not in run:
                 raise ConfigException("Command missing from run in namespace '%s'" % (name,))
             else:
                 run['command'] = expand_string(run['command'], namespace, this=run)
+            if 'name' not in run:
+                run['name'] = "%s-%d" % (os.path.basename(run['command']), index)
             if 'args' not in run:
                 run['args'] = []
             args = []
@@ -149,149 +247,970 @@ def normalize_config(config):
             if 'output_file' not in run:
                 run['output_file'] = None
             elif run['output_file']:
-                run['output_file'] = expand_string(run['output_file'], namespace, this=run)
-            check_directory_for(run['output_file'])
+                run['output_file'] = instance_path(expand_string(run['output_file'], namespace, this=run),
+                                                   run['output_file'], instance)
+            run['output_max_bytes'] = int(run.get('output_max_bytes', 0))
+            run['output_backups'] = int(run.get('output_backups', 3))
+            # yaml reads bare no and yes as booleans
+            restart = run.get('restart', 'no')
+            run['restart'] = {False: 'no', True: 'always'}.get(restart, restart)
+            if run['restart'] not in ['no', 'on-failure', 'always']:
+                raise ConfigException("Unknown restart '%s' of run '%s' in namespace '%s'" % (
+                                      run['restart'], run['name'], name))
+            run['restart_delay'] = float(run.get('restart_delay', 1.0))
+            run['ready'] = run.get('ready') or None
+            run['ready_timeout'] = float(run.get('ready_timeout', 30.0))
+            if run['ready'] is not None:
+                if type(run['ready']) != dict or len([x for x in ['socket', 'port', 'log'] if x in run['ready']]) != 1:
+                    raise ConfigException("Ready of run '%s' in namespace '%s' should have one of socket, port "
+                                          "or log" % (run['name'], name))
+                if 'socket' in run['ready']:
+                    run['ready']['socket'] = expand_string(run['ready']['socket'], namespace, this=run)
+                if 'log' in run['ready'] and not run['output_file']:
+                    raise ConfigException("Ready log of run '%s' in namespace '%s' needs output_file" % (
+                                          run['name'], name))
+            if not run['background'] and (run['ready'] or run['restart'] != 'no' or run['output_max_bytes']):
+                raise ConfigException("Ready, restart and output_max_bytes of run '%s' in namespace '%s' need "
+                                      "background" % (run['name'], name))
 
-        # Handle templates
-        for template in namespace['templates']:
-            if 'source' not in template:
-                raise ConfigException("source missing from tempate in namespace '%s'" % (name,))
-            template['source'] = expand_string(template['source'], namespace,
-                                               this=template)
-            if 'destination' not in template:
-                raise ConfigException("destination missing from tempate in namespace '%s'" % (name,))
-            template['destination'] = expand_string(template['destination'], namespace,
-                                                    this=template)
+    check_directories(config)
+    validate_config(config)
     return config
 
 
-def parse_templates(namespace):
-    for template in namespace['templates']:
-        if not os.path.isfile(template['source']):
-            raise ConfigException("%s not such file or directory" % template['source'])
-        destination_folder = os.path.dirname(template['destination'])
-        if not os.path.isdir(destination_folder):
-            raise ConfigException("Destination folder %s is not a directory" % destination_folder)
-        logger.debug("Creating file %s from template %s" % (template['destination'], template['source']))
-        source_file = open(template['source'], 'rb')
-        destination_file = open(template['destination'], 'wb')
-
-        content = source_file.read().decode("utf-8")
-        source_file.close()
-        parsed = expand_string(content, namespace).encode("utf-8")
-        destination_file.write(parsed)
-        destination_file.write("\n".encode("utf-8"))
-        destination_file.flush()
-        destination_file.close()
-
-
-def create_from_config(config):
-    namespaces = {}
-    # Create all namespaces first
-    for namespace in config['namespaces'].keys():
-        namespaces[namespace] = ip.netns(namespace)
+def check_directories(config):
+    """
+    Check directories of output files exist, done for cached configs too
+    """
+    for namespace in config['namespaces'].values():
+        for run in namespace['run']:
+            if run['output_file']:
+                check_directory_for(run['output_file'])
 
-    # Create interfaces
-    for namespace, values in config['namespaces'].items():
-        ns = namespaces[namespace]
 
-        if 'interfaces' not in values:
-            values['interfaces'] = []
+class _Connected(object):
+    """
+    Index of connected networks of one namespace, looked up by prefix length
+    """
+    def __init__(self):
+        self.networks = []
+        self.by_length = {}
+
+    def add(self, interface, name):
+        network = interface.network
+        self.networks.append((network, interface, name))
+        if network.prefixlen != network.max_prefixlen:
+            key = (network.version, network.prefixlen)
+            self.by_length.setdefault(key, set()).add(int(network.network_address))
+
+    def reaches(self, address):
+        for ((version, length), networks) in self.by_length.items():
+            if version == address.version:
+                shift = address.max_prefixlen - length
+                if (int(address) >> shift) << shift in networks:
+                    return True
+        return False
+
+    def overlaps(self):
+        """
+        Return pairs of overlapping networks on different interfaces, found by sorting networks by start
+        """
+        overlaps = []
+        networks = sorted([x for x in self.networks if x[0].prefixlen != x[0].max_prefixlen],
+                          key=lambda x: (x[0].version, int(x[0].network_address), x[0].prefixlen))
+        previous = None
+        for current in networks:
+            if previous is not None and previous[0].version == current[0].version and \
+                    int(current[0].network_address) <= int(previous[0].broadcast_address):
+                if previous[2] != current[2]:
+                    overlaps.append((previous, current))
+                if int(current[0].broadcast_address) <= int(previous[0].broadcast_address):
+                    continue
+            previous = current
+        return overlaps
+
+
+def validate_config(config):
+    """
+    Check whole topology at once before anything is created: veth peers exist, interface names and
+    addresses are unique per namespace and route nexthops are inside a connected network.
+    Overlapping connected networks of different interfaces are logged as warnings.
+    :raises ConfigException: listing every error found
+    """
+    errors = []
+    namespaces = config['namespaces']
+    names = dict([(namespace, {}) for namespace in namespaces.keys()])
+    addresses = dict([(namespace, {}) for namespace in namespaces.keys()])
+    connected = dict([(namespace, _Connected()) for namespace in namespaces.keys()])
+
+    def add_name(namespace, name, origin):
+        if name in names[namespace]:
+            errors.append("interface '%s' in namespace '%s' defined by %s and %s" % (
+                name, namespace, names[namespace][name], origin))
+        else:
+            names[namespace][name] = origin
 
+    def add_address(namespace, name, value):
+        try:
+            interface = ipaddress.ip_interface(str(value))
+        except ValueError as e:
+            errors.append("invalid address on interface '%s' in namespace '%s': %s" % (name, namespace, e))
+            return
+        if interface.ip in addresses[namespace]:
+            errors.append("address %s on interface '%s' in namespace '%s' already on interface '%s'" % (
+                interface.ip, name, namespace, addresses[namespace][interface.ip]))
+            return
+        addresses[namespace][interface.ip] = name
+        connected[namespace].add(interface, name)
+
+    for namespace, values in namespaces.items():
         for interface in values['interfaces']:
             if interface['type'] == 'veth':
-                (iface1, iface2) = ns.ip.veth(namespaces[interface['peer']],
-                                              interface['my_interface'],
-                                              interface['peer_interface'])
-                iface1.up()
-                iface2.up()
-                if 'my_address' in interface:
-                    iface1.add_address(interface['my_address'])
-                if 'peer_address' in interface:
-                    iface2.add_address(interface['peer_address'])
-                if 'my_address6' in interface:
-                    iface1.add_address(interface['my_address6'])
-                if 'peer_address6' in interface:
-                    iface2.add_address(interface['peer_address6'])
-            elif interface['type'] == 'normal':
-                iface = ns.ip.interface(interface['name'])
-                iface.up()
-                if 'address' in interface:
-                    iface.add_address(interface['address'])
-                if 'address6' in interface:
-                    iface.add_address(interface['address6'])
+                origin = "veth '%s' of namespace '%s'" % (interface['name_prefix'], namespace)
+                peer = interface.get('peer')
+                if peer not in namespaces:
+                    errors.append("peer namespace '%s' of %s not defined" % (peer, origin))
+                    peer = None
+                add_name(namespace, interface['my_interface'], origin)
+                if peer is not None:
+                    add_name(peer, interface['peer_interface'], origin)
+                for key in ['my_address', 'my_address6']:
+                    if key in interface:
+                        add_address(namespace, interface['my_interface'], interface[key])
+                for key in ['peer_address', 'peer_address6']:
+                    if key in interface and peer is not None:
+                        add_address(peer, interface['peer_interface'], interface[key])
             else:
-                raise IPException("Unknown interface type %s" % interface['type'])
+                add_name(namespace, interface['name'], "interface of namespace '%s'" % namespace)
+                for key in ['address', 'address6']:
+                    if key in interface:
+                        add_address(namespace, interface['name'], interface[key])
 
-    # Create routes
-    for namespace, values in config['namespaces'].items():
-        ns = namespaces[namespace]
-        for route in values['routes']:
+    for namespace in namespaces.keys():
+        # Kernel accepts overlapping networks, e.g. a covering prefix on lo, so they are only warned about
+        for (first, second) in connected[namespace].overlaps():
+            logger.warning("Network %s on interface '%s' overlaps %s on interface '%s' in namespace '%s'" % (
+                second[1], second[2], first[1], first[2], namespace))
+
+    for namespace, values in namespaces.items():
+        for (key, version) in [('routes', 4), ('routes6', 6)]:
+            for route in values[key]:
+                if route['destination'] != 'default':
+                    try:
+                        ipaddress.ip_network(str(route['destination']), strict=False)
+                    except ValueError as e:
+                        errors.append("invalid destination of %s in namespace '%s': %s" % (key[:-1], namespace, e))
+                for nexthop in route['nexthop']:
+                    try:
+                        via = ipaddress.ip_address(str(nexthop['via']))
+                    except ValueError as e:
+                        errors.append("invalid nexthop of %s '%s' in namespace '%s': %s" % (
+                            key[:-1], route['destination'], namespace, e))
+                        continue
+                    if via.version != version:
+                        errors.append("nexthop %s of %s '%s' in namespace '%s' is not IPv%d address" % (
+                            via, key[:-1], route['destination'], namespace, version))
+                    # Global namespace has addresses not managed by config
+                    elif namespace != 'global' and not via.is_link_local and \
+                            not connected[namespace].reaches(via):
+                        errors.append("nexthop %s of %s '%s' in namespace '%s' is not in any connected network" % (
+                            via, key[:-1], route['destination'], namespace))
+
+    if errors:
+        raise ConfigException("%d error(s) in config:\n%s" % (len(errors), '\n'.join(errors)))
+
+
+def config_cache_directory():
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'nscommander')
+
+
+def _file_digest(path):
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def _template_digests(config):
+    sources = set([t['source'] for n in config['namespaces'].values() for t in n['templates']])
+    return dict([(source, _file_digest(source)) for source in sources])
+
+
+def prune_config_cache(entries=CONFIG_CACHE_ENTRIES):
+    """
+    Remove least recently used cached configs beyond entries
+    """
+    directory = config_cache_directory()
+    cached = []
+    for name in os.listdir(directory):
+        if name.endswith('.json'):
+            try:
+                cached.append((os.stat(os.path.join(directory, name)).st_mtime, name))
+            except FileNotFoundError:
+                continue
+    for (_, name) in sorted(cached, reverse=True)[entries:]:
+        try:
+            os.unlink(os.path.join(directory, name))
+        except FileNotFoundError:
+            # Pruned by another process at the same time
+            pass
+
+
+def load_config(path, cache=True, instance=None):
+    """
+    Read and normalize config file, for instance if given.
+
+    Normalized config is cached on disk keyed by hash of the config file, and used as long as
+    template sources it references are unchanged. At most CONFIG_CACHE_ENTRIES configs are kept.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    key = hashlib.sha256(b"%d\0%s\0%s" % (CONFIG_CACHE_VERSION, (instance or '').encode("utf-8"),
+                                           data)).hexdigest()
+    cache_file = os.path.join(config_cache_directory(), "%s.json" % key)
+    if cache:
+        try:
+            with open(cache_file, 'r') as f:
+                cached = json.load(f)
+            if _template_digests(cached['config']) == cached['templates']:
+                logger.debug("Using cached config %s" % cache_file)
+                check_directories(cached['config'])
+                # Modification time orders entries for pruning
+                os.utime(cache_file)
+                return cached['config']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    import yaml
+    config = normalize_config(yaml.load(data, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader)),
+                              instance=instance)
+    if cache:
+        try:
+            content = json.dumps({'config': config, 'templates': _template_digests(config)})
+            os.makedirs(config_cache_directory(), mode=0o700, exist_ok=True)
+            if write_if_changed(cache_file, content.encode("utf-8")):
+                prune_config_cache()
+        except (OSError, TypeError, ValueError) as e:
+            # Values yaml can represent but json can not, such as dates, are not cached
+            logger.debug("Not caching config: %s" % e)
+    return config
+
+
+def write_if_changed(destination, content):
+    """
+    Atomically replace destination with content unless it already has the same content
+    :return: True if file was written
+    """
+    digest = hashlib.sha256(content).digest()
+    try:
+        with open(destination, 'rb') as f:
+            if hashlib.sha256(f.read()).digest() == digest:
+                return False
+        mode = os.stat(destination).st_mode & 0o7777
+    except FileNotFoundError:
+        mode = 0o666 & ~UMASK
+    (fd, temporary) = tempfile.mkstemp(prefix=".%s." % os.path.basename(destination),
+                                       dir=os.path.dirname(destination) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.chmod(temporary, mode)
+        os.replace(temporary, destination)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+    return True
+
+
+def render_templates(namespaces, jobs=1):
+    """
+    Render templates of namespaces, every source file is read only once
+    and destinations are rendered in parallel on jobs workers.
+    :return: list of destination files which changed
+    """
+    sources = {}
+    templates = []
+    for namespace in namespaces:
+        for template in namespace['templates']:
+            if template['source'] not in sources:
+                if not os.path.isfile(template['source']):
+                    raise ConfigException("%s not such file or directory" % template['source'])
+                with open(template['source'], 'rb') as source_file:
+                    sources[template['source']] = source_file.read().decode("utf-8")
+            destination_folder = os.path.dirname(template['destination'])
+            if not os.path.isdir(destination_folder):
+                raise ConfigException("Destination folder %s is not a directory" % destination_folder)
+            templates.append((namespace, template))
+
+    def render(item):
+        (namespace, template) = item
+        parsed = expand_string(sources[template['source']], namespace).encode("utf-8") + "\n".encode("utf-8")
+        written = write_if_changed(template['destination'], parsed)
+        journal.record('file', namespace=namespace['name'], path=os.path.abspath(template['destination']))
+        if written:
+            logger.debug("Created file %s from template %s" % (template['destination'], template['source']))
+            return template['destination']
+        logger.debug("File %s is up to date" % template['destination'])
+
+    if jobs > 1 and len(templates) > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            changed = list(executor.map(render, templates))
+    else:
+        changed = [render(x) for x in templates]
+    return [x for x in changed if x]
+
+
+def parse_templates(namespace):
+    return render_templates([namespace])
+
+
+def _create_namespace(namespace):
+    batch = IPBatch()
+    with batch.describe("namespace '%s'" % namespace):
+        IP(batch=batch).netns(namespace)
+    batch.execute()
+    if namespace != 'global':
+        journal.record('namespace', name=namespace)
+
+
+def _create_links(namespace, values):
+    batch = IPBatch()
+    ns = NetNS(namespace, batch=batch)
+    for interface in values['interfaces']:
+        if interface['type'] == 'veth':
+            # Resumed create may find veths created before it was interrupted
+            if journal.entries and ns.ip.context.state.has_link(interface['my_interface']) and \
+                    NetNS(interface['peer']).ip.context.state.has_link(interface['peer_interface']):
+                continue
+            with batch.describe("veth '%s' in namespace '%s'" % (interface['my_interface'], namespace)):
+                ns.ip.veth(NetNS(interface['peer'], batch=batch),
+                           interface['my_interface'],
+                           interface['peer_interface'])
+    batch.execute()
+    for interface in values['interfaces']:
+        if interface['type'] == 'veth':
+            journal.record('veth', namespace=namespace, name=interface['my_interface'], peer=interface['peer'],
+                           peer_interface=interface['peer_interface'])
+
+
+def _configure_interfaces(namespace, interfaces):
+    """
+    Set up interfaces located in namespace and add their addresses
+    :param interfaces: list of (config item, interface name, address keys) tuples
+    """
+    batch = IPBatch()
+    ns = NetNS(namespace, batch=batch)
+    for (interface, name, keys) in interfaces:
+        with batch.describe("interface '%s' in namespace '%s'" % (name, namespace)):
+            iface = ns.ip.interface(name)
+            iface.up()
+            for key in keys:
+                if key in interface:
+                    iface.add_address(interface[key])
+    batch.execute()
+    if namespace == 'global':
+        for (interface, name, keys) in interfaces:
+            for key in keys:
+                if key in interface:
+                    journal.record('address', namespace=namespace, interface=name, address=interface[key])
+
+
+def _create_routes(namespace, values):
+    batch = IPBatch()
+    ns = NetNS(namespace, batch=batch)
+    for route in values['routes']:
+        with batch.describe("route '%s' in namespace '%s'" % (route['destination'], namespace)):
             if len(route['nexthop']) > 1:
                 # ECMP route
                 ns.ip.ecmp_route(route['destination'], route['nexthop'], state="exists")
             else:
                 ns.ip.route(route['destination'], route['nexthop'][0]['via'], state="exists")
-        for route in values['routes6']:
+    for route in values['routes6']:
+        with batch.describe("route6 '%s' in namespace '%s'" % (route['destination'], namespace)):
             if len(route['nexthop']) > 1:
                 # ECMP route
                 ns.ip.ecmp_route6(route['destination'], route['nexthop'], state="exists")
             else:
                 ns.ip.route6(route['destination'], route['nexthop'][0]['via'], state="exists")
-    
-    # Run sysctl
+    batch.execute()
+    if namespace == 'global':
+        for (key, ipversion) in [('routes', '4'), ('routes6', '6')]:
+            for route in values[key]:
+                journal.record('route', namespace=namespace, destination=route['destination'],
+                               nexthop=route['nexthop'], ipversion=ipversion)
+
+
+def _run_sysctl(namespace, values):
+    changed = sysctl.apply(NetNS(namespace).ip.context, values)
+    logger.debug("Namespace %s: %d of %d sysctl value(s) changed" % (namespace, len(changed), len(values)))
+
+
+def _running(namespace, run):
+    """
+    Return True if background run entry started by an earlier create is still running
+    """
+    for entry in journal.of('process'):
+        if entry['namespace'] == namespace and entry['name'] == run['name'] and \
+                entry['start_time'] is not None and start_time(entry['pid']) == entry['start_time']:
+            return True
+    return False
+
+
+def _run_command(namespace, run):
+    context = NetNS(namespace).ip.context
+    if run['background']:
+        if _running(namespace, run):
+            logger.debug("Run '%s' in namespace %s is already running" % (run['name'], namespace))
+            return
+        (pid, supervised) = supervisor.start(context, run)
+        journal.record('process', namespace=namespace, name=run['name'], pid=pid, start_time=start_time(pid),
+                       supervised=supervised)
+        supervisor.wait_ready(context.namespace, run)
+    else:
+        context.run(run['command'], *run['args'], output_file=run['output_file'])
+
+
+def _run_commands(namespace, values):
+    for run in values['run']:
+        _run_command(namespace, run)
+
+
+def _locate_interfaces(config):
+    """
+    Return interfaces located in each namespace, veth peers end up in the peer namespace,
+    and namespaces whose links must exist before interfaces of a namespace can be configured
+    :return: ({namespace: [(config item, interface name, address keys)]}, {namespace: set of namespaces})
+    """
+    located = dict([(namespace, []) for namespace in config['namespaces'].keys()])
+    owners = dict([(namespace, set([namespace])) for namespace in config['namespaces'].keys()])
+    for namespace, values in config['namespaces'].items():
+        if 'interfaces' not in values:
+            values['interfaces'] = []
+        for interface in values['interfaces']:
+            if interface['type'] == 'veth':
+                located[namespace].append((interface, interface['my_interface'], ['my_address', 'my_address6']))
+                located[interface['peer']].append((interface, interface['peer_interface'],
+                                                   ['peer_address', 'peer_address6']))
+                owners[interface['peer']].add(namespace)
+            elif interface['type'] == 'normal':
+                located[namespace].append((interface, interface['name'], ['address', 'address6']))
+            else:
+                raise IPException("Unknown interface type %s" % interface['type'])
+    return (located, owners)
+
+
+def interface_names(config):
+    """
+    Return {namespace: [interface names]} of interfaces config places in each namespace
+    """
+    (located, owners) = _locate_interfaces(config)
+    return dict([(namespace, [name for (_, name, _) in interfaces])
+                 for (namespace, interfaces) in located.items() if interfaces])
+
+
+def create_from_config(config, jobs=1):
+    """
+    Create namespaces, interfaces, routes, sysctls, templates and run commands of config.
+
+    Work is split to per namespace operations which are run on a pool of jobs workers
+    as soon as the operations they depend on are done.
+    """
+    invalidate_states()
+    scheduler = Scheduler(jobs=jobs)
+    (located, owners) = _locate_interfaces(config)
+
     for namespace, values in config['namespaces'].items():
-        ns = namespaces[namespace]
-        for key, value in values['sysctl'].items():
-            ns.ip.context.run(SYSCTLCOMMAND, '-w', "%s=%s" % (key, str(value)))
+        scheduler.add("namespace/%s" % namespace, functools.partial(_create_namespace, namespace))
+        peers = set([x['peer'] for x in values['interfaces'] if x['type'] == 'veth'])
+        scheduler.add("links/%s" % namespace, functools.partial(_create_links, namespace, values),
+                      ["namespace/%s" % x for x in sorted(peers | set([namespace]))])
 
-    # Create configs
     for namespace, values in config['namespaces'].items():
-        parse_templates(values)
+        scheduler.add("interfaces/%s" % namespace,
+                      functools.partial(_configure_interfaces, namespace, located[namespace]),
+                      ["links/%s" % x for x in sorted(owners[namespace])])
+        scheduler.add("routes/%s" % namespace, functools.partial(_create_routes, namespace, values),
+                      ["interfaces/%s" % namespace])
+        # Per interface keys need every link of the namespace to exist
+        scheduler.add("sysctl/%s" % namespace, functools.partial(_run_sysctl, namespace, values['sysctl']),
+                      ["interfaces/%s" % namespace])
+        scheduler.add("templates/%s" % namespace, functools.partial(parse_templates, values))
 
-    # Run commands
+    if 'global' not in config['namespaces']:
+        # Forwarding of the global namespace is set once per run even when config does not manage it
+        scheduler.add("sysctl/global", functools.partial(_run_sysctl, 'global', forwarding_defaults()))
+
+    # Commands are started only after the whole topology is ready
+    ready = list(scheduler.order)
     for namespace, values in config['namespaces'].items():
-        ns = namespaces[namespace]
+        scheduler.add("run/%s" % namespace, functools.partial(_run_commands, namespace, values), ready)
+
+    completed = journal.completed_steps() & set(scheduler.order)
+    if completed:
+        logger.info("Resuming create, %d of %d steps already done" % (len(completed), len(scheduler.order)))
+    scheduler.run(completed=completed, on_complete=lambda name: journal.record('step', name=name))
+    # Next create does every step again, so resources removed meanwhile are recreated
+    journal.record('created')
+
+
+def apply_from_config(config, dry_run=False, jobs=1, namespaces=None):
+    """
+    Change live namespaces to match config without recreating unchanged parts.
+
+    Commands are started only in namespaces which did not exist before.
+    :param namespaces: apply only these namespaces, reusing live state of others loaded earlier
+    :return: list of changes
+    """
+    if namespaces is None:
+        invalidate_states()
+    else:
+        for namespace in namespaces:
+            invalidate_state(NetNS(namespace).ip.namespace)
+    with profiler.phase('plan'):
+        changes = plan_config(config, namespaces)
+    if dry_run:
+        return changes
+    applied = []
+    # Removing addresses makes kernel flush routes and secondary addresses depending
+    # on them, plan again until live state converges
+    for _ in range(3):
+        if not changes:
+            break
+        with profiler.phase('apply'):
+            apply_changes(changes)
+        applied += changes
+        if not [x for x in changes if x.action == '-' and x.kind in ['address', 'link']]:
+            break
+        invalidate_states()
+        with profiler.phase('plan'):
+            changes = plan_config(config, namespaces)
+    changes = applied
+    _journal_changes(changes)
+    with profiler.phase('templates'):
+        render_templates([values for (namespace, values) in config['namespaces'].items()
+                          if namespaces is None or namespace in namespaces], jobs=jobs)
+    for change in changes:
+        if change.kind == 'namespace' and change.action == '+':
+            with profiler.phase('run', change.namespace):
+                _run_commands(change.namespace, config['namespaces'][change.namespace])
+    return changes
+
+
+def _journal_changes(changes):
+    for change in changes:
+        if change.action == '+' and change.kind == 'namespace':
+            journal.record('namespace', name=change.namespace)
+        elif change.action == '+' and change.kind == 'veth':
+            journal.record('veth', namespace=change.namespace, name=change.name, peer=change.item['peer'],
+                           peer_interface=change.item['peer_interface'])
+        elif change.namespace == 'global' and change.action == '+' and change.kind == 'address':
+            journal.record('address', namespace=change.namespace, interface=change.item, address=change.name)
+        elif change.namespace == 'global' and change.action in ['+', '~'] and change.kind == 'route':
+            (route, ipversion) = change.item
+            journal.record('route', namespace=change.namespace, destination=route['destination'],
+                           nexthop=route['nexthop'], ipversion=ipversion)
+
+
+def _changed_namespaces(old, new):
+    """
+    Return namespaces whose normalized config differs between configs
+    """
+    changed = set()
+    for namespace, values in new['namespaces'].items():
+        previous = old['namespaces'].get(namespace)
+        if previous is None or json.dumps(previous, sort_keys=True) != json.dumps(values, sort_keys=True):
+            changed.add(namespace)
+    return changed
+
+
+def _serve_apply(config, namespaces, jobs):
+    with profiler.phase('serve'):
+        try:
+            changes = apply_from_config(config, jobs=jobs, namespaces=namespaces)
+        except (IPException, ConfigException, OSError) as e:
+            logger.error("Applying namespaces %s failed: %s" % (', '.join(sorted(namespaces)), e))
+            return
+    for change in changes:
+        logger.info("Applied %s" % change)
+
+
+def serve_config(path, jobs=1, cache=True, instance=None):
+    """
+    Keep live namespaces in sync with config until interrupted.
+
+    Config and template sources are watched with inotify. A changed config is
+    reloaded and applied only to namespaces whose normalized config changed, and
+    changed template sources are rendered only for namespaces using them. Links,
+    addresses and routes changed by someone else are seen from rtnetlink multicast
+    groups of every namespace and fixed by applying that namespace again.
+    """
+    # Imported here, only serve needs inotify and netlink event sockets
+    import watch
+    monitor = watch.Monitor()
+    try:
+        config = load_config(path, cache=cache, instance=instance)
+        path = os.path.abspath(path)
+        dirty = set(config['namespaces'].keys())
+        while True:
+            if dirty:
+                _serve_apply(config, dirty, jobs)
+            sources = set([os.path.abspath(t['source']) for values in config['namespaces'].values()
+                           for t in values['templates']])
+            monitor.watch_files([path] + sorted(sources))
+            monitor.subscribe(list(config['namespaces'].keys()))
+            (paths, drifted) = monitor.wait()
+            dirty = set(drifted)
+            if paths is None:
+                logger.warning("File events were lost, applying every namespace")
+                paths = set([path])
+                dirty = set(config['namespaces'].keys())
+            for changed in paths:
+                if os.path.dirname(changed) == NETNS_RUN_DIR and os.path.basename(changed) in config['namespaces']:
+                    # Deleted or recreated by someone else
+                    dirty.add(os.path.basename(changed))
+            if path in paths:
+                try:
+                    with profiler.phase('config'):
+                        loaded = load_config(path, cache=cache, instance=instance)
+                except Exception as e:
+                    logger.error("Not applying changed config %s: %s" % (path, e))
+                    continue
+                dirty |= _changed_namespaces(config, loaded)
+                logger.info("Config %s changed, %d namespace(s) affected" % (path, len(dirty)))
+                config = loaded
+                if journal.enabled:
+                    journal.rename(config_key(path, instance))
+            for (namespace, values) in config['namespaces'].items():
+                if [t for t in values['templates'] if os.path.abspath(t['source']) in paths]:
+                    dirty.add(namespace)
+            # Veths span namespaces, deleting one end deletes the other
+            dirty = peer_namespaces(config, dirty & set(config['namespaces'].keys()))
+    finally:
+        monitor.close()
+
+
+def compile_config(config):
+    """
+    Compile config to a plan of low level operations, see plan module.
+
+    Templates are rendered and relative paths made absolute now, so replaying the
+    plan needs neither the config nor template sources.
+    """
+    compiled = plan.new_plan()
+    (located, owners) = _locate_interfaces(config)
+    sources = {}
+    for namespace, values in config['namespaces'].items():
+        if namespace != 'global':
+            plan.add(compiled, 'namespaces', 'netns_add', 'global', namespace)
+        for interface in values['interfaces']:
+            if interface['type'] == 'veth':
+                plan.add(compiled, 'links', 'veth', namespace, interface['my_interface'], interface['peer'],
+                         interface['peer_interface'])
+        for (interface, name, keys) in located[namespace]:
+            plan.add(compiled, 'interfaces', 'up', namespace, name)
+            for key in keys:
+                if key in interface:
+                    plan.add(compiled, 'interfaces', 'addr', namespace, name, interface[key])
+        for (key, ipversion) in [('routes', '4'), ('routes6', '6')]:
+            for route in values[key]:
+                plan.add(compiled, 'routes', 'route', namespace, route['destination'], route['nexthop'], ipversion)
+        if values['sysctl']:
+            plan.add(compiled, 'sysctl', 'sysctl', namespace, values['sysctl'])
+        for template in values['templates']:
+            if template['source'] not in sources:
+                if not os.path.isfile(template['source']):
+                    raise ConfigException("%s not such file or directory" % template['source'])
+                with open(template['source'], 'rb') as source_file:
+                    sources[template['source']] = source_file.read().decode("utf-8")
+            plan.add(compiled, 'files', 'file', namespace, os.path.abspath(template['destination']),
+                     expand_string(sources[template['source']], values) + "\n")
         for run in values['run']:
-            ns.ip.context.run(run['command'], *run['args'], background=run['background'], output_file=run['output_file'])
-
-
-def destroy_from_config(config):
-    current_namespaces = [x.strip() for x in ip.context.run(IPCOMMAND, 'netns', 'list').splitlines()]
-    for namespace in config['namespaces'].keys():
-        if namespace == 'global':
-            continue
-        if namespace not in current_namespaces:
-            continue
-        for pid in ip.context.run(IPCOMMAND, 'netns', 'pids', namespace).splitlines():
-            pid = pid.strip()
-            ip.context.run(KILLCOMMAND, pid)
-        time.sleep(0.1)
-        if ip.context.run(IPCOMMAND, 'netns', 'pids', namespace).splitlines():
-            time.sleep(1)
-            for pid in ip.context.run(IPCOMMAND, 'netns', 'pids', namespace).splitlines():
-                pid = pid.strip()
-                ip.context.run(KILLCOMMAND, '-9', pid)
+            if run['output_file']:
+                run = dict(run, output_file=os.path.abspath(run['output_file']))
+            plan.add(compiled, 'run', 'run', namespace, run)
+    if 'global' not in config['namespaces']:
+        plan.add(compiled, 'sysctl', 'sysctl', 'global', forwarding_defaults())
+    return compiled
+
+
+def _replay_operations(namespace, operations):
+    batch = IPBatch()
+    ns = NetNS(namespace, batch=batch)
+    backend = ns.ip.context.backend
+    for operation in operations:
+        (kind, name) = (operation[0], operation[2])
+        with batch.describe("%s '%s' in namespace '%s'" % (kind, name, namespace)):
+            if kind == 'netns_add':
+                backend.netns_add(name)
+            elif kind == 'veth':
+                # Resumed replay may find veths created before it was interrupted
+                if journal.entries and ns.ip.context.state.has_link(name) and \
+                        NetNS(operation[3]).ip.context.state.has_link(operation[4]):
+                    continue
+                backend.link_add_veth(name, operation[4])
+                backend.link_set_netns(operation[4], NetNS(operation[3]).ip.namespace)
+            elif kind == 'up':
+                backend.link_set(name, up=True)
+            elif kind == 'addr':
+                backend.addr_add(name, operation[3], '6' if ':' in operation[3] else '4')
+            elif kind == 'route':
+                backend.route_add(name, operation[3], operation[4])
+    batch.execute()
+    for operation in operations:
+        (kind, name) = (operation[0], operation[2])
+        if kind == 'netns_add':
+            journal.record('namespace', name=name)
+        elif kind == 'veth':
+            journal.record('veth', namespace=namespace, name=name, peer=operation[3], peer_interface=operation[4])
+        elif kind == 'addr' and namespace == 'global':
+            journal.record('address', namespace=namespace, interface=name, address=operation[3])
+        elif kind == 'route' and namespace == 'global':
+            journal.record('route', namespace=namespace, destination=name, nexthop=operation[3],
+                           ipversion=operation[4])
+        elif kind == 'sysctl':
+            _run_sysctl(namespace, name)
+        elif kind == 'file':
+            write_if_changed(name, operation[3].encode("utf-8"))
+            journal.record('file', namespace=namespace, path=name)
+        elif kind == 'run':
+            _run_command(namespace, name)
+
+
+def replay_plan(compiled, jobs=1):
+    """
+    Run operations of a compiled plan phase by phase, namespaces of a phase in parallel on jobs workers.
+
+    Completed phases of namespaces are journaled like create steps and skipped when
+    an interrupted replay is run again.
+    """
+    invalidate_states()
+    completed = journal.completed_steps()
+    if completed:
+        logger.info("Resuming replay, %d steps already done" % len(completed))
+    for (phase, operations) in compiled['phases']:
+        steps = [x for x in plan.grouped(operations) if "%s/%s" % (phase, x[0]) not in completed]
+
+        def replay(step):
+            (namespace, operations) = step
+            with profiler.phase(phase, namespace):
+                _replay_operations(namespace, operations)
+            journal.record('step', name="%s/%s" % (phase, namespace))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            list(executor.map(replay, steps))
+    journal.record('created')
+
+
+def _delete_namespace(namespace):
+    start = time.monotonic()
+    with profiler.phase('delete', namespace):
         ip.netns_del(namespace)
+    return time.monotonic() - start
+
+
+def _ignore_missing(description, func, *args):
+    """
+    Remove journaled resource, which may already be gone
+    """
+    try:
+        func(*args)
+    except (IPException, OSError) as e:
+        logger.debug("%s already removed: %s" % (description, e))
+
+
+def _destroy_journaled(jobs=1, grace=1.0):
+    """
+    Remove exactly the resources recorded in journal without looking for them
+    """
+    stop_workers()
+    pids = []
+    groups = []
+    for entry in journal.of('process'):
+        # PIDs may have been reused after the process exited
+        if entry['start_time'] is not None and start_time(entry['pid']) == entry['start_time']:
+            pids.append(entry['pid'])
+            if not entry['supervised']:
+                groups.append(entry['pid'])
+        if entry['supervised']:
+            child = supervisor.read_pid(supervisor.pid_file(NetNS(entry['namespace']).ip.namespace, entry['name']))
+            if child is not None:
+                pids.append(child)
+                groups.append(child)
+    with profiler.phase('terminate'):
+        exited = terminate(sorted(set(pids)), grace=grace, groups=groups)
+        for namespace in set([x['namespace'] for x in journal.of('process')]):
+            supervisor.forget(NetNS(namespace).ip.namespace)
+    logger.info("%d process(es) stopped in %.3fs" % (len(exited), max(list(exited.values()) + [0.0])))
+
+    namespaces = []
+    for entry in journal.of('namespace'):
+        if entry['name'] not in namespaces:
+            namespaces.append(entry['name'])
+
+    def delete(namespace):
+        with profiler.phase('delete', namespace):
+            _ignore_missing("Namespace %s" % namespace, ip.context.backend.netns_del, namespace)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        list(executor.map(delete, namespaces))
+    logger.info("%d namespace(s) deleted" % len(namespaces))
+
+    root = IP()
+    with profiler.phase('global'):
+        for entry in reversed(journal.of('route')):
+            nexthop = entry['nexthop'][0]['via'] if len(entry['nexthop']) == 1 else None
+            _ignore_missing("Route %s" % entry['destination'], root.context.backend.route_del,
+                            entry['destination'], nexthop, entry['ipversion'])
+        for entry in reversed(journal.of('address')):
+            _ignore_missing("Address %s" % entry['address'], root.context.backend.addr_del, entry['interface'],
+                            entry['address'], '6' if ':' in entry['address'] else '4')
+        for entry in reversed(journal.of('veth')):
+            # Veths with both ends in deleted namespaces are gone already
+            if entry['namespace'] == 'global':
+                _ignore_missing("Veth %s" % entry['name'], root.context.backend.link_del, entry['name'])
+            elif entry['peer'] == 'global':
+                _ignore_missing("Veth %s" % entry['peer_interface'], root.context.backend.link_del,
+                                entry['peer_interface'])
+    for path in sorted(set([x['path'] for x in journal.of('file')])):
+        _ignore_missing("File %s" % path, os.unlink, path)
+    journal.remove()
+
+
+def _tracked(namespace, values):
+    return all([supervisor.is_tracked(namespace, run) for run in values['run'] if run['background']])
+
+
+def destroy_from_config(config, jobs=1, grace=1.0, scan=False):
+    """
+    Stop processes and delete namespaces of config and remove its routes from global namespace.
+
+    Processes of all namespaces are signalled at once and waited for concurrently,
+    those still running after grace seconds are killed. Processes started from run
+    entries are found from their pidfiles, /proc is scanned for processes of namespaces
+    only if some pidfile is missing or scan is set.
+
+    If a finished create was journaled, exactly the journaled resources are removed instead
+    unless scan is set. Otherwise resources are found from config, and journaled resources
+    config does not cover, such as those of an interrupted create or apply, are removed after.
+    """
+    invalidate_states()
+    if journal.enabled and journal.created() and not scan:
+        return _destroy_journaled(jobs=jobs, grace=grace)
+    # Workers would be found and killed as processes of namespaces
+    stop_workers()
+    current_namespaces = ip.netns_list()
+    namespaces = [x for x in config['namespaces'].keys() if x != 'global' and x in current_namespaces]
+
+    with profiler.phase('terminate'):
+        untracked = [x for x in namespaces if scan or not _tracked(x, config['namespaces'][x])]
+        pids = netns_pids(untracked)
+        groups = []
+        for namespace in namespaces + (['global'] if 'global' in config['namespaces'] else []):
+            (supervisors, processes) = supervisor.tracked_pids(namespace)
+            groups += processes
+            pids[namespace] = sorted(set(pids.get(namespace, []) + supervisors + processes))
+        exited = terminate([pid for name in pids.keys() for pid in pids[name]], grace=grace, groups=groups)
+        for namespace in pids.keys():
+            supervisor.forget(namespace)
+
+    deleted = {}
+    if namespaces:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            deleted = dict(zip(namespaces, executor.map(_delete_namespace, namespaces)))
+
+    for namespace in namespaces:
+        stopped = max([exited.get(pid, 0.0) for pid in pids[namespace]] + [0.0])
+        logger.info("Namespace %s: %d process(es) stopped in %.3fs, deleted in %.3fs" % (
+            namespace, len(pids[namespace]), stopped, deleted[namespace]))
 
     if 'global' in config['namespaces'].keys():
-        if 'routes' in config['namespaces']['global']:
-            for route in config['namespaces']['global']['routes']:
-                if len(route['nexthop']) > 1:
-                    ip.ecmp_route(route['destination'], route['nexthop'], state="absent")
-                else:
-                    ip.route(route['destination'], route['nexthop'][0]['via'], state="absent")
+        batch = IPBatch()
+        root = IP(batch=batch)
+        for (key, ipversion) in [('routes', '4'), ('routes6', '6')]:
+            for route in config['namespaces']['global'].get(key, []):
+                with batch.describe("%s '%s' in namespace 'global'" % (key[:-1], route['destination'])):
+                    if len(route['nexthop']) > 1:
+                        root._ecmp_route(route['destination'], route['nexthop'], state="absent",
+                                         ipversion=ipversion)
+                    else:
+                        root._route(route['destination'], route['nexthop'][0]['via'], state="absent",
+                                    ipversion=ipversion)
+        with profiler.phase('routes', 'global'):
+            batch.execute()
+    if journal.entries:
+        _destroy_journaled(jobs=jobs, grace=grace)
+    journal.remove()
+
+
+@contextlib.contextmanager
+def topology(config, jobs=1, grace=0.0):
+    """
+    Create namespaces of normalized config for the duration of with block, meant for test fixtures.
+    Namespaces come from and are recycled to the pool set with ip.set_pool, if any.
+
+        ip.set_pool(Pool(size=32))
+        with topology(load_config('chain.yaml')) as config:
+            ...
+    """
+    create_from_config(config, jobs=jobs)
+    try:
+        yield config
+    finally:
+        destroy_from_config(config, jobs=jobs, grace=grace)
 
 
+def log_profile():
+    summary = profiler.summary()
+    for (name, values) in sorted(summary['phases'].items(), key=lambda x: -x[1]['total']):
+        logger.info("Phase %s: %d run(s), total %.3fs, p50 %.3fs, p99 %.3fs" % (
+            name, values['count'], values['total'], values['p50'], values['p99']))
+    for (name, values) in sorted(summary['operations_by_namespace'].items(), key=lambda x: -x[1]['total']):
+        logger.info("Namespace %s: %d operation(s), total %.3fs, p50 %.3fs, p99 %.3fs" % (
+            name, values['count'], values['total'], values['p50'], values['p99']))
+
 
 if __name__ == '__main__':
     logging.basicConfig()
     import argparse
     parser = argparse.ArgumentParser()
 
-    parser.add_argument("-c", "--config", help="Config file", required=True)
+    parser.add_argument("-c", "--config", help="Config file, needed by every action except pool")
     parser.add_argument("-d", "--debug", help="Enable debug", default=False, action="store_true")
-    parser.add_argument('action', help="Action to do", default="create", choices=["create", "destroy", "restart", "dump", "templates"])
+    parser.add_argument("-b", "--backend", help="Use /bin/ip or native rtnetlink to configure namespaces",
+                        default="ip", choices=["ip", "netlink"])
+    parser.add_argument("-j", "--jobs", help="Number of parallel workers used to create namespaces",
+                        type=int, default=os.cpu_count() or 1)
+    parser.add_argument("-x", "--exec-mode", help="Run commands in namespaces with `ip netns exec` or "
+                        "with a helper process living in each namespace", default="exec", choices=["exec", "worker"])
+    parser.add_argument("-g", "--grace", help="Seconds to wait for processes to exit before killing them",
+                        type=float, default=1.0)
+    parser.add_argument("-s", "--scan", help="Find processes to stop by scanning /proc even if all processes "
+                        "started from config are tracked", default=False, action="store_true")
+    parser.add_argument("--no-journal", help="Do not record created resources, destroy finds them from config",
+                        default=False, action="store_true")
+    parser.add_argument("-p", "--profile", help="Save latency of every command and summary per phase and "
+                        "namespace as JSON to file")
+    parser.add_argument("-t", "--trace", help="Save commands and phases to file in Chrome trace-event format")
+    parser.add_argument("--no-cache", help="Do not use or save cached normalized config", default=False,
+                        action="store_true")
+    parser.add_argument("-o", "--output", help="File compile writes plan or shell script and stats samples to, "
+                        "directory for batch files. Written to stdout by default")
+    parser.add_argument("-f", "--format", help="Format compile writes plan in (plan, batch or shell, default plan) "
+                        "or stats writes samples in (csv or json, default csv)",
+                        choices=["plan", "batch", "shell", "csv", "json"])
+    parser.add_argument("-i", "--interval", help="Seconds between samples of stats", type=float, default=1.0)
+    parser.add_argument("-n", "--count", help="Number of samples stats takes, 0 samples until interrupted",
+                        type=int, default=0)
+    parser.add_argument("--pool", help="Take namespaces from a pool of idle namespaces and recycle deleted "
+                        "namespaces to it, keeping at most this many idle. pool action fills the pool to this "
+                        "size, 0 deletes idle namespaces", type=int)
+    parser.add_argument("--instance", help="Create a separate copy of config, namespaces, veths and files are "
+                        "named after instance id so copies can be created and destroyed side by side")
+    parser.add_argument('action', help="Action to do, replay and destroy also accept a compiled plan as config",
+                        default="create", choices=["create", "destroy", "restart", "apply", "plan", "dump",
+                                                   "templates", "compile", "replay", "serve", "pool",
+                                                   "stats"])
 
     args = parser.parse_args()
 
@@ -300,27 +1219,137 @@ if __name__ == '__main__':
     else:
         logger.setLevel(logging.INFO)
 
+    set_backend(args.backend)
+    set_exec_mode(args.exec_mode)
+    if args.profile or args.trace:
+        profiler.enable()
+
+    if args.pool is not None:
+        namespace_pool = Pool(size=args.pool, grace=args.grace)
+        if args.action == 'pool':
+            if args.pool:
+                logger.info("%d idle namespace(s) added to pool" % namespace_pool.fill())
+            else:
+                logger.info("%d idle namespace(s) deleted" % namespace_pool.drain())
+            sys.exit(0)
+        set_pool(namespace_pool)
+    elif args.action == 'pool':
+        print("Pool action needs --pool size")
+        sys.exit(1)
+
+    formats = {'compile': ['plan', 'batch', 'shell'], 'stats': ['csv', 'json']}
+    if args.format is not None and args.format not in formats.get(args.action, []):
+        print("Format %s can not be used with action %s" % (args.format, args.action))
+        sys.exit(1)
+    if args.format is None and args.action in formats:
+        args.format = formats[args.action][0]
+
+    if not args.config:
+        print("Action %s needs --config" % args.action)
+        sys.exit(1)
     if not os.path.isfile(args.config):
         print("Not such file or directory '%s'" % args.config)
         sys.exit(1)
 
-    c = open(args.config, 'r')
+    config = None
+    compiled = None
+    if plan.is_plan_file(args.config):
+        if args.action not in ['compile', 'replay', 'destroy', 'restart']:
+            print("Action %s needs a config, %s is a compiled plan" % (args.action, args.config))
+            sys.exit(1)
+        if args.instance is not None:
+            print("Plan %s is already compiled, pass --instance to compile instead" % args.config)
+            sys.exit(1)
+        with profiler.phase('config'):
+            compiled = plan.load(args.config)
+    elif args.action == 'replay':
+        print("%s is not a compiled plan, create one with the compile action" % args.config)
+        sys.exit(1)
+    elif args.action != 'serve':
+        with profiler.phase('config'):
+            config = load_config(args.config, cache=not args.no_cache, instance=args.instance)
+        logger.debug("Template cache: %(hits)d hits, %(misses)d misses, %(plain)d plain strings" % cache_info())
 
-    config = normalize_config(yaml.load(c.read()))
+    if not args.no_journal and args.action in ['create', 'destroy', 'restart', 'apply', 'replay', 'serve']:
+        journal.open(config_key(args.config, args.instance), (args.config, args.instance))
 
-    if args.action == 'create':
-        create_from_config(config)
+    if args.action in ['destroy', 'restart'] and compiled is not None:
+        # Resources of a replayed plan are known only from its journal
+        if not journal.entries:
+            print("Nothing journaled for plan %s, cannot destroy it" % args.config)
+            sys.exit(1)
+        invalidate_states()
+        _destroy_journaled(jobs=args.jobs, grace=args.grace)
+        if args.action == 'restart':
+            journal.open(config_key(args.config, args.instance), (args.config, args.instance))
+            replay_plan(compiled, jobs=args.jobs)
+    elif args.action == 'create':
+        create_from_config(config, jobs=args.jobs)
     elif args.action == 'destroy':
-        destroy_from_config(config)
+        destroy_from_config(config, jobs=args.jobs, grace=args.grace, scan=args.scan)
     elif args.action == "restart":
-        destroy_from_config(config)
-        create_from_config(config)
+        destroy_from_config(config, jobs=args.jobs, grace=args.grace, scan=args.scan)
+        if not args.no_journal:
+            journal.open(config_key(args.config, args.instance), (args.config, args.instance))
+        create_from_config(config, jobs=args.jobs)
+    elif args.action == 'replay':
+        replay_plan(compiled, jobs=args.jobs)
+    elif args.action == 'stats':
+        sampler = stats.Sampler(interface_names(config))
+        output = open(args.output, 'a') if args.output else sys.stdout
+        try:
+            stats.run(sampler, output, interval=args.interval, count=args.count, output_format=args.format,
+                      header=not args.output or output.tell() == 0)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if args.output:
+                output.close()
+    elif args.action == 'serve':
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            serve_config(args.config, jobs=args.jobs, cache=not args.no_cache, instance=args.instance)
+        except KeyboardInterrupt:
+            pass
+    elif args.action == 'compile':
+        if compiled is None:
+            with profiler.phase('compile'):
+                compiled = compile_config(config)
+        if args.format == 'batch':
+            if not args.output:
+                print("Batch format needs an output directory")
+                sys.exit(1)
+            (files, skipped) = plan.export_batch(compiled, args.output)
+            logger.info("%d batch file(s) written to %s" % (len(files), args.output))
+            if skipped:
+                logger.warning("%d sysctl, file and run operation(s) are not in batch files, "
+                               "use shell format to include them" % skipped)
+        else:
+            output = plan.export_shell(compiled) if args.format == 'shell' else plan.dumps(compiled)
+            if args.output:
+                with open(args.output, 'w') as f:
+                    f.write(output)
+                if args.format == 'shell':
+                    os.chmod(args.output, 0o755 & ~UMASK)
+            else:
+                sys.stdout.write(output)
+    elif args.action in ['apply', 'plan']:
+        changes = apply_from_config(config, dry_run=args.action == 'plan', jobs=args.jobs)
+        for change in changes:
+            print(change)
+        if not changes:
+            print("No changes")
     elif args.action == 'dump':
+        import yaml
         print(yaml.dump(config, indent=4, default_flow_style=False, default_style='"'))
     elif args.action == 'templates':
-        for _, namespace in config['namespaces'].items():
-            parse_templates(namespace)
+        render_templates(list(config['namespaces'].values()), jobs=args.jobs)
     else:
         print("Invalid action %s" % args.action)
         sys.exit(1)
+    if args.profile:
+        profiler.export(args.profile)
+        log_profile()
+    if args.trace:
+        profiler.export_chrome(args.trace)
     logger.info("Done!")
@@ -0,0 +1,206 @@
+"""
+Long lived helper processes running inside network namespaces.
+
+Instead of prefixing every command with `ip netns exec`, one helper per
+namespace is started and moved to the namespace with setns. Commands and
+sysctl writes are sent to it as JSON lines over a pipe. Unlike `ip netns exec`
+the helper does not create a mount namespace, so /sys and /etc/netns are
+those of the global namespace.
+
+Helpers exit when nscommander closes the pipe, which also happens if it crashes.
+"""
+
+import atexit
+import base64
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from profiling import profiler
+
+
+def sysctl_path(key):
+    return os.path.join('/proc/sys', key.replace('.', '/'))
+
+
+def write_sysctl(values):
+    """
+    Write sysctl values of the namespace calling thread is in
+    """
+    for key, value in values.items():
+        with open(sysctl_path(key), 'w') as f:
+            f.write("%s\n" % value)
+
+
+def read_sysctl(keys):
+    """
+    Read sysctl values of the namespace calling thread is in, keys which do not exist are left out
+    """
+    values = {}
+    for key in keys:
+        try:
+            with open(sysctl_path(key), 'r') as f:
+                values[key] = ' '.join(f.read().split())
+        except FileNotFoundError:
+            # Written anyway, so a missing key is reported by the write
+            continue
+    return values
+
+
+def _handle(request, children):
+    if request['op'] == 'run':
+        output_file = request.get('output_file')
+        if request['background']:
+            with open(output_file or os.devnull, 'ab') as o:
+                p = subprocess.Popen(request['args'], stdin=subprocess.DEVNULL, stdout=o, stderr=subprocess.STDOUT,
+                                     start_new_session=True)
+            children.append(p)
+            return {'pid': p.pid}
+        if output_file:
+            with open(output_file, 'wb') as o:
+                p = subprocess.Popen(request['args'], stdin=subprocess.DEVNULL, stdout=o, stderr=subprocess.PIPE)
+                (out, err) = p.communicate()
+            out = b''
+        else:
+            p = subprocess.Popen(request['args'], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE)
+            (out, err) = p.communicate()
+        return {'pid': p.pid, 'status': p.returncode,
+                'stdout': base64.b64encode(out).decode("ascii"), 'stderr': base64.b64encode(err).decode("ascii")}
+    elif request['op'] == 'sysctl':
+        write_sysctl(request['values'])
+        return {}
+    elif request['op'] == 'read_sysctl':
+        return {'values': read_sysctl(request['keys'])}
+    raise ValueError("Unknown operation '%s'" % request['op'])
+
+
+def serve(namespace):
+    from ip import setns, netns_path
+    fd = os.open(netns_path(namespace), os.O_RDONLY)
+    setns(fd)
+    os.close(fd)
+    children = []
+    stdin = sys.stdin.buffer
+    stdout = sys.stdout.buffer
+    for line in stdin:
+        # Reap finished background commands
+        children = [x for x in children if x.poll() is None]
+        try:
+            response = _handle(json.loads(line.decode("utf-8")), children)
+        except Exception as e:
+            response = {'error': "%s: %s" % (e.__class__.__name__, e)}
+        stdout.write(json.dumps(response).encode("utf-8") + b'\n')
+        stdout.flush()
+
+
+class Worker(object):
+    def __init__(self, namespace):
+        from ip import netns_path
+        self.namespace = namespace
+        self.inode = os.stat(netns_path(namespace)).st_ino
+        self.lock = threading.Lock()
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__), namespace],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def call(self, request):
+        from ip import IPException
+        start = time.monotonic()
+        with self.lock:
+            try:
+                self.process.stdin.write(json.dumps(request).encode("utf-8") + b'\n')
+                self.process.stdin.flush()
+                line = self.process.stdout.readline()
+            except (BrokenPipeError, ValueError):
+                line = b''
+            if not line:
+                raise IPException("Worker of namespace %s exited" % self.namespace)
+        response = json.loads(line.decode("utf-8"))
+        profiler.record('worker', ' '.join(request.get('args', [request['op']])), self.namespace, start,
+                        1 if 'error' in response else response.get('status', 0),
+                        len(response.get('stdout', '')) * 3 // 4)
+        if 'error' in response:
+            raise IPException("Worker of namespace %s failed: %s" % (self.namespace, response['error']))
+        return response
+
+    def run(self, args, background=False, output_file=None):
+        """
+        Run command in namespace, same semantics as IPContext.run
+        """
+        from ip import IPException
+        response = self.call({'op': 'run', 'args': list(args), 'background': background,
+                              'output_file': os.path.abspath(output_file) if output_file else None})
+        if background:
+            return response['pid']
+        stdout = base64.b64decode(response['stdout'])
+        stderr = base64.b64decode(response['stderr'])
+        if response['status'] != 0:
+            raise IPException("%s command failed in namespace %s:\n%s\n%s" % (' '.join(args), self.namespace,
+                                                                              stdout, stderr))
+        return stdout.decode("utf-8")
+
+    def sysctl(self, values):
+        self.call({'op': 'sysctl', 'values': dict([(k, str(v)) for (k, v) in values.items()])})
+
+    def read_sysctl(self, keys):
+        return self.call({'op': 'read_sysctl', 'keys': list(keys)})['values']
+
+    def stop(self, timeout=1.0):
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process.stdout.close()
+
+
+_workers = {}
+_workers_lock = threading.Lock()
+
+
+def get_worker(namespace):
+    """
+    Return worker of namespace, starting it if needed.
+    Namespaces recreated with the same name get a new worker.
+    """
+    from ip import netns_path
+    inode = os.stat(netns_path(namespace)).st_ino
+    with _workers_lock:
+        worker = _workers.get(namespace)
+        if worker is not None and (worker.inode != inode or worker.process.poll() is not None):
+            worker.stop()
+            worker = None
+        if worker is None:
+            worker = Worker(namespace)
+            _workers[namespace] = worker
+        return worker
+
+
+def stop_worker(namespace):
+    with _workers_lock:
+        worker = _workers.pop(namespace, None)
+    if worker is not None:
+        worker.stop()
+
+
+def stop_workers():
+    for namespace in list(_workers.keys()):
+        stop_worker(namespace)
+
+
+def worker_pids():
+    return [x.process.pid for x in list(_workers.values())]
+
+
+atexit.register(stop_workers)
+
+
+if __name__ == '__main__':
+    serve(sys.argv[1])
@@ -0,0 +1,204 @@
+"""
+Compiled execution plans.
+
+A plan is a config compiled to an ordered list of phases, each a list of low
+level operations. Templates are rendered at compile time, so a plan can be
+replayed without yaml, Jinja or config normalization. Operations are lists
+starting with operation name and namespace:
+
+    ['netns_add', 'global', name]
+    ['veth', namespace, interface, peer namespace, peer interface]
+    ['up', namespace, interface]
+    ['addr', namespace, interface, address]
+    ['route', namespace, destination, nexthops, ipversion]
+    ['sysctl', namespace, {key: value}]
+    ['file', namespace, path, content]
+    ['run', namespace, normalized run entry]
+
+Operations of different namespaces in the same phase are independent.
+Plans can also be exported as `ip -batch` files or a shell script.
+"""
+
+import hashlib
+import json
+import os
+import shlex
+
+from ip import CommandBackend, IPCOMMAND, SYSCTLCOMMAND
+
+PLAN_VERSION = 1
+
+PHASES = ['namespaces', 'links', 'interfaces', 'routes', 'sysctl', 'files', 'run']
+
+# Operations done with ip commands, others are exported only to shell scripts
+IP_OPERATIONS = ['netns_add', 'veth', 'up', 'addr', 'route']
+
+
+def new_plan():
+    return {'nscommander_plan': PLAN_VERSION, 'phases': [[phase, []] for phase in PHASES]}
+
+
+def add(plan, phase, *operation):
+    plan['phases'][PHASES.index(phase)][1].append(list(operation))
+
+
+def grouped(operations):
+    """
+    Return list of (namespace, operations) in order of first appearance
+    """
+    groups = {}
+    for operation in operations:
+        groups.setdefault(operation[1], []).append(operation)
+    return list(groups.items())
+
+
+def dumps(plan):
+    return json.dumps(plan, separators=(',', ':')) + '\n'
+
+
+def is_plan_file(path):
+    with open(path, 'rb') as f:
+        return f.read(32).startswith(b'{"nscommander_plan":')
+
+
+def load(path):
+    with open(path, 'r') as f:
+        plan = json.load(f)
+    if plan.get('nscommander_plan') != PLAN_VERSION:
+        raise ValueError("%s is not a plan of version %d" % (path, PLAN_VERSION))
+    return plan
+
+
+class _Recorder(object):
+    """
+    Stands in for IPContext and collects ip commands of CommandBackend
+    """
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.commands = []
+
+    def ip(self, *args):
+        self.commands.append(list(args))
+
+
+def _namespace(name):
+    return None if name == 'global' else name
+
+
+def ip_commands(namespace, operations):
+    """
+    Return {(options): [ip arguments]} of ip operations, grouped by global options like IPBatch
+    """
+    recorder = _Recorder(_namespace(namespace))
+    backend = CommandBackend(recorder)
+    for operation in operations:
+        kind = operation[0]
+        if kind == 'netns_add':
+            backend.netns_add(operation[2])
+        elif kind == 'veth':
+            backend.link_add_veth(operation[2], operation[4])
+            backend.link_set_netns(operation[4], _namespace(operation[3]))
+        elif kind == 'up':
+            backend.link_set(operation[2], up=True)
+        elif kind == 'addr':
+            backend.addr_add(operation[2], operation[3], '6' if ':' in operation[3] else '4')
+        elif kind == 'route':
+            backend.route_add(operation[2], operation[3], operation[4])
+    commands = {}
+    for args in recorder.commands:
+        options = []
+        while args and args[0].startswith('-'):
+            options.append(args.pop(0))
+        commands.setdefault(tuple(options), []).append(args)
+    return commands
+
+
+def _ip_prefix(namespace, options):
+    command = ['$IP']
+    if _namespace(namespace):
+        command += ['-n', shlex.quote(namespace)]
+    return ' '.join(command + list(options))
+
+
+def export_batch(plan, directory):
+    """
+    Write ip operations as numbered `ip -batch` files to directory
+    :return: list of written files and number of operations which can not be expressed as ip commands
+    """
+    os.makedirs(directory, exist_ok=True)
+    files = []
+    skipped = 0
+    for (phase, operations) in plan['phases']:
+        skipped += len([x for x in operations if x[0] not in IP_OPERATIONS])
+        for (namespace, ops) in grouped([x for x in operations if x[0] in IP_OPERATIONS]):
+            for (options, commands) in ip_commands(namespace, ops).items():
+                name = "%03d-%s-%s%s.batch" % (len(files) + 1, phase, namespace, ''.join(options))
+                with open(os.path.join(directory, name), 'w') as f:
+                    f.write("# %s -batch %s\n" % (_ip_prefix(namespace, options).replace('$IP', 'ip'), name))
+                    f.write(''.join(["%s\n" % ' '.join(args) for args in commands]))
+                files.append(name)
+    return (files, skipped)
+
+
+def _heredoc(content):
+    marker = "NSC_%s" % hashlib.sha256(content.encode("utf-8")).hexdigest()[:12]
+    if not content.endswith('\n'):
+        content += '\n'
+    return (marker, content)
+
+
+def _exec_prefix(namespace):
+    if _namespace(namespace):
+        return "$IP netns exec %s " % shlex.quote(namespace)
+    return ""
+
+
+def _shell_run(namespace, run):
+    command = _exec_prefix(namespace) + ' '.join([shlex.quote(x) for x in [run['command']] + run['args']])
+    if not run['background']:
+        if run['output_file']:
+            command += " > %s" % shlex.quote(run['output_file'])
+        return [command]
+    lines = ["setsid %s >> %s 2>&1 < /dev/null &" % (command, shlex.quote(run['output_file'] or '/dev/null'))]
+    if run['restart'] != 'no' or run['output_max_bytes']:
+        lines.insert(0, "# restart and output rotation of %s are not supported in shell scripts" % run['name'])
+    ready = run['ready'] or {}
+    if 'socket' in ready:
+        check = "[ -S %s ]" % shlex.quote(ready['socket'])
+    elif 'port' in ready:
+        check = "%sss -H%sln 'sport = :%d' | grep -q ." % (_exec_prefix(namespace), ready.get('protocol', 'tcp')[0],
+                                                        int(ready['port']))
+    elif 'log' in ready:
+        check = "grep -qE %s %s" % (shlex.quote(ready['log']), shlex.quote(run['output_file']))
+    else:
+        return lines
+    lines.append("i=0; until %s; do i=$((i+1)); [ $i -lt %d ] || { echo '%s not ready' >&2; exit 1; }; "
+                 "sleep 0.05; done" % (check, int(run['ready_timeout'] / 0.05), run['name']))
+    return lines
+
+
+def export_shell(plan):
+    """
+    Return plan as a POSIX shell script needing only ip and sysctl
+    """
+    lines = ["#!/bin/sh", "# Generated by nscommander compile", "set -e",
+             "IP=${IP:-%s}" % IPCOMMAND, "SYSCTL=${SYSCTL:-%s}" % SYSCTLCOMMAND]
+    for (phase, operations) in plan['phases']:
+        if operations:
+            lines += ["", "# %s" % phase]
+        for (namespace, ops) in grouped(operations):
+            for (options, commands) in ip_commands(namespace, [x for x in ops if x[0] in IP_OPERATIONS]).items():
+                lines.append("%s -batch - <<'NSC_EOF'" % _ip_prefix(namespace, options))
+                lines += [' '.join(args) for args in commands]
+                lines.append("NSC_EOF")
+            for operation in ops:
+                if operation[0] == 'sysctl':
+                    lines.append("%s$SYSCTL -q -w %s" % (_exec_prefix(namespace), ' '.join(
+                        [shlex.quote("%s=%s" % (k, v)) for (k, v) in sorted(operation[2].items())])))
+                elif operation[0] == 'file':
+                    (marker, content) = _heredoc(operation[3])
+                    lines.append("cat > %s <<'%s'" % (shlex.quote(operation[2]), marker))
+                    lines.append(content + marker)
+                elif operation[0] == 'run':
+                    lines += _shell_run(namespace, operation[2])
+    return '\n'.join(lines) + '\n'
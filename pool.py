@@ -0,0 +1,252 @@
+"""
+Pool of pre-created idle namespaces.
+
+Creating and especially deleting a network namespace is slow, deletion waits
+for the kernel to tear the namespace down. A pool keeps idle namespaces named
+nsc-pool-<random> in /run/netns. Creating a namespace takes an idle one and
+bind mounts it to the requested name, and deleting one recycles it instead:
+processes in it are killed, links other than lo deleted, lo addresses and all
+routes flushed and sysctls under net. changed from their values in a new
+namespace reset, after which it is renamed back to an idle namespace.
+
+Pool is used by namespace create and delete once set with ip.set_pool:
+
+    p = Pool(size=32)
+    p.fill()
+    ip.set_pool(p)
+
+Policy routing rules and firewall rules of recycled namespaces are not reset.
+"""
+
+import contextlib
+import ctypes
+import fcntl
+import os
+import sys
+import threading
+
+from ip import IPBatch, IPContext, IPException, invalidate_state, logger, netns_entered, netns_path, random_string, \
+    NETNS_RUN_DIR
+from processes import netns_pids, terminate
+
+POOL_PREFIX = 'nsc-pool-'
+
+# Not in /run/netns, where every file is taken to be a namespace
+LOCK_FILE = '/run/nscommander/pool.lock'
+
+SYSCTL_ROOT = '/proc/sys/net'
+
+MS_BIND = 0x1000
+MNT_DETACH = 0x2
+
+_libc = None
+
+
+def _check(result, description):
+    if result != 0:
+        error = ctypes.get_errno()
+        raise IPException("%s: %s" % (description, os.strerror(error)))
+
+
+def rename_netns(name, new_name):
+    """
+    Rename namespace by bind mounting it to new name and removing the old name
+    """
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(None, use_errno=True)
+    (source, target) = (netns_path(name), netns_path(new_name))
+    fd = os.open(target, os.O_RDONLY | os.O_CREAT | os.O_EXCL, 0)
+    os.close(fd)
+    try:
+        _check(_libc.mount(source.encode("utf-8"), target.encode("utf-8"), None, MS_BIND, None),
+               "Binding namespace %s to %s failed" % (name, new_name))
+    except IPException:
+        os.unlink(target)
+        raise
+    _check(_libc.umount2(source.encode("utf-8"), MNT_DETACH), "Unmounting namespace %s failed" % name)
+    os.unlink(source)
+    # Cached state and sockets are looked up by name
+    invalidate_state(name)
+    invalidate_state(new_name)
+    if 'netlink' in sys.modules:
+        sys.modules['netlink'].drop_socket(name)
+
+
+def read_sysctls(namespace):
+    """
+    Return every readable and writable sysctl under net. of namespace, per interface keys of links other than lo
+    are left out. Read in a thread entered to the namespace, where /proc/sys shows sysctls of the namespace.
+    """
+    values = {}
+    with netns_entered(namespace):
+        for (directory, directories, files) in os.walk(SYSCTL_ROOT):
+            if os.path.basename(os.path.dirname(directory)) == 'conf' and \
+                    os.path.basename(directory) not in ['all', 'default', 'lo']:
+                directories[:] = []
+                continue
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    if not os.stat(path).st_mode & 0o200:
+                        continue
+                    with open(path, 'r') as f:
+                        values[path] = f.read()
+                except OSError:
+                    # Write only keys and keys needing privileges we do not have
+                    continue
+    return values
+
+
+def write_sysctls(namespace, values):
+    with netns_entered(namespace):
+        for (path, value) in values.items():
+            try:
+                with open(path, 'w') as f:
+                    f.write(value)
+            except OSError as e:
+                logger.debug("Resetting %s in namespace %s failed: %s" % (path, namespace, e))
+
+
+class Pool(object):
+    """
+    Pool keeping up to size idle namespaces, shared by every process using the same prefix
+    """
+    def __init__(self, size=16, prefix=POOL_PREFIX, grace=0.0):
+        self.size = size
+        self.prefix = prefix
+        self.grace = grace
+        self.lock = threading.Lock()
+        self.defaults = None
+
+    @contextlib.contextmanager
+    def locked(self):
+        """
+        Hold pool lock of this process and the lock file shared with other processes
+        """
+        with self.lock:
+            os.makedirs(os.path.dirname(LOCK_FILE), mode=0o700, exist_ok=True)
+            fd = os.open(LOCK_FILE, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(fd)
+
+    def idle(self):
+        try:
+            return sorted([x for x in os.listdir(NETNS_RUN_DIR) if x.startswith(self.prefix)])
+        except FileNotFoundError:
+            return []
+
+    def _new_name(self):
+        return "%s%s" % (self.prefix, random_string(length=8))
+
+    def fill(self):
+        """
+        Create idle namespaces until pool has size of them, with one ip command
+        :return: number of namespaces created
+        """
+        with self.locked():
+            missing = self.size - len(self.idle())
+            if missing <= 0:
+                return 0
+            batch = IPBatch()
+            context = IPContext(batch=batch)
+            for _ in range(missing):
+                context.ip('netns', 'add', self._new_name())
+            batch.execute()
+        logger.debug("Added %d idle namespace(s) to pool" % missing)
+        return missing
+
+    def drain(self):
+        """
+        Delete every idle namespace
+        """
+        with self.locked():
+            idle = self.idle()
+            if idle:
+                batch = IPBatch()
+                context = IPContext(batch=batch)
+                for name in idle:
+                    context.ip('netns', 'delete', name)
+                batch.execute()
+        return len(idle)
+
+    def _sysctl_defaults(self):
+        """
+        Sysctls of a new namespace, read from an idle namespace or one created for it
+        """
+        if self.defaults is None:
+            with self.locked():
+                idle = self.idle()
+                if idle:
+                    self.defaults = read_sysctls(idle[0])
+                    return self.defaults
+            name = self._new_name()
+            IPContext().ip('netns', 'add', name)
+            try:
+                self.defaults = read_sysctls(name)
+            finally:
+                IPContext().ip('netns', 'delete', name)
+        return self.defaults
+
+    def acquire(self, name):
+        """
+        Rename an idle namespace to name
+        :return: False if pool has no idle namespaces
+        """
+        with self.locked():
+            idle = self.idle()
+            if not idle:
+                return False
+            rename_netns(idle[0], name)
+        logger.debug("Namespace %s taken from pool" % name)
+        return True
+
+    def recycle(self, name):
+        """
+        Return namespace to the state of a new namespace
+        """
+        defaults = self._sysctl_defaults()
+        pids = netns_pids([name]).get(name, [])
+        if pids:
+            terminate(pids, grace=self.grace)
+        context = IPContext(namespace=name)
+        batch = IPBatch()
+        batched = IPContext(namespace=name, batch=batch)
+        for link in context.backend.link_list():
+            if link != 'lo':
+                batched.ip('link', 'delete', link)
+        batched.ip('link', 'set', 'lo', 'down')
+        batched.ip('address', 'flush', 'dev', 'lo')
+        batched.ip('-4', 'route', 'flush', 'table', 'all')
+        batched.ip('-6', 'route', 'flush', 'table', 'all')
+        try:
+            batch.execute()
+        except IPException:
+            # Deleting a veth with both ends in the namespace deletes its peer too
+            invalidate_state(name)
+            if [x for x in context.backend.link_list() if x != 'lo']:
+                raise
+        current = read_sysctls(name)
+        write_sysctls(name, dict([(k, v) for (k, v) in defaults.items() if k in current and current[k] != v]))
+        invalidate_state(name)
+
+    def release(self, name):
+        """
+        Recycle namespace and return it to pool
+        :return: False if pool is full, namespace is then left as is
+        """
+        if len(self.idle()) >= self.size:
+            return False
+        if 'nsworker' in sys.modules:
+            # Worker would be killed as a process of the namespace
+            sys.modules['nsworker'].stop_worker(name)
+        self.recycle(name)
+        with self.locked():
+            if len(self.idle()) >= self.size:
+                return False
+            rename_netns(name, self._new_name())
+        logger.debug("Namespace %s returned to pool" % name)
+        return True
@@ -0,0 +1,141 @@
+"""
+Finding, signalling and waiting for processes running in network namespaces.
+"""
+
+import os
+import select
+import signal
+import time
+
+from ip import NETNS_RUN_DIR, logger
+
+
+def netns_pids(names):
+    """
+    Return dict mapping each namespace name to list of PIDs running in it.
+
+    Same as `ip netns pids`, but all namespaces are resolved with one scan of /proc.
+    """
+    inodes = {}
+    for name in names:
+        try:
+            st = os.stat(os.path.join(NETNS_RUN_DIR, name))
+        except FileNotFoundError:
+            continue
+        inodes[(st.st_dev, st.st_ino)] = name
+    pids = dict([(name, []) for name in names])
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            st = os.stat('/proc/%s/ns/net' % entry)
+        except OSError:
+            continue
+        name = inodes.get((st.st_dev, st.st_ino))
+        if name is not None:
+            pids[name].append(int(entry))
+    return pids
+
+
+def start_time(pid):
+    """
+    Return start time of process in clock ticks after boot, used to detect reused PIDs
+    """
+    try:
+        with open('/proc/%d/stat' % pid, 'rb') as f:
+            return int(f.read().rsplit(b')', 1)[1].split()[19])
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def is_alive(pid):
+    try:
+        with open('/proc/%d/stat' % pid, 'rb') as f:
+            # State follows the parenthesized command name
+            return f.read().rsplit(b')', 1)[1].split()[0] != b'Z'
+    except (OSError, IndexError):
+        return False
+
+
+def send_signal(pids, signum):
+    for pid in pids:
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+
+def wait_exit(pids, timeout):
+    """
+    Wait until processes exit or timeout seconds have passed.
+
+    Uses pidfds so waiting is done in one poll() over all processes,
+    falls back to polling /proc on kernels without pidfd_open.
+    :return: dict of pid to exit time in seconds from start, processes still running are missing
+    """
+    start = time.monotonic()
+    deadline = start + timeout
+    exited = {}
+    poller = select.poll()
+    fds = {}
+    polling = []
+    for pid in pids:
+        try:
+            fd = os.pidfd_open(pid)
+        except ProcessLookupError:
+            exited[pid] = 0.0
+            continue
+        except (AttributeError, OSError):
+            polling.append(pid)
+            continue
+        fds[fd] = pid
+        poller.register(fd, select.POLLIN)
+    try:
+        while fds or polling:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            wait = deadline - now
+            if polling:
+                wait = min(wait, 0.01)
+            for (fd, _) in poller.poll(wait * 1000):
+                pid = fds.pop(fd)
+                poller.unregister(fd)
+                os.close(fd)
+                exited[pid] = time.monotonic() - start
+            for pid in list(polling):
+                if not is_alive(pid):
+                    polling.remove(pid)
+                    exited[pid] = time.monotonic() - start
+    finally:
+        for fd in fds.keys():
+            os.close(fd)
+    return exited
+
+
+def send_group_signal(groups, signum):
+    for group in groups:
+        try:
+            os.killpg(group, signum)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+
+def terminate(pids, grace=1.0, groups=()):
+    """
+    Send SIGTERM to processes and SIGKILL to those still running after grace seconds.
+    Process groups in groups are signalled as a whole, their leaders must be in pids.
+    :return: dict of pid to time it took to exit
+    """
+    pids = list(pids)
+    send_signal(pids, signal.SIGTERM)
+    send_group_signal(groups, signal.SIGTERM)
+    exited = wait_exit(pids, grace)
+    remaining = [pid for pid in pids if pid not in exited]
+    if remaining:
+        logger.debug("Killing processes %s" % ' '.join([str(x) for x in remaining]))
+        send_signal(remaining, signal.SIGKILL)
+        send_group_signal([x for x in groups if x in remaining], signal.SIGKILL)
+        for pid, elapsed in wait_exit(remaining, grace).items():
+            exited[pid] = grace + elapsed
+    return exited
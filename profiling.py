@@ -0,0 +1,122 @@
+"""
+Tracing of kernel facing operations.
+
+Every command, batch, netlink request and worker call is recorded with its
+latency, exit status, output size and namespace, together with the phase
+(create/destroy operation) it was run in. Records can be summarized per
+phase and namespace, and exported as JSON or Chrome trace-event format.
+"""
+
+import contextlib
+import json
+import threading
+import time
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def _rollup(durations):
+    return {'count': len(durations), 'total': sum(durations),
+            'p50': percentile(durations, 0.5), 'p99': percentile(durations, 0.99)}
+
+
+class Profiler(object):
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.start = time.monotonic()
+        self.records = []
+        self.phases = []
+
+    def enable(self):
+        self.enabled = True
+        self.start = time.monotonic()
+
+    def current_phase(self):
+        stack = getattr(self.local, 'phases', None)
+        return stack[-1] if stack else (None, None)
+
+    @contextlib.contextmanager
+    def phase(self, name, namespace=None):
+        """
+        Record duration of with block, operations done inside it are attributed to this phase
+        """
+        if not self.enabled:
+            yield
+            return
+        if not hasattr(self.local, 'phases'):
+            self.local.phases = []
+        self.local.phases.append((name, namespace))
+        start = time.monotonic()
+        status = 0
+        try:
+            yield
+        except BaseException:
+            status = 1
+            raise
+        finally:
+            self.local.phases.pop()
+            with self.lock:
+                self.phases.append({'phase': name, 'namespace': namespace, 'start': start - self.start,
+                                    'duration': time.monotonic() - start, 'status': status,
+                                    'thread': threading.get_ident()})
+
+    def record(self, kind, command, namespace, start, status=0, stdout_size=0):
+        """
+        Record operation started at time.monotonic() value start and ended now
+        """
+        if not self.enabled:
+            return
+        duration = time.monotonic() - start
+        (phase, phase_namespace) = self.current_phase()
+        with self.lock:
+            self.records.append({'kind': kind, 'command': command, 'namespace': namespace or phase_namespace,
+                                 'phase': phase, 'start': start - self.start, 'duration': duration,
+                                 'status': status, 'stdout_size': stdout_size,
+                                 'thread': threading.get_ident()})
+
+    def summary(self):
+        by_phase = {}
+        by_namespace = {}
+        for record in self.records:
+            by_phase.setdefault(record['phase'] or 'none', []).append(record['duration'])
+            by_namespace.setdefault(record['namespace'] or 'global', []).append(record['duration'])
+        phases = {}
+        for phase in self.phases:
+            phases.setdefault(phase['phase'], []).append(phase['duration'])
+        return {'operations': _rollup([x['duration'] for x in self.records]),
+                'operations_by_phase': dict([(k, _rollup(v)) for (k, v) in by_phase.items()]),
+                'operations_by_namespace': dict([(k, _rollup(v)) for (k, v) in by_namespace.items()]),
+                'phases': dict([(k, _rollup(v)) for (k, v) in phases.items()])}
+
+    def export(self, path):
+        with open(path, 'w') as f:
+            json.dump({'summary': self.summary(), 'phases': self.phases, 'operations': self.records}, f, indent=2)
+
+    def export_chrome(self, path):
+        threads = {}
+        events = []
+        for (category, items) in [('phase', self.phases), ('operation', self.records)]:
+            for item in items:
+                tid = threads.setdefault(item['thread'], len(threads) + 1)
+                if category == 'phase':
+                    name = "%s %s" % (item['phase'], item['namespace'] or '')
+                    args = {'namespace': item['namespace'], 'status': item['status']}
+                else:
+                    name = item['command']
+                    args = {'namespace': item['namespace'], 'phase': item['phase'], 'status': item['status'],
+                            'stdout_size': item['stdout_size'], 'kind': item['kind']}
+                events.append({'name': name.strip(), 'cat': category, 'ph': 'X', 'pid': 1, 'tid': tid,
+                               'ts': int(item['start'] * 1000000), 'dur': int(item['duration'] * 1000000),
+                               'args': args})
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+profiler = Profiler()
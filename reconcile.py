@@ -0,0 +1,253 @@
+"""
+Compare normalized configuration against live namespaces and apply the difference.
+"""
+
+import ipaddress
+
+from ip import ip, IP, IPBatch, IPException, NetNS, get_state, invalidate_state, route_key, address_key
+from sysctl import changed_values
+
+# Addresses kernel manages by itself, never removed
+UNMANAGED_NETWORKS = [ipaddress.ip_network(x) for x in ['127.0.0.0/8', '::1/128', 'fe80::/10']]
+
+
+class Change(object):
+    """
+    One difference between config and live state.
+    :param action: '+' to add, '-' to remove and '~' to modify
+    """
+    def __init__(self, action, kind, namespace, name, item=None, detail=None):
+        self.action = action
+        self.kind = kind
+        self.namespace = namespace
+        self.name = name
+        self.item = item
+        self.detail = detail
+
+    def __str__(self):
+        return "%s %s %s in namespace %s%s" % (self.action, self.kind, self.name, self.namespace,
+                                               " (%s)" % self.detail if self.detail else "")
+
+
+def _managed_address(address):
+    address = ipaddress.ip_interface(address).ip
+    return not any([address in network for network in UNMANAGED_NETWORKS])
+
+
+def desired_state(config):
+    """
+    Return links, addresses, routes and sysctls config wants to have in every namespace
+    """
+    desired = {}
+    for namespace in config['namespaces'].keys():
+        desired[namespace] = {'veths': {}, 'links': set(), 'addresses': {}, 'routes': {}, 'sysctl': {}}
+
+    def add_addresses(namespace, name, interface, keys):
+        addresses = desired[namespace]['addresses'].setdefault(name, {})
+        for key in keys:
+            if key in interface:
+                addresses[address_key(interface[key])] = interface[key]
+
+    for namespace, values in config['namespaces'].items():
+        for interface in values['interfaces']:
+            if interface['type'] == 'veth':
+                desired[namespace]['veths'][interface['my_interface']] = interface
+                desired[namespace]['links'].add(interface['my_interface'])
+                desired[interface['peer']]['links'].add(interface['peer_interface'])
+                add_addresses(namespace, interface['my_interface'], interface, ['my_address', 'my_address6'])
+                add_addresses(interface['peer'], interface['peer_interface'], interface,
+                              ['peer_address', 'peer_address6'])
+            else:
+                desired[namespace]['links'].add(interface['name'])
+                add_addresses(namespace, interface['name'], interface, ['address', 'address6'])
+        for (key, ipversion) in [('routes', '4'), ('routes6', '6')]:
+            for route in values[key]:
+                desired[namespace]['routes'][route_key(route['destination'], ipversion)] = (route, ipversion)
+        for key, value in values['sysctl'].items():
+            desired[namespace]['sysctl'][key] = str(value)
+    return desired
+
+
+def peer_namespaces(config, namespaces):
+    """
+    Return namespaces and namespaces connected to them with veths
+    """
+    selected = set(namespaces)
+    for namespace, values in config['namespaces'].items():
+        for interface in values['interfaces']:
+            if interface['type'] == 'veth':
+                if namespace in namespaces:
+                    selected.add(interface['peer'])
+                if interface['peer'] in namespaces:
+                    selected.add(namespace)
+    return selected
+
+
+def plan_config(config, namespaces=None):
+    """
+    Return list of changes needed to make live namespaces match config.
+
+    Namespaces not in config are never touched. In the global namespace
+    nothing is removed, only missing links, addresses and routes are added.
+    Only routes added with ip (protocol boot) are removed, so routes
+    installed by routing daemons are left alone.
+
+    :param namespaces: plan only these namespaces, live state is then loaded only
+                       for them and namespaces connected to them
+    """
+    changes = []
+    desired = desired_state(config)
+    if namespaces is None:
+        namespaces = set(config['namespaces'].keys())
+    existing = set(ip.netns_list())
+    live = {}
+    for namespace in sorted(peer_namespaces(config, namespaces), key=list(config['namespaces'].keys()).index):
+        if namespace == 'global' or namespace in existing:
+            live[namespace] = NetNS(namespace).ip.context.state
+        else:
+            live[namespace] = None
+            if namespace in namespaces:
+                changes.append(Change('+', 'namespace', namespace, namespace))
+
+    def has_link(namespace, name):
+        return live[namespace] is not None and live[namespace].has_link(name)
+
+    for namespace, want in desired.items():
+        if namespace not in namespaces:
+            continue
+        state = live[namespace]
+        managed = namespace != 'global'
+        for name, interface in want['veths'].items():
+            if not has_link(namespace, name) or not has_link(interface['peer'], interface['peer_interface']):
+                if has_link(namespace, name):
+                    changes.append(Change('-', 'link', namespace, name, detail="peer missing"))
+                elif has_link(interface['peer'], interface['peer_interface']):
+                    changes.append(Change('-', 'link', interface['peer'], interface['peer_interface'],
+                                          detail="peer missing"))
+                changes.append(Change('+', 'veth', namespace, name, interface,
+                                      detail="peer %s in %s" % (interface['peer_interface'], interface['peer'])))
+        if state is not None and managed:
+            for name in sorted(state.links.keys()):
+                if name != 'lo' and name not in want['links']:
+                    changes.append(Change('-', 'link', namespace, name))
+        for name in sorted(want['links']):
+            if state is None or not state.links.get(name, {}).get('up', False):
+                changes.append(Change('~', 'link', namespace, name, detail="up"))
+
+        for name, addresses in sorted(want['addresses'].items()):
+            current = set(state.get_addresses(name)) if state is not None else set()
+            for key, address in sorted(addresses.items()):
+                if key not in current:
+                    changes.append(Change('+', 'address', namespace, address, item=name, detail="on %s" % name))
+            if managed:
+                for address in sorted(current - set(addresses.keys())):
+                    if _managed_address(address):
+                        changes.append(Change('-', 'address', namespace, address, item=name,
+                                              detail="on %s" % name))
+
+        for key, (route, ipversion) in want['routes'].items():
+            vias = sorted([x['via'] for x in route['nexthop']])
+            current = state.routes.get(key) if state is not None else None
+            if current is None:
+                changes.append(Change('+', 'route', namespace, route['destination'], (route, ipversion),
+                                      detail="via %s" % ', '.join(vias)))
+            elif current.get('protocol', 'boot') != 'kernel' and \
+                    sorted([x['via'] for x in current['nexthops']]) != vias:
+                changes.append(Change('~', 'route', namespace, route['destination'], (route, ipversion),
+                                      detail="via %s" % ', '.join(vias)))
+        if state is not None and managed:
+            for key, route in sorted(state.routes.items()):
+                if key[0] == 'main' and route.get('protocol') == 'boot' and key not in want['routes']:
+                    changes.append(Change('-', 'route', namespace, route['destination'], (route, route['family'])))
+
+        if want['sysctl']:
+            keys = sorted(want['sysctl'].keys())
+            current = NetNS(namespace).ip.context.read_sysctl(keys) if state is not None else {}
+            changed = changed_values(current, want['sysctl'])
+            for key in keys:
+                if key in changed:
+                    changes.append(Change('~', 'sysctl', namespace, key, want['sysctl'][key],
+                                          detail="%s -> %s" % (current.get(key), want['sysctl'][key])))
+    return changes
+
+
+def _delete_link(namespace, name):
+    try:
+        NetNS(namespace).ip.interface(name).delete()
+    except IPException:
+        # Other end of veth may have been deleted together with its peer
+        invalidate_state(namespace if namespace != 'global' else None)
+        if NetNS(namespace).ip.context.state.has_link(name):
+            raise
+
+
+def apply_changes(changes):
+    """
+    Apply changes returned by plan_config in dependency order
+    """
+    def of(action, kind):
+        return [x for x in changes if x.action == action and x.kind == kind]
+
+    batch = IPBatch()
+    root = IP(batch=batch)
+    for change in of('+', 'namespace'):
+        with batch.describe(str(change)):
+            root.netns(change.namespace)
+    batch.execute()
+
+    for change in of('-', 'link'):
+        _delete_link(change.namespace, change.name)
+    if of('-', 'link'):
+        # Deleting veth removes its peer from another namespace too
+        for namespace in set([x.namespace for x in changes]):
+            invalidate_state(namespace if namespace != 'global' else None)
+
+    for change in of('+', 'veth'):
+        interface = change.item
+        with batch.describe(str(change)):
+            NetNS(change.namespace, batch=batch).ip.veth(NetNS(interface['peer'], batch=batch),
+                                                         interface['my_interface'],
+                                                         interface['peer_interface'])
+    batch.execute()
+
+    for change in of('~', 'link'):
+        with batch.describe(str(change)):
+            NetNS(change.namespace, batch=batch).ip.interface(change.name).up()
+    for change in of('-', 'address'):
+        with batch.describe(str(change)):
+            iface = NetNS(change.namespace, batch=batch).ip.interface(change.item)
+            if ipaddress.ip_interface(change.name).version == 6:
+                iface.delete_address6(change.name)
+            else:
+                iface.delete_address(change.name)
+    for change in of('+', 'address'):
+        with batch.describe(str(change)):
+            iface = NetNS(change.namespace, batch=batch).ip.interface(change.item)
+            if ipaddress.ip_interface(change.name).version == 6:
+                iface.add_address6(change.name)
+            else:
+                iface.add_address(change.name)
+    batch.execute()
+
+    for change in of('-', 'route') + of('~', 'route'):
+        (route, ipversion) = change.item
+        with batch.describe(str(change)):
+            ns = NetNS(change.namespace, batch=batch)
+            ns.ip.context.backend.route_del(route['destination'], ipversion=ipversion)
+            get_state(ns.ip.namespace).remove_route(route['destination'], ipversion)
+    batch.execute()
+    for change in of('+', 'route') + of('~', 'route'):
+        (route, ipversion) = change.item
+        with batch.describe(str(change)):
+            ns = NetNS(change.namespace, batch=batch)
+            if ipversion == '6':
+                ns.ip.ecmp_route6(route['destination'], route['nexthop'], state="exists")
+            else:
+                ns.ip.ecmp_route(route['destination'], route['nexthop'], state="exists")
+    batch.execute()
+
+    values = {}
+    for change in of('~', 'sysctl'):
+        values.setdefault(change.namespace, {})[change.name] = change.item
+    for namespace, changed in values.items():
+        NetNS(namespace).ip.context.sysctl(changed)
@@ -0,0 +1,120 @@
+"""
+Dependency aware scheduler running operations on a bounded worker pool.
+"""
+
+import concurrent.futures
+
+from ip import logger
+from profiling import profiler
+
+
+class SchedulerException(Exception):
+    def __init__(self, failures):
+        self.failures = failures
+        super(SchedulerException, self).__init__("%d operation(s) failed:\n%s" % (
+            len(failures), '\n'.join(["%s: %s" % (name, error) for (name, error) in failures])))
+
+
+class Scheduler(object):
+    """
+    Graph of named operations, each operation is run after all its dependencies succeeded.
+
+    Ready operations are started in the order they were added. After first failure no new
+    operations are started, running ones are waited for and every failure is reported.
+    """
+    def __init__(self, jobs=1):
+        self.jobs = max(1, jobs or 1)
+        self.nodes = {}
+        self.order = []
+
+    def __contains__(self, name):
+        return name in self.nodes
+
+    def add(self, name, func, deps=()):
+        if name in self.nodes:
+            raise SchedulerException([(name, "operation defined twice")])
+        self.nodes[name] = (func, list(deps))
+        self.order.append(name)
+
+    def _check(self):
+        errors = []
+        for name in self.order:
+            for dep in self.nodes[name][1]:
+                if dep not in self.nodes:
+                    errors.append((name, "unknown dependency '%s'" % dep))
+        if errors:
+            raise SchedulerException(errors)
+        # Detect cycles with Kahn's algorithm
+        pending = dict([(name, len(set(self.nodes[name][1]))) for name in self.order])
+        dependants = self._dependants()
+        ready = [name for name in self.order if not pending[name]]
+        seen = 0
+        while ready:
+            name = ready.pop()
+            seen += 1
+            for dependant in dependants[name]:
+                pending[dependant] -= 1
+                if not pending[dependant]:
+                    ready.append(dependant)
+        if seen != len(self.order):
+            raise SchedulerException([(name, "dependency cycle") for name in self.order if pending[name]])
+
+    def _dependants(self):
+        dependants = dict([(name, []) for name in self.order])
+        for name in self.order:
+            for dep in set(self.nodes[name][1]):
+                dependants[dep].append(name)
+        return dependants
+
+    def _run_node(self, name):
+        # Operations are named <phase>/<namespace>, commands they run are profiled under that phase
+        (phase, _, namespace) = name.partition('/')
+        with profiler.phase(phase, namespace or None):
+            self.nodes[name][0]()
+
+    def run(self, completed=(), on_complete=None):
+        """
+        Run all operations.
+        :param completed: names of operations already done earlier, they are not run again
+        :param on_complete: called with name of every operation that succeeded
+        :raises SchedulerException: listing every failed operation
+        """
+        self._check()
+        pending = dict([(name, len(set(self.nodes[name][1]))) for name in self.order])
+        position = dict([(name, i) for (i, name) in enumerate(self.order)])
+        dependants = self._dependants()
+        failures = []
+        running = {}
+        done = [name for name in self.order if name in completed]
+        while done:
+            for dependant in dependants[done.pop()]:
+                pending[dependant] -= 1
+        ready = [name for name in self.order if not pending[name] and name not in completed]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while True:
+                while ready and not failures and len(running) < self.jobs:
+                    name = ready.pop(0)
+                    logger.debug("Starting %s" % name)
+                    running[executor.submit(self._run_node, name)] = name
+                if not running:
+                    break
+                done, _ = concurrent.futures.wait(list(running.keys()),
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    error = future.exception()
+                    if error is not None:
+                        failures.append((name, error))
+                        continue
+                    if on_complete is not None:
+                        on_complete(name)
+                    for dependant in dependants[name]:
+                        pending[dependant] -= 1
+                        if not pending[dependant] and dependant not in completed:
+                            ready.append(dependant)
+                    ready.sort(key=lambda x: position[x])
+
+        if failures:
+            failures.sort(key=lambda x: position[x[0]])
+            raise SchedulerException(failures)
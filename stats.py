@@ -0,0 +1,107 @@
+"""
+Sampling interface counters of namespaces.
+
+Counters of every link of a namespace are read at once from /proc/net/dev of a
+thread entered to the namespace, so no process is started per namespace or
+sample. Previous counters and rates are kept in flat arrays holding one row of
+LINK_STATS per link, and rates are updated from the difference to the previous
+sample.
+"""
+
+import array
+import json
+import time
+
+from ip import LINK_STATS, IPException, NetNS, logger
+
+
+class Sampler(object):
+    def __init__(self, links):
+        """
+        :param links: {namespace: [link names]}, 'global' is the global namespace
+        """
+        self.links = links
+        self.rows = {}
+        self.counters = array.array('Q')
+        self.rates = array.array('d')
+        self.time = None
+
+    def _row(self, key):
+        if key not in self.rows:
+            self.rows[key] = len(self.rows)
+            self.counters.extend([0] * len(LINK_STATS))
+            self.rates.extend([0.0] * len(LINK_STATS))
+        return self.rows[key] * len(LINK_STATS)
+
+    def sample(self):
+        """
+        Read counters of all links.
+        :return: list of (namespace, link, counters, rates), rates are per second since previous
+                 sample and None on the first sample of a link
+        """
+        now = time.monotonic()
+        elapsed = now - self.time if self.time is not None else None
+        width = len(LINK_STATS)
+        samples = []
+        for (namespace, names) in self.links.items():
+            try:
+                stats = NetNS(namespace).ip.context.backend.link_stats()
+            except (IPException, OSError) as e:
+                logger.debug("No counters for namespace %s: %s" % (namespace, e))
+                continue
+            for name in names:
+                counters = stats.get(name)
+                if counters is None:
+                    continue
+                seen = (namespace, name) in self.rows
+                row = self._row((namespace, name))
+                rates = None
+                if seen and elapsed:
+                    for (i, value) in enumerate(counters):
+                        previous = self.counters[row + i]
+                        # Counters start from zero again when link is recreated
+                        self.rates[row + i] = (value - previous) / elapsed if value >= previous else 0.0
+                    rates = self.rates[row:row + width]
+                self.counters[row:row + width] = array.array('Q', counters)
+                samples.append((namespace, name, counters, rates))
+        self.time = now
+        return samples
+
+
+def csv_header():
+    return ','.join(['time', 'namespace', 'interface'] + LINK_STATS + ["%s_rate" % x for x in LINK_STATS]) + '\n'
+
+
+def format_samples(timestamp, samples, output_format='csv'):
+    lines = []
+    for (namespace, name, counters, rates) in samples:
+        if output_format == 'json':
+            line = {'time': round(timestamp, 3), 'namespace': namespace, 'interface': name}
+            line.update(zip(LINK_STATS, counters))
+            line.update(zip(["%s_rate" % x for x in LINK_STATS], [round(x, 1) for x in rates] if rates else
+                            [None] * len(LINK_STATS)))
+            lines.append(json.dumps(line))
+        else:
+            lines.append(','.join(["%.3f" % timestamp, namespace, name] + [str(x) for x in counters] +
+                                  (["%.1f" % x for x in rates] if rates else [''] * len(LINK_STATS))))
+    return ''.join(["%s\n" % x for x in lines])
+
+
+def run(sampler, output, interval=1.0, count=0, output_format='csv', header=True):
+    """
+    Write samples taken every interval seconds to output until count samples, forever if count is 0
+    :param header: write CSV header first, left out when appending to an earlier CSV file
+    """
+    if output_format == 'csv' and header:
+        output.write(csv_header())
+    start = time.monotonic()
+    taken = 0
+    while True:
+        timestamp = time.time()
+        output.write(format_samples(timestamp, sampler.sample(), output_format))
+        output.flush()
+        taken += 1
+        if count and taken >= count:
+            return
+        # Sampling is kept on schedule even if reading counters took a while
+        time.sleep(max(0.0, start + taken * interval - time.monotonic()))
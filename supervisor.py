@@ -0,0 +1,329 @@
+"""
+Starting, supervising and tracking background processes of run entries.
+
+Background processes are started in their own session with output streamed to
+output_file, and their PIDs are written to pidfiles so destroy can find them
+without scanning /proc. Entries restarted on exit or with a rotated output file
+get a supervisor process, this file run as a script, which stays alive after
+nscommander exits.
+
+Readiness probes are checked by nscommander before the next run entry of the
+namespace is started:
+
+    ready: {socket: /run/daemon.sock}    unix socket exists
+    ready: {port: 179}                   TCP port (or UDP with protocol: udp) is bound
+    ready: {log: "Started"}              regular expression matches a line of output_file
+"""
+
+import json
+import os
+import re
+import signal
+import stat
+import subprocess
+import sys
+import threading
+import time
+
+import ip
+from ip import IPException, logger, netns_path, setns
+from processes import is_alive, start_time
+from profiling import profiler
+
+PID_DIR = '/run/nscommander/pids'
+
+# Restart delay is doubled on every restart up to this many seconds
+MAX_RESTART_DELAY = 60.0
+
+PROBE_INTERVAL = 0.05
+
+TCP_LISTEN = '0A'
+UDP_UNCONNECTED = '07'
+
+
+def pid_directory(namespace):
+    return os.path.join(PID_DIR, namespace or 'global')
+
+
+def pid_file(namespace, name, supervisor=False):
+    return os.path.join(pid_directory(namespace), "%s%s.pid" % (name, '.supervisor' if supervisor else ''))
+
+
+def read_pid(path):
+    """
+    Return PID of pidfile, None if the process has exited and its PID may have been reused
+    """
+    try:
+        with open(path, 'r') as f:
+            (pid, started) = f.read().split()
+        (pid, started) = (int(pid), int(started))
+    except (OSError, ValueError):
+        # Also pidfiles without start time, their PID can not be checked
+        return None
+    if start_time(pid) != started:
+        return None
+    return pid
+
+
+def write_pid(path, pid):
+    """
+    Write PID with start time of the process, which tells a reused PID apart from it
+    """
+    tmp = "%s.tmp" % path
+    with open(tmp, 'w') as f:
+        f.write("%d %s\n" % (pid, start_time(pid)))
+    os.replace(tmp, path)
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+class RotatingOutput(object):
+    """
+    File rotated to file.1 ... file.<backups> when it would grow over max_bytes
+    """
+    def __init__(self, path, max_bytes, backups):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.file = open(path, 'ab')
+
+    def write(self, data):
+        if self.file.tell() and self.file.tell() + len(data) > self.max_bytes:
+            self.rotate()
+        self.file.write(data)
+        self.file.flush()
+
+    def rotate(self):
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists("%s.%d" % (self.path, i)):
+                os.replace("%s.%d" % (self.path, i), "%s.%d" % (self.path, i + 1))
+        if self.backups:
+            os.replace(self.path, "%s.1" % self.path)
+        else:
+            os.unlink(self.path)
+        self.file = open(self.path, 'ab')
+
+    def close(self):
+        self.file.close()
+
+
+def supervise(spec):
+    """
+    Run command of spec until it exits without needing restart or supervisor gets SIGTERM
+    """
+    global PID_DIR
+    PID_DIR = spec['pid_dir']
+    if spec['setns']:
+        fd = os.open(netns_path(spec['namespace']), os.O_RDONLY)
+        setns(fd)
+        os.close(fd)
+    supervisor_pidfile = pid_file(spec['namespace'], spec['name'], supervisor=True)
+    child_pidfile = pid_file(spec['namespace'], spec['name'])
+    write_pid(supervisor_pidfile, os.getpid())
+    stopping = threading.Event()
+    child = None
+
+    def stop(signum, frame):
+        stopping.set()
+        if child is not None and child.poll() is None:
+            try:
+                os.killpg(child.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for signum in [signal.SIGTERM, signal.SIGINT, signal.SIGHUP]:
+        signal.signal(signum, stop)
+
+    delay = spec['restart_delay']
+    output = None
+    if spec['output_file'] and spec['output_max_bytes']:
+        output = RotatingOutput(spec['output_file'], spec['output_max_bytes'], spec['output_backups'])
+    try:
+        while not stopping.is_set():
+            started = time.monotonic()
+            if output is not None:
+                child = subprocess.Popen(spec['args'], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                         stderr=subprocess.STDOUT, start_new_session=True)
+            else:
+                with open(spec['output_file'] or os.devnull, 'ab') as o:
+                    child = subprocess.Popen(spec['args'], stdin=subprocess.DEVNULL, stdout=o,
+                                             stderr=subprocess.STDOUT, start_new_session=True)
+            write_pid(child_pidfile, child.pid)
+            if output is not None:
+                for data in iter(lambda: child.stdout.read1(65536), b''):
+                    output.write(data)
+                child.stdout.close()
+            status = child.wait()
+            if stopping.is_set() or spec['restart'] == 'no' or (spec['restart'] == 'on-failure' and status == 0):
+                break
+            # Process which stayed up long enough restarts without delay growing further
+            if time.monotonic() - started > MAX_RESTART_DELAY:
+                delay = spec['restart_delay']
+            stopping.wait(delay)
+            delay = min(delay * 2, MAX_RESTART_DELAY)
+    finally:
+        if output is not None:
+            output.close()
+        _remove(child_pidfile)
+        _remove(supervisor_pidfile)
+
+
+def _listening(pid, port, protocol):
+    """
+    Check from /proc/<pid>/net, which shows sockets of network namespace of pid, if port is bound
+    """
+    state = TCP_LISTEN if protocol == 'tcp' else UDP_UNCONNECTED
+    for name in [protocol, "%s6" % protocol]:
+        try:
+            with open('/proc/%d/net/%s' % (pid, name), 'r') as f:
+                next(f)
+                for line in f:
+                    fields = line.split()
+                    if int(fields[1].rsplit(':', 1)[1], 16) == port and fields[3] == state:
+                        return True
+        except (OSError, StopIteration):
+            continue
+    return False
+
+
+class _LogTail(object):
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.buffer = b''
+
+    def lines(self):
+        try:
+            with open(self.path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size < self.offset:
+                    # Rotated or truncated
+                    self.offset = 0
+                f.seek(self.offset)
+                data = f.read()
+                self.offset = f.tell()
+        except FileNotFoundError:
+            return []
+        lines = (self.buffer + data).split(b'\n')
+        self.buffer = lines.pop()
+        return [x.decode("utf-8", "replace") for x in lines]
+
+
+def wait_ready(namespace, run):
+    """
+    Wait until readiness probe of run entry succeeds.
+    :raises IPException: if process exits without restart or probe does not succeed in ready_timeout seconds
+    """
+    ready = run['ready']
+    if not ready:
+        return
+    description = "%s in namespace %s" % (run['name'], namespace)
+    deadline = time.monotonic() + run['ready_timeout']
+    tail = _LogTail(run['output_file']) if 'log' in ready else None
+    pattern = re.compile(ready['log']) if 'log' in ready else None
+    start = time.monotonic()
+    while True:
+        path = pid_file(namespace, run['name'])
+        started = os.path.exists(path)
+        pid = read_pid(path)
+        alive = pid is not None and is_alive(pid)
+        if 'socket' in ready:
+            try:
+                if stat.S_ISSOCK(os.stat(ready['socket']).st_mode):
+                    break
+            except OSError:
+                pass
+        elif 'port' in ready:
+            if alive and _listening(pid, int(ready['port']), ready.get('protocol', 'tcp')):
+                break
+        elif tail is not None:
+            if [x for x in tail.lines() if pattern.search(x)]:
+                break
+        if not alive and run['restart'] == 'no' and started:
+            raise IPException("%s exited before it was ready" % description)
+        if time.monotonic() >= deadline:
+            raise IPException("%s not ready in %.1f seconds" % (description, run['ready_timeout']))
+        time.sleep(PROBE_INTERVAL)
+    logger.debug("%s ready in %.3fs" % (description, time.monotonic() - start))
+
+
+def start(context, run):
+    """
+    Start background run entry in namespace of context and track its PID, wait_ready waits until it is ready
+    :return: (PID, supervised), PID is that of the supervisor process if the entry is supervised
+    """
+    namespace = context.namespace
+    os.makedirs(pid_directory(namespace), mode=0o700, exist_ok=True)
+    args = [run['command']] + list(run['args'])
+    if run['restart'] != 'no' or run['output_max_bytes']:
+        in_worker = ip.EXEC_MODE == 'worker' and namespace
+        spec = {'namespace': namespace, 'name': run['name'], 'setns': bool(in_worker), 'pid_dir': PID_DIR,
+                'args': args if in_worker else context._ns_prefix() + args,
+                'output_file': os.path.abspath(run['output_file']) if run['output_file'] else None,
+                'output_max_bytes': run['output_max_bytes'], 'output_backups': run['output_backups'],
+                'restart': run['restart'], 'restart_delay': run['restart_delay']}
+        _remove(pid_file(namespace, run['name']))
+        started = time.monotonic()
+        # Errors of supervisor itself end up in output file
+        with open(spec['output_file'] or os.devnull, 'ab') as o:
+            p = subprocess.Popen([sys.executable, os.path.abspath(__file__), json.dumps(spec)],
+                                 stdin=subprocess.DEVNULL, stdout=o, stderr=o, start_new_session=True)
+        profiler.record('spawn', "supervise %s" % ' '.join(args), namespace, started)
+        (pid, supervised) = (p.pid, True)
+    else:
+        pid = context.run(*args, background=True, output_file=run['output_file'])
+        write_pid(pid_file(namespace, run['name']), pid)
+        supervised = False
+    return (pid, supervised)
+
+
+def tracked_pids(namespace):
+    """
+    Return (supervisor PIDs, process PIDs) of running processes tracked in pidfiles of namespace
+    """
+    supervisors = []
+    processes = []
+    try:
+        names = os.listdir(pid_directory(namespace))
+    except FileNotFoundError:
+        return (supervisors, processes)
+    for name in names:
+        if not name.endswith('.pid'):
+            continue
+        pid = read_pid(os.path.join(pid_directory(namespace), name))
+        if pid is not None and is_alive(pid):
+            (supervisors if name.endswith('.supervisor.pid') else processes).append(pid)
+    return (supervisors, processes)
+
+
+def is_tracked(namespace, run):
+    """
+    Return True if process of run entry is known from its pidfile, otherwise it is looked for in /proc
+    """
+    return read_pid(pid_file(namespace, run['name'])) is not None
+
+
+def forget(namespace):
+    """
+    Remove pidfiles of namespace
+    """
+    directory = pid_directory(namespace)
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return
+    for name in names:
+        _remove(os.path.join(directory, name))
+    try:
+        os.rmdir(directory)
+    except OSError:
+        pass
+
+
+if __name__ == '__main__':
+    supervise(json.loads(sys.argv[1]))
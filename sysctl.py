@@ -0,0 +1,40 @@
+"""
+Applying sysctl values to namespaces.
+
+All wanted keys of a namespace are read in one go and only those differing
+from the wanted value are written, again in one go. Keys which can not be
+read are written too, so a key that does not exist fails with its own error. How values are read and
+written depends on the backend and execution mode, see IPContext.sysctl.
+"""
+
+# Forwarding keys set in every namespace, to 1 unless namespace has forwarding: false
+FORWARDING = ['net.ipv4.ip_forward', 'net.ipv6.conf.all.forwarding']
+
+
+def forwarding_defaults(enabled=True):
+    return dict([(key, 1 if enabled else 0) for key in FORWARDING])
+
+
+def normalize_value(value):
+    return ' '.join(str(value).split())
+
+
+def changed_values(current, values):
+    """
+    Return values which differ from current values
+    """
+    return dict([(key, value) for (key, value) in values.items()
+                 if current.get(key) is None or normalize_value(current[key]) != normalize_value(value)])
+
+
+def apply(context, values):
+    """
+    Set sysctl values in namespace of context, skipping keys already at wanted value
+    :return: dict of values written
+    """
+    if not values:
+        return {}
+    changed = changed_values(context.read_sysctl(values.keys()), values)
+    if changed:
+        context.sysctl(changed)
+    return changed
@@ -1,4 +1,11 @@
-import jinja2
+import functools
+
+# Number of compiled templates kept in memory
+TEMPLATE_CACHE_SIZE = 1024
+
+_environment = None
+_plain = 0
+
 
 def get_by_tag(itemlist, required):
     for item in itemlist:
@@ -6,11 +13,48 @@ def get_by_tag(itemlist, required):
             if required in item['tags']:
                 return item
 
+
+def get_environment():
+    global _environment
+    if _environment is None:
+        # Imported here, configs without templated strings never need Jinja
+        import jinja2
+        _environment = jinja2.Environment(undefined=jinja2.StrictUndefined)
+        _environment.globals.update({'get_by_tag': get_by_tag})
+    return _environment
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def compile_string(string):
+    return get_environment().from_string(string)
+
+
+def cache_info():
+    """
+    Return counters of template cache, plain strings are expanded without Jinja
+    """
+    info = compile_string.cache_info()
+    return {'hits': info.hits, 'misses': info.misses, 'plain': _plain, 'size': info.currsize}
+
+
+def _is_plain(string):
+    return '{{' not in string and '{%' not in string and '{#' not in string
+
+
+def _render_plain(string):
+    # Same newline handling as Jinja: newlines are normalized and one trailing newline removed
+    string = string.replace('\r\n', '\n').replace('\r', '\n')
+    if string.endswith('\n'):
+        string = string[:-1]
+    return string
+
+
 def expand_string(string, namespace={}, this=None):
-    env = jinja2.Environment(undefined=jinja2.StrictUndefined)
-    env.globals.update({'namespace': namespace, 'this': this, 'get_by_tag': get_by_tag})
-    return_value = env.from_string(string).render()
+    global _plain
+    if isinstance(string, str) and _is_plain(string):
+        _plain += 1
+        return _render_plain(string)
+    return_value = compile_string(string).render(namespace=namespace, this=this)
     if return_value is None:
         raise ConfigException("Failed to parse template string '%s'" % string)
     return return_value
-
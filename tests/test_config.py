@@ -0,0 +1,47 @@
+import os
+
+import pytest
+
+import nscommander
+
+
+CONFIG = """
+namespaces:
+    nsA:
+      run:
+          - command: /bin/true
+            background: True
+            output_file: %s/logs/true.log
+"""
+
+
+def test_cached_config_checks_output_directory(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    (tmp_path / 'logs').mkdir()
+    path = tmp_path / 'config.yaml'
+    path.write_text(CONFIG % tmp_path)
+    nscommander.load_config(str(path))
+    assert len(os.listdir(nscommander.config_cache_directory())) == 1
+    (tmp_path / 'logs').rmdir()
+    with pytest.raises(nscommander.ConfigException):
+        nscommander.load_config(str(path))
+
+
+def test_config_cache_is_pruned(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    (tmp_path / 'logs').mkdir()
+    path = tmp_path / 'config.yaml'
+    for i in range(nscommander.CONFIG_CACHE_ENTRIES + 5):
+        path.write_text(CONFIG % tmp_path + "# %d\n" % i)
+        nscommander.load_config(str(path))
+    assert len(os.listdir(nscommander.config_cache_directory())) == nscommander.CONFIG_CACHE_ENTRIES
+
+
+@pytest.mark.parametrize('background', [False, True])
+def test_run_without_output_file(background):
+    config = nscommander.normalize_config({'namespaces': {'nsA': {'run': [
+        {'command': '/bin/true', 'background': background}]}}})
+    run = config['namespaces']['nsA']['run'][0]
+    assert run['output_file'] is None
+    assert run['output_max_bytes'] == 0
+    assert run['output_backups'] == 3
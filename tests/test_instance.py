@@ -0,0 +1,51 @@
+import pytest
+
+import nscommander
+
+
+def test_instance_name():
+    assert nscommander.instance_name('nsA', None) == 'nsA'
+    assert nscommander.instance_name('global', 'i1') == 'i1-global'
+
+
+@pytest.mark.parametrize('template,prefixed', [
+    ('/tmp/static.conf', True),
+    ('/srv/instances/static.conf', True),
+    ('/tmp/{{ namespace.logical_name }}.conf', True),
+    ('/tmp/{{namespace.name}}.conf', False),
+    ('/tmp/{{ namespace.instance }}/x.conf', False),
+    ('/tmp/{{ namespace["name"] }}.conf', False),
+])
+def test_instance_path(template, prefixed):
+    expected = '/tmp/i1-x.conf' if prefixed else '/tmp/x.conf'
+    assert nscommander.instance_path('/tmp/x.conf', template, 'i1') == expected
+    assert nscommander.instance_path('/tmp/x.conf', template, None) == '/tmp/x.conf'
+
+
+def test_short_name_prefix():
+    assert nscommander.short_name_prefix('ab') == 'ab'
+    # Without instance names of earlier versions are kept
+    assert nscommander.short_name_prefix('uplink-very-long') == 'uplink-very-l'
+    first = nscommander.short_name_prefix('uplink-i1-global', 'i1')
+    second = nscommander.short_name_prefix('uplink-i1-globam', 'i1')
+    assert len(first) == nscommander.MAX_NAME_PREFIX
+    assert first != second
+
+
+def test_normalize_instance():
+    config = nscommander.normalize_config({'namespaces': {
+        'global': {'interfaces': [{'type': 'veth', 'peer': 'nsA', 'name_prefix': 'up-{{ namespace.name }}',
+                                   'my_address': '10.0.0.1/24', 'peer_address': '10.0.0.2/24'}]},
+        'nsA': {},
+    }}, instance='i1')
+    assert sorted(config['namespaces'].keys()) == ['i1-global', 'i1-nsA']
+    namespace = config['namespaces']['i1-global']
+    assert (namespace['name'], namespace['logical_name'], namespace['instance']) == ('i1-global', 'global', 'i1')
+    interface = namespace['interfaces'][0]
+    assert interface['peer'] == 'i1-nsA'
+    assert interface['name_prefix'] == 'up-i1-global'
+
+
+def test_invalid_instance():
+    with pytest.raises(nscommander.ConfigException):
+        nscommander.normalize_config({'namespaces': {}}, instance='a-b')
@@ -0,0 +1,40 @@
+import os
+
+import journal as journal_module
+from journal import Journal, config_key
+
+
+def test_completed_steps_reset_by_finished_create(tmp_path, monkeypatch):
+    monkeypatch.setattr(journal_module, 'JOURNAL_DIR', str(tmp_path))
+    j = Journal()
+    j.open('key')
+    j.record('step', name='namespace/a')
+    assert j.completed_steps() == set(['namespace/a'])
+    assert not j.created()
+    j.record('created')
+    j.record('step', name='links/a')
+    j.open('key')
+    assert j.created()
+    assert j.completed_steps() == set(['links/a'])
+    j.remove()
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_journal_of_edited_config_is_moved(tmp_path, monkeypatch):
+    monkeypatch.setattr(journal_module, 'JOURNAL_DIR', str(tmp_path / 'run'))
+    config = tmp_path / 'config.yaml'
+    config.write_text("namespaces: {}\n")
+    j = Journal()
+    j.open(config_key(str(config)), (str(config), None))
+    j.record('namespace', name='a')
+    j.record('created')
+    config.write_text("namespaces: {b: {}}\n")
+    j.open(config_key(str(config)), (str(config), None))
+    j.record('namespace', name='b')
+    assert [x['name'] for x in j.of('namespace')] == ['a', 'b']
+    assert j.created()
+    assert os.listdir(str(tmp_path / 'run')) == [config_key(str(config))]
+    # Other instances of the same file keep journals of their own
+    j.open(config_key(str(config), 'i1'), (str(config), 'i1'))
+    assert j.entries == []
+    assert len(os.listdir(str(tmp_path / 'run'))) == 2
@@ -0,0 +1,16 @@
+from ip import address_key, route_key
+
+
+def test_route_key_normalizes_destination():
+    assert route_key('fc00::0/64', '6') == route_key('fc00::/64', '6')
+    assert route_key('10.0.0.1/24') == ('main', '10.0.0.0/24')
+
+
+def test_route_key_default():
+    assert route_key('default') == ('main', '0.0.0.0/0')
+    assert route_key('default', 6) == ('main', '::/0')
+
+
+def test_address_key():
+    assert address_key('fc00::0001/64') == 'fc00::1/64'
+    assert address_key('10.0.0.1/24') == '10.0.0.1/24'
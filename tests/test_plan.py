@@ -0,0 +1,32 @@
+import nscommander
+import plan
+
+
+CONFIG = {'namespaces': {
+    'nsA': {'interfaces': [{'type': 'veth', 'peer': 'nsB', 'name_prefix': 'ab',
+                            'my_address': '10.0.0.1/24', 'peer_address': '10.0.0.2/24'}],
+            'routes': [{'destination': '10.0.1.0/24', 'nexthop': '10.0.0.2'}]},
+    'nsB': {},
+}}
+
+
+def test_round_trip(tmp_path):
+    compiled = nscommander.compile_config(nscommander.normalize_config(CONFIG))
+    path = tmp_path / 'topology.plan'
+    path.write_text(plan.dumps(compiled))
+    assert plan.is_plan_file(str(path))
+    assert plan.load(str(path)) == compiled
+    phases = dict(compiled['phases'])
+    assert sorted([x[2] for x in phases['namespaces']]) == ['nsA', 'nsB']
+    assert phases['links'] == [['veth', 'nsA', 'ab-a', 'nsB', 'ab-b']]
+
+
+def test_not_a_plan(tmp_path):
+    path = tmp_path / 'config.yaml'
+    path.write_text("namespaces: {}\n")
+    assert not plan.is_plan_file(str(path))
+
+
+def test_grouped_keeps_order():
+    operations = [['up', 'b', 'x'], ['up', 'a', 'y'], ['up', 'b', 'z']]
+    assert plan.grouped(operations) == [('b', [['up', 'b', 'x'], ['up', 'b', 'z']]), ('a', [['up', 'a', 'y']])]
@@ -0,0 +1,118 @@
+import threading
+import time
+
+import pytest
+
+import nscommander
+from scheduler import Scheduler, SchedulerException
+
+
+def test_runs_dependencies_first():
+    done = []
+    scheduler = Scheduler(jobs=4)
+    scheduler.add("c", lambda: done.append("c"), ["a", "b"])
+    scheduler.add("a", lambda: done.append("a"))
+    scheduler.add("b", lambda: done.append("b"), ["a"])
+    scheduler.run()
+    assert done == ["a", "b", "c"]
+
+
+def test_unknown_dependency():
+    scheduler = Scheduler()
+    scheduler.add("a", lambda: None, ["missing"])
+    with pytest.raises(SchedulerException) as error:
+        scheduler.run()
+    assert error.value.failures == [("a", "unknown dependency 'missing'")]
+
+
+def test_cycle():
+    scheduler = Scheduler()
+    scheduler.add("a", lambda: None, ["b"])
+    scheduler.add("b", lambda: None, ["a"])
+    scheduler.add("c", lambda: None)
+    with pytest.raises(SchedulerException) as error:
+        scheduler.run()
+    assert sorted([name for (name, _) in error.value.failures]) == ["a", "b"]
+
+
+def test_defined_twice():
+    scheduler = Scheduler()
+    scheduler.add("a", lambda: None)
+    with pytest.raises(SchedulerException):
+        scheduler.add("a", lambda: None)
+
+
+def test_failure_stops_new_operations():
+    done = []
+    scheduler = Scheduler(jobs=1)
+    scheduler.add("fail", lambda: 1 / 0)
+    scheduler.add("other", lambda: done.append("other"))
+    scheduler.add("after", lambda: done.append("after"), ["fail"])
+    with pytest.raises(SchedulerException) as error:
+        scheduler.run()
+    assert [name for (name, _) in error.value.failures] == ["fail"]
+    assert done == []
+
+
+def test_running_operations_finish_after_failure():
+    done = []
+    started = threading.Event()
+    failed = threading.Event()
+
+    def fail():
+        started.wait(5)
+        failed.set()
+        raise ValueError("broken")
+
+    def slow():
+        started.set()
+        failed.wait(5)
+        time.sleep(0.1)
+        done.append("slow")
+
+    scheduler = Scheduler(jobs=2)
+    scheduler.add("fail", fail)
+    scheduler.add("slow", slow)
+    scheduler.add("later", lambda: done.append("later"), ["slow"])
+    with pytest.raises(SchedulerException):
+        scheduler.run()
+    assert done == ["slow"]
+
+
+def test_completed_are_skipped():
+    done = []
+    completed = []
+    scheduler = Scheduler()
+    scheduler.add("a", lambda: done.append("a"))
+    scheduler.add("b", lambda: done.append("b"), ["a"])
+    scheduler.run(completed=["a"], on_complete=completed.append)
+    assert done == ["b"]
+    assert completed == ["b"]
+
+
+def _dependencies(scheduler, name):
+    seen = set()
+    pending = [name]
+    while pending:
+        for dep in scheduler.nodes[pending.pop()][1]:
+            if dep not in seen:
+                seen.add(dep)
+                pending.append(dep)
+    return seen
+
+
+def test_create_orders_sysctl_after_interfaces(monkeypatch):
+    captured = []
+    monkeypatch.setattr(nscommander.Scheduler, 'run', lambda self, **kwargs: captured.append(self))
+    config = nscommander.normalize_config({'namespaces': {
+        'nsA': {'interfaces': [{'type': 'veth', 'peer': 'nsB', 'name_prefix': 'ab',
+                                'my_address': '10.0.0.1/24', 'peer_address': '10.0.0.2/24'}],
+                'sysctl': {'net.ipv4.conf.ab-a.rp_filter': 0}},
+        'nsB': {'sysctl': {'net.ipv4.conf.ab-b.rp_filter': 0}},
+    }})
+    nscommander.create_from_config(config, jobs=8)
+    scheduler = captured[0]
+    for namespace in ['nsA', 'nsB']:
+        dependencies = _dependencies(scheduler, "sysctl/%s" % namespace)
+        assert "interfaces/%s" % namespace in dependencies
+        assert "links/nsA" in dependencies
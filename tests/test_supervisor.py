@@ -0,0 +1,35 @@
+import os
+import subprocess
+
+import supervisor
+
+
+def test_pid_of_running_process(tmp_path):
+    path = str(tmp_path / 'run.pid')
+    supervisor.write_pid(path, os.getpid())
+    assert supervisor.read_pid(path) == os.getpid()
+
+
+def test_reused_pid_is_ignored(tmp_path):
+    path = str(tmp_path / 'run.pid')
+    supervisor.write_pid(path, os.getpid())
+    with open(path) as f:
+        (pid, started) = f.read().split()
+    # Same PID started at another time belongs to another process
+    with open(path, 'w') as f:
+        f.write("%s %d\n" % (pid, int(started) + 1))
+    assert supervisor.read_pid(path) is None
+
+
+def test_exited_process_is_ignored(tmp_path):
+    path = str(tmp_path / 'run.pid')
+    p = subprocess.Popen(['true'])
+    supervisor.write_pid(path, p.pid)
+    p.wait()
+    assert supervisor.read_pid(path) is None
+
+
+def test_pidfile_without_start_time_is_ignored(tmp_path):
+    path = tmp_path / 'run.pid'
+    path.write_text("%d\n" % os.getpid())
+    assert supervisor.read_pid(str(path)) is None
@@ -0,0 +1,62 @@
+import os
+
+import ip
+import nsworker
+import sysctl
+
+
+class FakeContext(object):
+    def __init__(self, current):
+        self.current = current
+        self.written = []
+
+    def read_sysctl(self, keys):
+        return dict([(k, self.current[k]) for k in keys if k in self.current])
+
+    def sysctl(self, values):
+        self.written.append(values)
+
+
+def test_changed_values():
+    current = {'net.ipv4.ip_forward': '1', 'net.ipv4.tcp_rmem': '4096 131072  6291456'}
+    values = {'net.ipv4.ip_forward': 1, 'net.ipv4.tcp_rmem': '4096\t131072 6291456', 'net.ipv6.x': 0}
+    assert sysctl.changed_values(current, values) == {'net.ipv6.x': 0}
+
+
+def test_apply_writes_only_changed():
+    context = FakeContext({'a.b': '0', 'c.d': '1'})
+    assert sysctl.apply(context, {'a.b': 1, 'c.d': 1}) == {'a.b': 1}
+    assert context.written == [{'a.b': 1}]
+
+
+def test_apply_writes_missing_keys():
+    context = FakeContext({'a.b': '1'})
+    assert sysctl.apply(context, {'a.b': 1, 'missing.key': 1}) == {'missing.key': 1}
+    assert context.written == [{'missing.key': 1}]
+
+
+def test_apply_nothing_changed():
+    context = FakeContext({'a.b': '1'})
+    assert sysctl.apply(context, {'a.b': '1'}) == {}
+    assert context.written == []
+
+
+def test_worker_read_skips_missing(tmp_path, monkeypatch):
+    monkeypatch.setattr(nsworker, 'sysctl_path', lambda key: os.path.join(str(tmp_path), key))
+    (tmp_path / 'a.b').write_text("4096\t131072\n")
+    assert nsworker.read_sysctl(['a.b', 'missing']) == {'a.b': '4096 131072'}
+
+
+def test_command_read_skips_missing(monkeypatch):
+    context = ip.IPContext(namespace='ns')
+    monkeypatch.setattr(ip, 'EXEC_MODE', 'exec')
+    monkeypatch.setattr(ip, 'BACKEND', 'ip')
+    commands = []
+
+    def run(*args, **kwargs):
+        commands.append(args)
+        return "net.ipv4.ip_forward = 1\nnet.ipv4.tcp_rmem = 4096\t131072\t6291456\n"
+    monkeypatch.setattr(context, 'run', run)
+    values = context.read_sysctl(['net.ipv4.ip_forward', 'net.nope', 'net.ipv4.tcp_rmem'])
+    assert values == {'net.ipv4.ip_forward': '1', 'net.ipv4.tcp_rmem': '4096 131072 6291456'}
+    assert '-e' in commands[0]
@@ -0,0 +1,62 @@
+import pytest
+
+import nscommander
+
+
+def veth(peer, prefix, my, other):
+    return {'type': 'veth', 'peer': peer, 'name_prefix': prefix, 'my_address': my, 'peer_address': other}
+
+
+def errors(namespaces):
+    with pytest.raises(nscommander.ConfigException) as error:
+        nscommander.normalize_config({'namespaces': namespaces})
+    return str(error.value)
+
+
+def test_valid():
+    nscommander.normalize_config({'namespaces': {
+        'nsA': {'interfaces': [veth('nsB', 'ab', '10.0.0.1/24', '10.0.0.2/24')],
+                'routes': [{'destination': '10.0.1.0/24', 'nexthop': '10.0.0.2'}]},
+        'nsB': {},
+    }})
+
+
+def test_unknown_peer():
+    assert "peer namespace 'nsX'" in errors({'nsA': {'interfaces': [veth('nsX', 'ax', '10.0.0.1/24',
+                                                                          '10.0.0.2/24')]}})
+
+
+def test_duplicate_interface_and_address():
+    message = errors({
+        'nsA': {'interfaces': [veth('nsB', 'ab', '10.0.0.1/24', '10.0.0.2/24'),
+                               veth('nsB', 'ab', '10.0.0.1/24', '10.0.0.3/24')]},
+        'nsB': {},
+    })
+    assert "interface 'ab-a' in namespace 'nsA' defined by" in message
+    assert "address 10.0.0.1 on interface 'ab-a'" in message
+
+
+def test_overlapping_networks_warn(caplog):
+    nscommander.normalize_config({'namespaces': {
+        'nsA': {'interfaces': [{'name': 'lo', 'address': '10.0.0.0/8'},
+                               veth('nsB', 'ab', '10.1.0.1/30', '10.1.0.2/30')]},
+        'nsB': {},
+    }})
+    assert "overlaps" in caplog.text
+
+
+def test_unreachable_nexthop():
+    message = errors({
+        'nsA': {'interfaces': [veth('nsB', 'ab', '10.0.0.1/24', '10.0.0.2/24')],
+                'routes': [{'destination': '10.0.1.0/24', 'nexthop': '10.9.9.9'}]},
+        'nsB': {},
+    })
+    assert "not in any connected network" in message
+
+
+def test_every_error_reported():
+    message = errors({
+        'nsA': {'interfaces': [veth('nsX', 'ax', '10.0.0.1/24', '10.0.0.2/24')],
+                'routes': [{'destination': '10.0.1.0/24', 'nexthop': '10.9.9.9'}]},
+    })
+    assert message.startswith("2 error(s) in config")
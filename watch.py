@@ -0,0 +1,188 @@
+"""
+Watching config files and live namespaces for changes.
+
+Inotify reports writes to config and template sources and namespaces added to
+or removed from /run/netns. A rtnetlink socket subscribed to link, address and
+route multicast groups in each namespace reports changes done by someone else,
+so drift is noticed without listing links or routes periodically.
+"""
+
+import ctypes
+import errno
+import os
+import select
+import struct
+
+from ip import NETNS_RUN_DIR, logger, netns_path
+from netlink import NetlinkSocket
+
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# Editors often replace files by renaming a new file over them
+FILE_EVENTS = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_MOVED_FROM
+
+INOTIFY_EVENT = struct.Struct("=iIII")
+
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+RTMGRP_IPV6_IFADDR = 0x100
+RTMGRP_IPV6_ROUTE = 0x400
+
+DRIFT_GROUPS = RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE | RTMGRP_IPV6_IFADDR | RTMGRP_IPV6_ROUTE
+
+_libc = None
+
+
+def _check(result):
+    if result < 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+    return result
+
+
+class Inotify(object):
+    """
+    Inotify instance watching directories, reports changed files by path
+    """
+    def __init__(self):
+        global _libc
+        if _libc is None:
+            _libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = _check(_libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+        self.directories = {}
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        os.close(self.fd)
+
+    def watch(self, directory):
+        directory = os.path.abspath(directory)
+        if directory in self.directories.values():
+            return
+        wd = _check(_libc.inotify_add_watch(self.fd, directory.encode("utf-8"), FILE_EVENTS))
+        self.directories[wd] = directory
+
+    def read(self):
+        """
+        Return set of paths changed since last read, None means events were lost
+        """
+        paths = set()
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return paths
+            offset = 0
+            while offset < len(data):
+                (wd, mask, _, length) = INOTIFY_EVENT.unpack_from(data, offset)
+                name = data[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + length].split(b'\0', 1)[0]
+                offset += INOTIFY_EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    return None
+                if wd in self.directories and name:
+                    paths.add(os.path.join(self.directories[wd], name.decode("utf-8")))
+
+
+class Monitor(object):
+    """
+    Wait for changed files and for links, addresses and routes changed in namespaces
+    """
+    def __init__(self):
+        self.inotify = Inotify()
+        os.makedirs(NETNS_RUN_DIR, exist_ok=True)
+        self.inotify.watch(NETNS_RUN_DIR)
+        self.sockets = {}
+        self.poll = select.poll()
+        self.poll.register(self.inotify, select.POLLIN)
+
+    def close(self):
+        for (_, sock) in self.sockets.values():
+            sock.close()
+        self.sockets = {}
+        self.inotify.close()
+
+    def watch_files(self, paths):
+        """
+        Watch files through their directories, so files replaced by renaming are noticed too
+        """
+        for path in paths:
+            self.inotify.watch(os.path.dirname(os.path.abspath(path)))
+
+    def _unsubscribe(self, name):
+        (_, sock) = self.sockets.pop(name)
+        self.poll.unregister(sock)
+        sock.close()
+
+    def subscribe(self, namespaces):
+        """
+        Subscribe to changes in namespaces, a list of names where 'global' is the global namespace.
+        Subscriptions of namespaces not in list, or deleted or recreated meanwhile, are dropped.
+        """
+        inodes = {}
+        for name in namespaces:
+            try:
+                inodes[name] = os.stat(netns_path(name)).st_ino if name != 'global' else None
+            except FileNotFoundError:
+                pass
+        for name in list(self.sockets.keys()):
+            if name not in inodes or self.sockets[name][0] != inodes[name]:
+                self._unsubscribe(name)
+        for (name, inode) in inodes.items():
+            if name in self.sockets:
+                continue
+            try:
+                sock = NetlinkSocket(None if name == 'global' else name, groups=DRIFT_GROUPS)
+            except FileNotFoundError:
+                continue
+            sock.sock.setblocking(False)
+            self.sockets[name] = (inode, sock)
+            self.poll.register(sock, select.POLLIN)
+
+    def _drain(self, name):
+        """
+        Read pending messages of namespace socket
+        """
+        sock = self.sockets[name][1]
+        while True:
+            try:
+                sock.receive()
+            except BlockingIOError:
+                return
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+                # Messages were dropped, namespace is checked as a whole anyway
+                logger.debug("Netlink events of namespace %s overflowed" % name)
+
+    def wait(self, timeout=None, settle=0.02):
+        """
+        Wait for changes, then collect those arriving within settle seconds of each other
+        :param timeout: seconds to wait, None waits forever
+        :return: (set of changed file paths or None if file events were lost, set of changed namespaces)
+        """
+        paths = set()
+        namespaces = set()
+        wait = None if timeout is None else int(timeout * 1000)
+        while True:
+            events = self.poll.poll(wait)
+            if not events:
+                return (paths, namespaces)
+            fds = set([fd for (fd, _) in events])
+            if self.inotify.fileno() in fds:
+                changed = self.inotify.read()
+                paths = None if changed is None or paths is None else paths | changed
+            for (name, (_, sock)) in list(self.sockets.items()):
+                if sock.fileno() in fds:
+                    self._drain(name)
+                    namespaces.add(name)
+            wait = int(settle * 1000)